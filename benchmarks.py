@@ -0,0 +1,124 @@
+# /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares how long each cache serializer takes to write and read back a
+# resource, without touching the disk or the network. Run it with
+#   python benchmarks.py [number of round trips]
+
+import sys
+import timeit
+import resources
+import cache
+
+
+# Returns a NamedAPIResource dictionary like Pokeapi sends.
+def named(resource_type, id):
+    return {'name': '{}-{}'.format(resource_type, id),
+            'url': 'http://pokeapi.co/api/v2/{}/{}/'.format(resource_type, id)}
+
+
+# Returns a PokemonResource about the size of a real one, with around 80
+# moves learned in several version groups.
+def pokemon_payload():
+    return [resources.PokemonResource(
+        id=1,
+        name='bulbasaur',
+        base_experience=64,
+        height=7,
+        is_default=True,
+        order=1,
+        weight=69,
+        abilities=[{'is_hidden': slot == 3, 'slot': slot,
+                    'ability': named('ability', slot)} for slot in (1, 3)],
+        forms=[named('pokemon-form', 1)],
+        game_indices=[{'game_index': 153, 'version': named('version', v)}
+                      for v in range(1, 21)],
+        held_items=[],
+        location_area_encounters='/api/v2/pokemon/1/encounters',
+        moves=[{'move': named('move', m),
+                'version_group_details': [
+                    {'level_learned_at': m % 50,
+                     'version_group': named('version-group', g),
+                     'move_learn_method': named('move-learn-method', 1)}
+                    for g in range(1, 6)]}
+               for m in range(1, 81)],
+        sprites={'front_default': 'http://pokeapi.co/media/sprites/1.png',
+                 'back_default': 'http://pokeapi.co/media/sprites/b/1.png',
+                 'front_shiny': None,
+                 'back_shiny': None},
+        species=named('pokemon-species', 1),
+        stats=[{'base_stat': 45, 'effort': 0, 'stat': named('stat', s)}
+               for s in range(1, 7)],
+        types=[{'slot': slot, 'type': named('type', t)}
+               for slot, t in ((1, 12), (2, 4))]
+    )]
+
+
+# Returns a MoveResource about the size of a real one, with machines in many
+# version groups and names in many languages.
+def move_payload():
+    return [resources.MoveResource(
+        id=1,
+        name='pound',
+        accuracy=100,
+        effect_chance=None,
+        pp=35,
+        priority=0,
+        power=40,
+        contest_combos={'normal': {'use_before': [named('move', 2)],
+                                   'use_after': None},
+                        'super': {'use_before': None, 'use_after': None}},
+        contest_type=named('contest-type', 5),
+        contest_effect={'url': 'http://pokeapi.co/api/v2/contest-effect/1/'},
+        damage_class=named('move-damage-class', 2),
+        effect_entries=[{'effect': 'Inflicts regular damage.',
+                         'short_effect': 'Inflicts regular damage.',
+                         'language': named('language', 9)}],
+        effect_changes=[],
+        generation=named('generation', 1),
+        machines=[{'machine': {'url': 'http://pokeapi.co/api/v2/machine/{}/'
+                               .format(g)},
+                   'version_group': named('version-group', g)}
+                  for g in range(1, 21)],
+        meta={'ailment': named('move-ailment', 0), 'min_hits': None,
+              'max_hits': None, 'crit_rate': 0, 'drain': 0, 'healing': 0,
+              'flinch_chance': 0, 'stat_chance': 0,
+              'category': named('move-category', 0)},
+        names=[{'name': 'Pound', 'language': named('language', l)}
+               for l in range(1, 11)],
+        past_values=[{'accuracy': 100, 'effect_chance': None, 'power': 35,
+                      'pp': 35, 'effect_entries': [],
+                      'type': named('type', 1),
+                      'version_group': named('version-group', g)}
+                     for g in range(1, 6)],
+        stat_changes=[],
+        super_contest_effect={
+            'url': 'http://pokeapi.co/api/v2/super-contest-effect/5/'},
+        target=named('move-target', 10),
+        type=named('type', 1)
+    )]
+
+
+# Times writing and reading back a payload with a serializer. Returns the
+# average round trip in microseconds and the size of the serialized payload.
+def round_trip(serializer, payload, number):
+    data = serializer.dump(payload)
+    seconds = timeit.timeit(lambda: cache.load(serializer.dump(payload)),
+                            number=number)
+    return seconds / number * 1000000, len(data)
+
+
+def main(number=200):
+    payloads = (('PokemonResource', pokemon_payload()),
+                ('MoveResource', move_payload()))
+    print('{:<16}{:<10}{:>16}{:>12}'.format('payload', 'format',
+                                            'round trip (us)', 'bytes'))
+    for payload_name, payload in payloads:
+        for name, serializer in sorted(cache.serializers.items()):
+            micros, size = round_trip(serializer, payload, number)
+            print('{:<16}{:<10}{:>16.1f}{:>12}'.format(payload_name, name,
+                                                       micros, size))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
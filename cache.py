@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import universal
+from universal import temp_file_name, write_file
+import metrics
 import tempfile
 from datetime import timedelta, datetime
 import yaml
@@ -15,158 +17,3300 @@ except ImportError:
           "Using pure Python loader and dumper.")
     from yaml import SafeLoader as YAMLLoader
     from yaml import SafeDumper as YAMLDumper
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, so only threads are kept apart there.
+    fcntl = None
 import configparser
 import os
 import gzip
+import zlib
+import bz2
+import lzma
+import struct
+import mmap
+import pickle
+import random
+import re
+import importlib
+import io
+import sqlite3
+import threading
+import atexit
+import json
+import hashlib
+import heapq
+import time
+import collections
+import types
+
+# The names of the storage backends the cache can use.
+backends = ('directory', 'sqlite', 'pack')
+# The store the cache is currently using. Set up by get_store().
+_store = None
+# The (backend, cache directory) _store was made for.
+_store_key = None
+# The in-memory catalog of the directory cache. Set up by get_catalog().
+_catalog = None
+# A clean() that ran out of time, to be resumed by the next call.
+_cleaner = None
+# The queue of writes waiting for a background thread. Set up by
+# get_write_behind().
+_write_behind = None
+# Recently used resources, kept decoded. Set up by get_memory_tier().
+_memory_tier = None
+# The Settings in use, when the config file they came from was modified,
+# when that was last checked, and whether they were set with configure()
+# rather than read from the file.
+_settings = None
+_settings_mtime = None
+_settings_checked = 0
+_settings_pinned = False
+# How many seconds to go between checking whether the config file has
+# changed. None to only read it again when reload() is called.
+config_check_interval = 1.0
+# The cache folder (Meta.cache_folder) and resource class name of each
+# category, filled in by register_category().
+category_folders = {}
+category_classes = {}
+# The expiration length of resources that never expire.
+never = timedelta.max
+# The most folder levels resource_path() can spread a category over, one for
+# each pair of hex digits in an MD5 hash.
+max_shard_levels = 16
+# Compression and decoding figures for each category. See
+# get_compression_stats().
+compression_stats = {}
+# What the cache records to metrics.registry (see metrics.py), along with
+# the figures collect_metrics() reads.
+cache_reads = metrics.registry.counter(
+    'pykachu_cache_reads_total',
+    'Cache reads, by category and outcome: memory (a memory tier hit), hit, '
+    'stale (expired but usable), expired (too stale to keep), corrupt '
+    '(quarantined) or miss.',
+    ('category', 'outcome'))
+cache_read_seconds = metrics.registry.histogram(
+    'pykachu_cache_read_seconds',
+    'Seconds cache reads took, by category and outcome.',
+    ('category', 'outcome'))
+cache_writes = metrics.registry.counter(
+    'pykachu_cache_writes_total',
+    'Resources written to the cache, by category and outcome: written, '
+    'queued (for a write-behind worker) or error.',
+    ('category', 'outcome'))
+cache_write_seconds = metrics.registry.histogram(
+    'pykachu_cache_write_seconds',
+    'Seconds taken to encode and store a resource, by category.',
+    ('category',))
+decode_seconds = metrics.registry.histogram(
+    'pykachu_decode_seconds',
+    'Seconds taken to decompress and parse a cache entry, by category.',
+    ('category',))
+# The current dictionary of each category, from the dictionary index, and
+# when the index was last read.
+_dictionary_index = {}
+_dictionary_index_mtime = None
+
+
+# Makes the cache directory and catalogs if they don't exist. Returns the
+# Settings in use.
+#   settings=None (Settings):
+#       the settings to run with. If None, the ones in the config file.
+def set_up(settings=None):
+    if settings is not None:
+        configure(settings)
+    if not os.path.isdir(get_cache_dir()):
+        os.makedirs(get_cache_dir())
+    # The sqlite backend doesn't use the catalogs.
+    if get_backend() == 'sqlite':
+        get_store()
+        return get_settings()
+    # Make the expiration catalog if it doesn't exist
+    if not os.path.isfile(os.path.join(get_cache_dir(),'expiration.cnf')):
+        open(os.path.join(get_cache_dir(), 'expiration.cnf'), 'a').close()
+    # Make the path catalog if it doesn't exist
+    if not os.path.isfile(os.path.join(get_cache_dir(), 'paths.cnf')):
+        open(os.path.join(get_cache_dir(), 'paths.cnf'), 'a').close()
+    return get_settings()
+
+
+# Returns the settings the cache runs with, reading the config file the
+# first time. After that the file is only checked for changes every
+# config_check_interval seconds, and re-read if it has been modified.
+def get_settings():
+    global _settings_checked
+    if _settings is None:
+        return reload()
+    if _settings_pinned or config_check_interval is None:
+        return _settings
+    now = time.monotonic()
+    if now - _settings_checked >= config_check_interval:
+        _settings_checked = now
+        if config_mtime() != _settings_mtime:
+            return reload()
+    return _settings
+
+
+# Reads the config file and makes its settings the ones the cache runs with,
+# replacing any set with configure(). Returns the new Settings.
+def reload():
+    global _settings_mtime, _settings_checked, _settings_pinned
+    _settings_mtime = config_mtime()
+    _settings_checked = time.monotonic()
+    settings = Settings.from_config(universal.get_config())
+    configure(settings)
+    _settings_pinned = False
+    return settings
+
+
+# Makes the cache run with the given Settings, which stay in place until
+# configure() or reload() is called again.
+def configure(settings):
+    global _settings, _settings_pinned, _memory_tier
+    # The memory tier is rebuilt if its limits or the cache it holds
+    # resources from have changed.
+    if (_settings is not None and
+            (settings.path, settings.memory_entries, settings.memory_size,
+             settings.memory_policy) !=
+            (_settings.path, _settings.memory_entries, _settings.memory_size,
+             _settings.memory_policy)):
+        _memory_tier = None
+    _settings = settings
+    _settings_pinned = True
+
+
+# Returns when the config file was last modified, or None if it doesn't
+# exist.
+def config_mtime():
+    try:
+        return os.stat(universal.config_path()).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Returns a directory if it exists or can be made, and can be written to.
+# Otherwise returns None.
+def writable_dir(path):
+    try:
+        os.makedirs(path, exist_ok=True)
+        tempfile.TemporaryFile(dir=path).close()
+        return path
+    except OSError:
+        return None
+
+
+# Returns the cache directory as a string.
+def get_cache_dir():
+    return get_settings().path
+
+
+# Returns the time after which a cache resource should expire. Categories
+# can have their own in the [expiration] section of the config file, in
+# hours or as 'never' or 'immutable', e.g.
+#   [expiration]
+#   pokemon = 24
+#   typeresource = never
+#   stat = immutable
+# gives everything in pokemon/ 24 hours, except types, which never expire,
+# and stats, which are immutable, since a category's own names beat the
+# folders above it (see config_keys()).
+# Resources that never expire get the length never. Immutable categories
+# never expire either, and reading them skips the expiration check
+# altogether (see is_immutable()).
+#   category=None (str):
+#       the category (name of resource class). If None, the length set for
+#       the whole cache.
+def get_expiration_length(category=None):
+    if category is not None:
+        length = get_category_expiration_length(category)
+        if length is not None:
+            return length
+    return get_settings().expiration_length
+
+
+# Returns the length set for a category in the [expiration] section of the
+# config file (see get_expiration_length()), or None if it has none.
+#   category (str):
+#       the category (name of resource class).
+def get_category_expiration_length(category):
+    settings = get_settings()
+    for key in config_keys(category):
+        if key in settings.expiration_lengths:
+            return settings.expiration_lengths[key]
+    return None
+
+
+# Returns whether an expired resource should be returned straight away while
+# a fresh copy is fetched in the background. Set with
+#   [cache]
+#   stale_while_revalidate = True
+def get_stale_while_revalidate():
+    return get_settings().stale_while_revalidate
+
+
+# Returns whether an expired resource should be returned when fetching a
+# fresh copy fails. Set with
+#   [cache]
+#   stale_if_error = True
+def get_stale_if_error():
+    return get_settings().stale_if_error
+
+
+# Returns how long after expiring a resource can still be served stale, in
+# hours as max_stale in the config file. Resources are kept that long after
+# they expire. Zero unless stale_while_revalidate or stale_if_error is on.
+def get_max_stale():
+    settings = get_settings()
+    if settings.stale_while_revalidate or settings.stale_if_error:
+        return settings.max_stale
+    return timedelta(0)
+
+
+# Returns how long resources imported from a dump stay fresh (see
+# importer.py), or never. Set in hours, or as 'never', with
+#   [cache]
+#   import_expiration_length = 720
+def get_import_expiration_length():
+    return get_settings().import_expiration_length
+
+
+# Returns whether a category is set as immutable in the [expiration] section
+# of the config file (see get_expiration_length()).
+#   category (str):
+#       the category (name of resource class).
+def is_immutable(category):
+    settings = get_settings()
+    for key in config_keys(category):
+        if key in settings.expiration_lengths:
+            return key in settings.immutable
+    return False
+
+
+# Returns how long a negative entry lasts (see write_missing()). Set in hours
+# with
+#   [cache]
+#   missing_expiration_length = 1
+def get_missing_expiration_length():
+    return get_settings().missing_expiration_length
+
+
+# Returns how many seconds a client waits for another process (or thread)
+# that's already fetching a resource it missed, instead of fetching it too
+# (see take_lease()). 0 turns waiting off. Set with
+#   [cache]
+#   coalesce_timeout = 10
+def get_coalesce_timeout():
+    return get_settings().coalesce_timeout
+
+
+# Returns the maximum size of the cache. Client and clean() will delete older
+# files to reduce the size of the cache to the maximum size or smaller
+def get_max_size():
+    return get_settings().max_size
+
+
+# Returns the total size of the cache in bytes.
+def get_size():
+    return get_store().get_size()
+
+
+# Returns whether the cache files should be compressed. Only used for
+# categories without a codec of their own (see get_codec()).
+def get_compression():
+    return get_settings().compression
+
+
+# Returns the name of the storage backend the cache uses: 'directory' (one
+# file per resource, catalogued in paths.cnf and expiration.cnf), 'sqlite'
+# (every resource in a single database file) or 'pack' (one packfile per
+# category).
+def get_backend():
+    return get_settings().backend
+
+
+# Returns the size in bytes the catalog journal can reach before it's
+# compacted into the catalog snapshots.
+def get_journal_compact_size():
+    return get_settings().journal_compact_size
+
+
+# Returns the serializer used to write resources to the cache. Resources
+# written in any other format can still be read.
+def get_serializer():
+    return serializers[get_settings().serializer]
+
+
+# Returns the write-behind queue if writes should happen in the background,
+# or None if write_cache() should write before returning. Set with
+#   [cache]
+#   write_behind = True
+#   write_workers = 2
+#   write_queue_size = 1000
+# write_workers is the number of background threads, and write_queue_size
+# the most writes that can wait before write_cache() blocks.
+# The queue is made the first time it's needed, so changes to write_workers
+# and write_queue_size after that have no effect.
+def get_write_behind():
+    global _write_behind
+    settings = get_settings()
+    if not settings.write_behind:
+        return None
+    if _write_behind is None:
+        _write_behind = WriteBehind(settings.write_workers,
+                                    settings.write_queue_size)
+    return _write_behind
+
+
+# Returns the write-behind figures: the queue depth, the writes in progress,
+# how many writes were done, merged into a later write of the same resource,
+# or failed, and the average seconds from write_cache() to the resource
+# being stored (latency) and spent storing it (write_time). Returns None if
+# write-behind isn't in use.
+def get_write_behind_stats():
+    if _write_behind is None:
+        return None
+    return _write_behind.stats()
+
+
+# Returns the memory tier, which keeps recently used resources decoded in
+# front of the store, or None if it's turned off. Set with
+#   [cache]
+#   memory_entries = 1000
+#   memory_size = 67108864
+#   memory_policy = lru
+# memory_entries is the most resources to keep (0 turns the tier off),
+# memory_size the most bytes, counted as the size of the stored entries, and
+# memory_policy one of the eviction policies. The tier is shared by every
+# client in the process.
+def get_memory_tier():
+    global _memory_tier
+    settings = get_settings()
+    if settings.memory_entries <= 0:
+        return None
+    if _memory_tier is None:
+        _memory_tier = MemoryTier(
+            eviction_policies[settings.memory_policy](),
+            settings.memory_entries, settings.memory_size)
+    return _memory_tier
+
+
+# Returns the eviction policy class used when the cache goes over its maximum
+# size.
+def get_eviction_policy():
+    return eviction_policies[get_settings().eviction_policy]
+
+
+# Returns the catalog of the directory cache, loading it the first time it's
+# needed. There's one catalog per process.
+def get_catalog():
+    global _catalog
+    cache_dir = get_cache_dir()
+    if _catalog is None or _catalog.cache_dir != cache_dir:
+        # The cache directory has moved, so let go of the old journal.
+        if _catalog is not None:
+            _catalog.close()
+        _catalog = Catalog(cache_dir, get_journal_compact_size())
+    return _catalog
+
+
+# Finishes any queued writes, then writes the catalog journal into the
+# catalog snapshots.
+def flush():
+    if _write_behind is not None:
+        _write_behind.flush()
+    if _catalog is not None:
+        _catalog.flush()
+
+
+# Returns the store for the configured backend, creating it the first time
+# it's needed and again whenever the backend or the cache directory changes.
+def get_store():
+    global _store, _store_key
+    backend = get_backend()
+    key = (backend, get_cache_dir())
+    if _store is None or _store_key != key:
+        if backend == 'sqlite':
+            _store = SQLiteStore(os.path.join(get_cache_dir(),
+                                              'cache.sqlite3'))
+            # Bring over anything cached before the switch to sqlite.
+            flush()
+            _store.migrate(get_cache_dir())
+        elif backend == 'pack':
+            _store = PackStore()
+        else:
+            _store = DirectoryStore()
+        _store_key = key
+    return _store
+
+
+# Records the cache folder (Meta.cache_folder) of a category, so the
+# per-folder settings in the config file apply to it.
+#   category (str):
+#       the category (name of resource class).
+#   folder (str):
+#       the cache folder, e.g. 'pokemon/pokemon/'.
+#   class_name=None (str):
+#       the name of the resource class, e.g. 'PokemonResource', so settings
+#       can be keyed by it too.
+def register_category(category, folder, class_name=None):
+    category_folders[category] = folder
+    if class_name:
+        category_classes[category] = class_name.lower()
+
+
+# Returns the names a category can be configured under, from most to least
+# specific: its cache folder, its resource class, the category name, then
+# each folder above its cache folder. 'berry firmness', in
+# 'berries/firmnesses/', can be configured as 'berries/firmnesses',
+# 'berryfirmnessresource', 'berry firmness' or 'berries'. The config file
+# makes every name lower case.
+def config_keys(category):
+    folder = category_folders.get(category, '').strip('/')
+    keys = [folder] if folder else []
+    if category in category_classes:
+        keys.append(category_classes[category])
+    keys.append(category)
+    folder = folder.rpartition('/')[0]
+    while folder:
+        keys.append(folder)
+        folder = folder.rpartition('/')[0]
+    return keys
+
+
+# Returns the codec and compression level for a category. Set in the
+# [codecs] section of the config file as 'codec' or 'codec:level', e.g.
+#   [codecs]
+#   games/generations = none
+#   pokemon = lzma:9
+# Categories without a setting use gzip at level 6 if compression is on and
+# no compression otherwise.
+#   category (str):
+#       the category (name of resource class).
+def get_codec(category):
+    settings = get_settings()
+    for key in config_keys(category):
+        if key in settings.codecs:
+            return settings.codecs[key]
+    if settings.compression:
+        return codecs['gzip'], 6
+    return codecs['none'], None
+
+
+# Turns a resource into the bytes that are stored in the cache: a header
+# naming the codec and dictionary, then the compressed, serialized resource.
+# Categories compressed with zlib use their trained dictionary, if they have
+# one.
+#   resource (subclass of resources.utility.CacheableResource):
+#       The resource that is to be cached.
+#   category=None (str):
+#       the category (name of resource class), which decides the codec.
+def encode(resource, category=None):
+    serializer = get_serializer()
+    serialized = serializer.dumps(resource)
+    codec, level = get_codec(category)
+    dictionary = get_dictionary(category) if codec.name == 'zlib' else None
+    if dictionary:
+        compressed = dictionary.compress(serialized, level)
+    else:
+        compressed = codec.compress(serialized, level)
+    cached = pack_entry(serializer, codec, dictionary.id if dictionary else 0,
+                        compressed)
+    stats = compression_stats.setdefault(category, CompressionStats())
+    stats.codec = codec.name
+    stats.raw += len(serialized)
+    stats.stored += len(cached)
+    return cached
+
+
+# Returns a cache entry: a version 3 header, then the payload.
+#   serializer (Serializer):
+#       the serializer the payload was serialized with.
+#   codec (Codec):
+#       the codec it was compressed with.
+#   dictionary_id (int):
+#       the id of the dictionary it was compressed with, or 0 for none.
+#   payload (bytes):
+#       the serialized, compressed resource.
+def pack_entry(serializer, codec, dictionary_id, payload):
+    return entry_headers[3].pack(entry_magic, 3, serializer.id, codec.id,
+                                 dictionary_id, len(payload),
+                                 zlib.crc32(payload)) + payload
+
+
+# Returns the id of the dictionary an entry was compressed with, or 0 if it
+# wasn't.
+def entry_dictionary(data):
+    if data[:len(entry_magic)] != entry_magic or len(data) < 4:
+        return 0
+    version = data[len(entry_magic)]
+    if version == 2 and len(data) >= entry_headers[2].size:
+        return entry_headers[2].unpack_from(data)[3]
+    if version == 3 and len(data) >= entry_headers[3].size:
+        return entry_headers[3].unpack_from(data)[4]
+    return 0
+
+
+# Turns bytes read from the cache back into a resource.
+#   data (bytes):
+#       The bytes that were stored in the cache.
+#   category=None (str):
+#       the category (name of resource class), for the decoding figures.
+# Returns None if the bytes can't be parsed.
+def decode(data, category=None):
+    started = time.perf_counter()
+    unpacked = unpack(data)
+    if unpacked is None:
+        return None
+    cached = load(unpacked[1], unpacked[0])
+    elapsed = time.perf_counter() - started
+    stats = compression_stats.setdefault(category, CompressionStats())
+    stats.decodes += 1
+    stats.decode_time += elapsed
+    decode_seconds.observe(elapsed, category)
+    return cached
+
+
+# Returns (serializer, serialized bytes) for a cache entry, or None if it's
+# damaged or can't be decompressed. The header says how to read the entry,
+# and a version 3 header's length and checksum are checked before anything
+# else is done with it. The serializer is None for entries from before
+# version 3, whose serialized bytes start with a format tag instead (see
+# load()). Entries from before headers are recognized as gzip by their magic
+# number, or else taken to be uncompressed.
+#   data (bytes):
+#       The bytes that were stored in the cache.
+def unpack(data):
+    dictionary = None
+    serializer = None
+    if data[:len(entry_magic)] == entry_magic:
+        header = (entry_headers.get(data[len(entry_magic)])
+                  if len(data) > len(entry_magic) else None)
+        if header is None or len(data) < header.size:
+            return None
+        if header is entry_headers[3]:
+            (magic, version, format_id, codec_id, dictionary_id, length,
+             checksum) = header.unpack_from(data)
+            data = data[header.size:]
+            # Cut short or damaged.
+            if len(data) != length or zlib.crc32(data) != checksum:
+                return None
+            serializer = serializers_by_id.get(format_id)
+            if serializer is None:
+                return None
+        else:
+            magic, version, codec_id, *dictionary_id = header.unpack_from(data)
+            dictionary_id = dictionary_id[0] if dictionary_id else 0
+            data = data[header.size:]
+        codec = codecs_by_id.get(codec_id)
+        if dictionary_id:
+            dictionary = load_dictionary(dictionary_id)
+            # The dictionary the entry was compressed with is gone.
+            if dictionary is None:
+                return None
+    elif data[:2] == b'\x1f\x8b':
+        codec = codecs['gzip']
+    else:
+        codec = codecs['none']
+    if codec is None:
+        return None
+    try:
+        if dictionary:
+            return serializer, dictionary.decompress(data)
+        # Uncompressed data may be a view into a packfile, which has to be
+        # copied out before it can be parsed.
+        return serializer, bytes(codec.decompress(data))
+    # The data is corrupted
+    except Exception:
+        return None
+
+
+# Returns the folder the compression dictionaries are kept in.
+def get_dictionary_dir():
+    return os.path.join(get_cache_dir(), dictionary_folder)
+
+
+# Returns the trained dictionary currently used for a category, or None if
+# it doesn't have one. The current dictionary of each category is listed in
+# index.cnf in the dictionary folder, which is reread when it changes.
+#   category (str):
+#       the category (name of resource class).
+def get_dictionary(category):
+    global _dictionary_index, _dictionary_index_mtime
+    index_path = os.path.join(get_dictionary_dir(), 'index.cnf')
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if mtime != _dictionary_index_mtime:
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(index_path)
+        _dictionary_index = dict(parser['dictionaries']) \
+            if 'dictionaries' in parser.sections() else {}
+        _dictionary_index_mtime = mtime
+    if category not in _dictionary_index:
+        return None
+    return load_dictionary(int(_dictionary_index[category], 16))
+
+
+# Returns a dictionary by its id, or None if it doesn't exist. Dictionaries
+# never change once written, so each is only read once.
+#   id (int):
+#       the dictionary id from an entry header.
+def load_dictionary(id):
+    if id not in dictionaries:
+        try:
+            with open(os.path.join(get_dictionary_dir(),
+                                   '{:08x}.zdict'.format(id)), 'rb') as file:
+                dictionaries[id] = Dictionary(file.read())
+        except FileNotFoundError:
+            return None
+    return dictionaries[id]
+
+
+# Builds a zlib preset dictionary for a category from a sample of its cached
+# entries and makes it the category's current dictionary. Entries already
+# written keep using the dictionary they were compressed with.
+#   category (str):
+#       the category (name of resource class).
+#   samples=200 (int):
+#       the most entries to learn from.
+#   size=32768 (int):
+#       the most bytes the dictionary can hold. zlib can't look back further
+#       than 32 KB, so a bigger dictionary doesn't help.
+# Returns the new Dictionary, or None if the category has nothing cached.
+def train_dictionary(category, samples=200, size=32 * 1024):
+    store = get_store()
+    ids = [id for entry_category, id, entry_size in store.sizes()
+           if entry_category == category]
+    if len(ids) > samples:
+        ids = random.sample(ids, samples)
+    # Learn from the entries as they would be serialized now.
+    serializer = get_serializer()
+    documents = []
+    for id in ids:
+        data = store.read(category, id)
+        resource = decode(data, category) if data is not None else None
+        if resource is not None:
+            documents.append(serializer.dumps(resource))
+    if not documents:
+        return None
+    dictionary = Dictionary.train(documents, size)
+    # Save the dictionary under its id, then point the index at it.
+    os.makedirs(get_dictionary_dir(), exist_ok=True)
+    path = os.path.join(get_dictionary_dir(),
+                        '{:08x}.zdict'.format(dictionary.id))
+    write_file(path, dictionary.data)
+    dictionaries[dictionary.id] = dictionary
+    index_path = os.path.join(get_dictionary_dir(), 'index.cnf')
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(index_path)
+    if 'dictionaries' not in parser.sections():
+        parser['dictionaries'] = {}
+    parser['dictionaries'][category] = '{:08x}'.format(dictionary.id)
+    text = io.StringIO()
+    parser.write(text)
+    write_file(index_path, text.getvalue().encode())
+    return dictionary
+
+
+# Trains a dictionary for every category in the cache. Returns a dictionary
+# of categories to their new Dictionary.
+def train_dictionaries(samples=200, size=32 * 1024):
+    categories = {category for category, id, entry_size
+                  in get_store().sizes()}
+    trained = {category: train_dictionary(category, samples, size)
+               for category in categories}
+    return {category: dictionary for category, dictionary in trained.items()
+            if dictionary}
+
+
+# Returns the compression figures for each category that has been written or
+# read since the process started, as a dictionary of categories to
+# dictionaries with:
+#   codec (str): the codec last used to write the category.
+#   ratio (float): uncompressed bytes over stored bytes.
+#   decode_time (float): the average seconds taken to decode an entry.
+def get_compression_stats():
+    return {category: {'codec': stats.codec,
+                       'ratio': stats.raw / stats.stored if stats.stored
+                       else None,
+                       'decode_time': stats.decode_time / stats.decodes
+                       if stats.decodes else None}
+            for category, stats in compression_stats.items()}
+
+
+# Returns the figures kept outside metrics.registry, for it to include: the
+# compression figures (see get_compression_stats()), the write-behind
+# figures (see get_write_behind_stats()) and the memory tier's.
+@metrics.registry.collector
+def collect_metrics():
+    for category, stats in list(compression_stats.items()):
+        labels = {'category': category}
+        yield ('pykachu_compressed_raw_bytes',
+               'Bytes written to the cache before compression.', labels,
+               stats.raw)
+        yield ('pykachu_compressed_stored_bytes',
+               'Bytes written to the cache after compression.', labels,
+               stats.stored)
+    write_behind = get_write_behind_stats()
+    for name, value in (write_behind or {}).items():
+        yield ('pykachu_write_behind_' + name,
+               'See cache.get_write_behind_stats().', {}, value)
+    if _memory_tier is not None:
+        for name, value in _memory_tier.stats().items():
+            yield ('pykachu_memory_tier_' + name,
+                   'See cache.MemoryTier.stats().', {}, value)
+
+
+# Turns serialized bytes back into a resource, using the serializer named in
+# the format tag. Entries from before format tags are YAML.
+#   data (bytes):
+#       The uncompressed bytes of a cache entry.
+#   serializer=None (Serializer):
+#       the serializer, for bytes without a format tag. If None, the bytes
+#       start with one.
+# Returns None if the bytes can't be parsed.
+def load(data, serializer=None):
+    if serializer is None:
+        serializer = serializers['yaml']
+        if data.startswith(Serializer.tag_prefix):
+            tag, _, data = data.partition(b'\n')
+            serializer = serializers.get(
+                tag[len(Serializer.tag_prefix):].decode(errors='replace'))
+            if serializer is None:
+                return None
+    try:
+        return serializer.loads(data)
+    except Exception:
+        return None
+
+
+# Turns an expiration date into the whole seconds since the epoch that the
+# stores keep, so checking it is one comparison with time.time().
+#   date (datetime, int or str):
+#       a datetime, epoch seconds, or a date in the ISO format older caches
+#       stored. None stays None.
+def to_epoch(date):
+    if date is None or isinstance(date, int):
+        return date
+    if isinstance(date, datetime):
+        return int(date.timestamp())
+    try:
+        return int(date)
+    # An ISO date from before expiration dates were epoch seconds.
+    except ValueError:
+        return int(parse_date(date).timestamp())
+
+
+# Turns an ISO date string from an older cache into a datetime.
+def parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d:%H:%M:%S.%f')
+
+
+class Settings(collections.namedtuple('Settings', (
+        'path', 'expiration_length', 'max_size', 'compression', 'backend',
+        'serializer', 'eviction_policy', 'journal_compact_size',
+        'write_behind', 'write_workers', 'write_queue_size',
+        'memory_entries', 'memory_size', 'memory_policy', 'codecs',
+        'expiration_lengths', 'immutable', 'stale_while_revalidate',
+        'stale_if_error', 'max_stale', 'import_expiration_length',
+        'missing_expiration_length', 'shard_levels', 'coalesce_timeout'))):
+    """
+    The cache settings, read from the config file once and checked, so
+    nothing has to be looked up or parsed again when the cache is used.
+    Settings that are missing or invalid get their defaults from universal.
+    Settings can't be changed. Use _replace() to make a copy with different
+    values and pass it to configure().
+
+        Fields:
+            path (str)
+                The cache directory. The default is used if the one set
+                can't be written to.
+            expiration_length (datetime.timedelta)
+                How long a resource stays fresh. Set in hours.
+            max_size (float)
+                The most bytes the cache can hold.
+            compression (bool)
+                Whether categories without a codec are compressed.
+            backend, serializer, eviction_policy, memory_policy (str)
+                Names from backends, serializers and eviction_policies.
+            journal_compact_size (int)
+                The journal size that sets off compaction.
+            write_behind (bool), write_workers (int), write_queue_size (int)
+                See get_write_behind().
+            memory_entries (int), memory_size (float)
+                See get_memory_tier().
+            codecs (types.MappingProxyType)
+                (Codec, level) by config key, from the [codecs] section.
+            expiration_lengths (types.MappingProxyType)
+                Expiration lengths (datetime.timedelta, or never) by config
+                key, from the [expiration] section.
+            immutable (frozenset)
+                The config keys set as immutable in the [expiration]
+                section.
+            stale_while_revalidate (bool), stale_if_error (bool)
+                See get_stale_while_revalidate() and get_stale_if_error().
+            max_stale (datetime.timedelta)
+                How long after expiring a resource can be served stale. Set
+                in hours.
+            import_expiration_length (datetime.timedelta)
+                How long resources imported from a dump stay fresh (see
+                importer.py). Set in hours, or 'never'.
+            missing_expiration_length (datetime.timedelta)
+                How long Pokeapi is taken at its word that a resource
+                doesn't exist (see write_missing()). Set in hours.
+            shard_levels (int)
+                See resource_path().
+            coalesce_timeout (float)
+                See get_coalesce_timeout().
+
+    Settings can be pickled, so worker processes can be given the same ones.
+    """
+
+    __slots__ = ()
+
+    # Codecs hold functions that can't be pickled, so they're pickled by
+    # name.
+    def __reduce__(self):
+        fields = self._asdict()
+        fields['codecs'] = {key: (codec.name, level)
+                            for key, (codec, level) in self.codecs.items()}
+        fields['expiration_lengths'] = dict(self.expiration_lengths)
+        return self._unpickle, (fields,)
+
+    @classmethod
+    def _unpickle(cls, fields):
+        fields['codecs'] = types.MappingProxyType(
+            {key: (codecs[name], level)
+             for key, (name, level) in fields['codecs'].items()})
+        fields['expiration_lengths'] = types.MappingProxyType(
+            fields['expiration_lengths'])
+        return cls(**fields)
+
+    # Returns the Settings in a ConfigParser.
+    @classmethod
+    def from_config(cls, config):
+        section = config['cache'] if 'cache' in config.sections() else {}
+
+        # Returns a setting converted by parse, or the default if it's
+        # missing or parse rejects it.
+        def read(key, parse, default):
+            try:
+                value = parse(section[key])
+                assert value is not None
+                return value
+            except Exception:
+                return default
+
+        def positive(kind):
+            return lambda value: kind(value) if kind(value) > 0 else None
+
+        def one_of(names):
+            return lambda value: value if value in names else None
+
+        def boolean(value):
+            return {'True': True, 'False': False}.get(value)
+
+        def non_negative(value):
+            return float(value) if float(value) >= 0 else None
+
+        def levels(value):
+            return int(value) if 0 <= int(value) <= max_shard_levels else None
+
+        def hours_or_never(value):
+            if value.strip().lower() == 'never':
+                return never
+            return timedelta(hours=positive(float)(value))
+
+        codec_settings = {}
+        if 'codecs' in config.sections():
+            for key, value in config['codecs'].items():
+                name, _, level = value.partition(':')
+                try:
+                    codec = codecs[name.strip()]
+                    codec_settings[key] = (codec, int(level) if level
+                                           else codec.level)
+                # Not a codec we know about, so the default applies.
+                except (KeyError, ValueError):
+                    continue
+        expiration_lengths = {}
+        immutable = set()
+        if 'expiration' in config.sections():
+            for key, value in config['expiration'].items():
+                value = value.strip().lower()
+                if value == 'immutable':
+                    immutable.add(key)
+                    expiration_lengths[key] = never
+                elif value == 'never':
+                    expiration_lengths[key] = never
+                else:
+                    try:
+                        hours = float(value)
+                        assert hours > 0
+                    # Not a length, so the default applies.
+                    except (AssertionError, ValueError):
+                        continue
+                    expiration_lengths[key] = timedelta(hours=hours)
+        return cls(
+            path=read('path', writable_dir, universal.default_cache_path),
+            expiration_length=timedelta(hours=read(
+                'expiration_length', positive(float),
+                universal.default_expiration_length)),
+            max_size=read('max_size', positive(float),
+                          universal.default_cache_size),
+            compression=read('compression', boolean,
+                             universal.default_cache_compression),
+            backend=read('backend', one_of(backends),
+                         universal.default_cache_backend),
+            serializer=read('serializer', one_of(serializers),
+                            universal.default_serializer),
+            eviction_policy=read('eviction_policy', one_of(eviction_policies),
+                                 universal.default_eviction_policy),
+            journal_compact_size=read('journal_compact_size', positive(int),
+                                      universal.default_journal_compact_size),
+            write_behind=read('write_behind', boolean, False),
+            write_workers=read('write_workers', positive(int),
+                               universal.default_write_workers),
+            write_queue_size=read('write_queue_size', positive(int),
+                                  universal.default_write_queue_size),
+            memory_entries=read('memory_entries', int,
+                                universal.default_memory_entries),
+            memory_size=read('memory_size', positive(float),
+                             universal.default_memory_size),
+            memory_policy=read('memory_policy', one_of(eviction_policies),
+                               universal.default_memory_policy),
+            codecs=types.MappingProxyType(codec_settings),
+            expiration_lengths=types.MappingProxyType(expiration_lengths),
+            immutable=frozenset(immutable),
+            stale_while_revalidate=read('stale_while_revalidate', boolean,
+                                        False),
+            stale_if_error=read('stale_if_error', boolean, False),
+            max_stale=timedelta(hours=read('max_stale', positive(float),
+                                           universal.default_max_stale)),
+            import_expiration_length=read(
+                'import_expiration_length', hours_or_never,
+                timedelta(hours=universal.default_import_expiration_length)),
+            missing_expiration_length=timedelta(hours=read(
+                'missing_expiration_length', positive(float),
+                universal.default_missing_expiration_length)),
+            shard_levels=read('shard_levels', levels,
+                              universal.default_shard_levels),
+            coalesce_timeout=read('coalesce_timeout', non_negative,
+                                  universal.default_coalesce_timeout))
+
+
+class Codec:
+    """
+    A way of compressing cache entries.
+
+        Attributes:
+            id (int)
+                The number that identifies the codec in entry headers.
+            name (str)
+                The name of the codec, as it appears in the config file.
+            level (int)
+                The compression level used when none is configured.
+    """
+
+    def __init__(self, id, name, compress, decompress, level=None):
+        self.id = id
+        self.name = name
+        self.level = level
+        self._compress = compress
+        self.decompress = decompress
+
+    # Returns the compressed data.
+    def compress(self, data, level=None):
+        return self._compress(data, self.level if level is None else level)
+
+
+# The codecs, by the names used in the config file.
+codecs = {codec.name: codec for codec in (
+    Codec(0, 'none', lambda data, level: data, lambda data: data),
+    Codec(1, 'zlib', zlib.compress, zlib.decompress, 6),
+    Codec(2, 'gzip', lambda data, level: gzip.compress(data, level),
+          gzip.decompress, 6),
+    Codec(3, 'bz2', bz2.compress, bz2.decompress, 9),
+    Codec(4, 'lzma', lambda data, level: lzma.compress(data, preset=level),
+          lzma.decompress, 6)
+)}
+codecs_by_id = {codec.id: codec for codec in codecs.values()}
+# Every entry starts with the magic bytes and the header version. Version 1
+# headers go on to give the codec, and version 2 headers the codec and the id
+# of the dictionary (0 for none). Version 3 headers give the serializer, the
+# codec, the dictionary, and the length and CRC32 of the payload after the
+# header. Entries are written with version 3 headers.
+entry_magic = b'PKC'
+entry_headers = {
+    1: struct.Struct('>3sBB'),
+    2: struct.Struct('>3sBBI'),
+    3: struct.Struct('>3sBBBIII')
+}
+# A negative entry, recording that Pokeapi has no such resource, is the
+# magic bytes and header version 0 with nothing after them.
+missing_entry = entry_magic + b'\x00'
+# The folder in the cache directory entries that can't be read are moved to.
+quarantine_folder = 'quarantine'
+# The folder in the cache directory the lease files are kept in.
+lease_folder = 'leases'
+# How often, in seconds, wait_for_lease() checks whether a lease is free.
+lease_poll_interval = 0.01
+# The folder in the cache directory the compression dictionaries are kept in.
+dictionary_folder = 'dictionaries'
+# Dictionaries already loaded, by id.
+dictionaries = {}
+
+
+class Dictionary:
+    """
+    A zlib preset dictionary trained on the entries of one category. Most
+    entries repeat the same keys and URLs, which zlib can then refer back to
+    instead of spelling out in every small entry.
+
+        Attributes:
+            id (int)
+                The CRC32 of the dictionary, recorded in the header of each
+                entry compressed with it. Since it's taken from the contents,
+                retraining gives a new id and old entries still find the
+                dictionary they were written with.
+            data (bytes)
+                The dictionary itself.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.id = zlib.crc32(data) or 1
+
+    # Returns the data compressed with the dictionary.
+    def compress(self, data, level=None):
+        compressor = zlib.compressobj(6 if level is None else level,
+                                      zdict=self.data)
+        return compressor.compress(data) + compressor.flush()
+
+    # Returns the data decompressed with the dictionary.
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(zdict=self.data)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    # Builds a dictionary from sample documents. Each document is split into
+    # pieces at commas and line breaks, and the pieces that turn up in more
+    # than one document are kept, the ones that save the most last, where
+    # zlib finds them soonest.
+    #   documents (list of bytes):
+    #       the serialized sample entries.
+    #   size (int):
+    #       the most bytes the dictionary can hold.
+    @classmethod
+    def train(cls, documents, size):
+        counts = collections.Counter()
+        for document in documents:
+            counts.update(set(re.findall(rb'[^,\n]+[,\n]?', document)))
+        pieces = [piece for piece, count in counts.items() if count > 1]
+        pieces.sort(key=lambda piece: counts[piece] * len(piece))
+        data = b''.join(pieces)[-size:]
+        return cls(data)
+
+
+class CompressionStats:
+    """
+    Running compression and decoding figures for one category.
+
+        Attributes:
+            codec (str)
+                The codec last used to write the category.
+            raw (int)
+                Bytes written before compression.
+            stored (int)
+                Bytes written after compression, headers included.
+            decodes (int)
+                The number of entries decoded.
+            decode_time (float)
+                The total seconds spent decoding.
+    """
+
+    def __init__(self):
+        self.codec = None
+        self.raw = 0
+        self.stored = 0
+        self.decodes = 0
+        self.decode_time = 0.0
+
+
+class Serializer:
+    """
+    Turns resources into bytes and back.
+
+    Every entry a serializer writes starts with a format tag line, like
+    b'#pykachu:json', so it can be read back whatever the current setting is.
+    The tag is a comment in YAML, so tagged YAML entries are still valid YAML.
+
+        Attributes:
+            name (str)
+                The name of the format, as it appears in the config file and
+                the format tag.
+            id (int)
+                The number that identifies the format in entry headers.
+    """
+
+    name = None
+    id = None
+    tag_prefix = b'#pykachu:'
+
+    # Returns the serialized resource, format tag included.
+    def dump(self, resource):
+        return self.tag_prefix + self.name.encode() + b'\n' + \
+            self.dumps(resource)
+
+    # Returns the serialized resource without a format tag.
+    def dumps(self, resource):
+        raise NotImplementedError
+
+    # Returns the resource from bytes without a format tag.
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class YAMLSerializer(Serializer):
+    """
+    The original format. Slow, especially without libyaml.
+    """
+
+    name = 'yaml'
+    id = 1
+
+    def dumps(self, resource):
+        return yaml.dump_all([resource], Dumper=YAMLDumper).encode()
+
+    def loads(self, data):
+        return yaml.load(data, Loader=YAMLLoader)
+
+
+class JSONSerializer(Serializer):
+    """
+    Stores objects as {'!type': 'module:class', '!state': attributes}. Only
+    YAML-serializable classes (the cacheable resources) are rebuilt, so a
+    tampered entry can't create arbitrary objects.
+    """
+
+    name = 'json'
+    id = 2
+    # Classes already looked up by name.
+    classes = {}
+
+    @staticmethod
+    def default(obj):
+        return {'!type': '{}:{}'.format(type(obj).__module__,
+                                        type(obj).__qualname__),
+                '!state': vars(obj)}
+
+    @classmethod
+    def object_hook(cls, dictionary):
+        if '!type' not in dictionary:
+            return dictionary
+        type_name = dictionary['!type']
+        if type_name not in cls.classes:
+            module_name, _, qualname = type_name.partition(':')
+            resource_class = importlib.import_module(module_name)
+            for name in qualname.split('.'):
+                resource_class = getattr(resource_class, name)
+            if not (isinstance(resource_class, type) and
+                    issubclass(resource_class, yaml.YAMLObject)):
+                raise TypeError('{} is not a cacheable type'.format(type_name))
+            cls.classes[type_name] = resource_class
+        resource_class = cls.classes[type_name]
+        # Rebuild the object the way YAML does, without calling __init__.
+        obj = resource_class.__new__(resource_class)
+        obj.__dict__.update(dictionary['!state'])
+        return obj
+
+    def dumps(self, resource):
+        return json.dumps(resource, default=self.default,
+                          separators=(',', ':')).encode()
+
+    def loads(self, data):
+        return json.loads(data.decode(), object_hook=self.object_hook)
+
+
+class MsgpackSerializer(JSONSerializer):
+    """
+    Stores objects the same way as JSONSerializer, in the more compact
+    msgpack format. Only available if msgpack is installed.
+    """
+
+    name = 'msgpack'
+    id = 3
+
+    def dumps(self, resource):
+        return msgpack.packb(resource, default=self.default)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, object_hook=self.object_hook, raw=False)
+
+
+class PickleSerializer(Serializer):
+    """
+    The fastest format, using pickle protocol 5. Pickles can run code when
+    loaded, so only use this on a cache no one else can write to.
+    """
+
+    name = 'pickle'
+    id = 4
+
+    def dumps(self, resource):
+        return pickle.dumps(resource, protocol=5)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+# The serializers, by the names used in the config file and format tags.
+serializers = {serializer.name: serializer() for serializer in
+               (YAMLSerializer, JSONSerializer, PickleSerializer)}
+if msgpack:
+    serializers['msgpack'] = MsgpackSerializer()
+serializers_by_id = {serializer.id: serializer
+                     for serializer in serializers.values()}
+
+
+class EvictionPolicy:
+    """
+    Decides which resources to remove when the cache is over its maximum
+    size. The store tells its policy about every write, hit and removal, so
+    the policy can rank resources without looking at the disk.
+
+    Resources are identified by (category, id) keys.
+    """
+
+    # Starts tracking a resource that has just been written.
+    def add(self, key, size):
+        raise NotImplementedError
+
+    # Records a cache hit on a resource.
+    def touch(self, key):
+        raise NotImplementedError
+
+    # Stops tracking a resource.
+    def remove(self, key):
+        raise NotImplementedError
+
+    # Yields keys in the order they should be removed. The caller removes
+    # each key it's given with remove() before asking for the next, and can
+    # stop at any point without changing what the policy tracks.
+    def victims(self):
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Removes the least recently used resources first.
+    """
+
+    def __init__(self):
+        self.order = collections.OrderedDict()
+
+    def add(self, key, size):
+        self.order[key] = size
+        self.order.move_to_end(key)
+
+    def touch(self, key):
+        if key in self.order:
+            self.order.move_to_end(key)
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def victims(self):
+        while self.order:
+            key = next(iter(self.order))
+            yield key
+            if key in self.order:
+                return
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Removes the least frequently used resources first. Ties go to the least
+    recently written.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.ticks = {}
+        self.tick = 0
+
+    def add(self, key, size):
+        self.tick += 1
+        self.counts[key] = 1
+        self.ticks[key] = self.tick
+
+    def touch(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+
+    def remove(self, key):
+        self.counts.pop(key, None)
+        self.ticks.pop(key, None)
+
+    def victims(self):
+        heap = [(count, self.ticks[key], key)
+                for key, count in self.counts.items()]
+        heapq.heapify(heap)
+        while heap:
+            key = heapq.heappop(heap)[2]
+            if key in self.counts:
+                yield key
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    """
+    The GreedyDual-Size policy. Each resource has a value of L + 1 / size,
+    and the resource with the lowest value is removed first. L starts at 0
+    and becomes the value of each removed resource, so resources that haven't
+    been used in a while age relative to recently used ones. Large resources
+    go before small ones used equally recently, which keeps more resources in
+    the same space.
+    """
+
+    def __init__(self):
+        self.inflation = 0
+        self.sizes = {}
+        self.values = {}
+        self.heap = []
+        self.victim = None
+
+    def value(self, key):
+        return self.inflation + 1 / max(self.sizes[key], 1)
+
+    def add(self, key, size):
+        self.sizes[key] = size
+        self.touch(key)
+
+    def touch(self, key):
+        if key in self.sizes:
+            self.values[key] = self.value(key)
+            heapq.heappush(self.heap, (self.values[key], key))
+            self.prune()
+
+    def remove(self, key):
+        self.sizes.pop(key, None)
+        value = self.values.pop(key, None)
+        # Only an eviction raises L, not any other removal.
+        if key == self.victim and value is not None:
+            self.victim = None
+            self.inflation = value
+            if self.heap and self.heap[0] == (value, key):
+                heapq.heappop(self.heap)
+        self.prune()
+
+    # Rebuilds the heap once entries left behind by hits and removals
+    # outnumber the live ones.
+    def prune(self):
+        if len(self.heap) > 2 * len(self.values):
+            self.heap = [(value, key) for key, value in self.values.items()]
+            heapq.heapify(self.heap)
+
+    def victims(self):
+        try:
+            while self.heap:
+                value, key = self.heap[0]
+                # Skip entries left behind by hits and removals.
+                if self.values.get(key) != value:
+                    heapq.heappop(self.heap)
+                    continue
+                self.victim = key
+                yield key
+                if key in self.values:
+                    return
+        finally:
+            self.victim = None
+
+
+class TinyLFUPolicy(EvictionPolicy):
+    """
+    The W-TinyLFU policy. New resources go into a small LRU window. When the
+    window is full, its oldest resource moves to the main area, and if
+    something has to be removed it must beat the main area's next victim on
+    estimated use count to stay, so one-off lookups can't push out resources
+    that are used again and again. The main area is split into
+    probation, for resources that haven't been used since getting in, and
+    protected, for those that have.
+
+    Use counts are estimated with a count-min sketch, which is halved every
+    so often so that old popularity fades.
+
+        Attributes:
+            window, probation, protected (collections.OrderedDict)
+                The three areas, each least recently used first.
+            sketch (list of bytearray)
+                The count-min sketch, one row of 4-bit counters per hash.
+    """
+
+    window_share = 0.01
+    protected_share = 0.8
+    depth = 4
+
+    # width=16384 (int):
+    #     the counters in each row of the sketch.
+    def __init__(self, width=16384):
+        self.width = width
+        self.sketch = [bytearray(width) for row in range(self.depth)]
+        self.additions = 0
+        self.candidate = None
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+
+    def slots(self, key):
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def record(self, key):
+        for row, slot in zip(self.sketch, self.slots(key)):
+            if row[slot] < 15:
+                row[slot] += 1
+        self.additions += 1
+        # Halve every counter once enough uses have been seen.
+        if self.additions >= 10 * self.width:
+            for row in self.sketch:
+                row[:] = bytes(count >> 1 for count in row)
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(row[slot]
+                   for row, slot in zip(self.sketch, self.slots(key)))
+
+    def add(self, key, size):
+        self.remove(key)
+        self.record(key)
+        self.window[key] = size
+        # The window's oldest moves to probation, where it has to beat the
+        # oldest there if something has to go.
+        total = len(self.window) + len(self.probation) + len(self.protected)
+        if len(self.window) > max(1, total * self.window_share):
+            self.candidate, size = self.window.popitem(last=False)
+            self.probation[self.candidate] = size
+
+    def touch(self, key):
+        self.record(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            self.protected[key] = self.probation.pop(key)
+            # Keep probation big enough for newcomers to compete with.
+            main = len(self.probation) + len(self.protected)
+            if len(self.protected) > max(1, main * self.protected_share):
+                demoted, size = self.protected.popitem(last=False)
+                self.probation[demoted] = size
+
+    def remove(self, key):
+        self.window.pop(key, None)
+        self.probation.pop(key, None)
+        self.protected.pop(key, None)
+
+    def victims(self):
+        while self.window or self.probation or self.protected:
+            candidate, self.candidate = self.candidate, None
+            if self.probation:
+                victim = next(iter(self.probation))
+                # The newcomer only gets in if it's used more.
+                if (candidate in self.probation and
+                        self.frequency(candidate) <= self.frequency(victim)):
+                    victim = candidate
+            elif self.protected:
+                victim = next(iter(self.protected))
+            else:
+                victim = next(iter(self.window))
+            yield victim
+            if victim in self.window or victim in self.probation or \
+                    victim in self.protected:
+                return
+
+
+# The eviction policies, by the names used in the config file.
+eviction_policies = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gds': GreedyDualSizePolicy,
+    'tinylfu': TinyLFUPolicy
+}
+
+
+class CleanReport:
+    """
+    What clean() removed, or would have removed in a dry run.
+
+        Attributes:
+            expired (list of tuple)
+                The (category, id) of each expired resource.
+            evicted (list of tuple)
+                The (category, id) of each resource removed to bring the
+                cache under its maximum size.
+            uncatalogued (list of str)
+                The paths of files in the cache directory that no catalog
+                entry points to.
+            missing (list of tuple)
+                The (category, id) of each catalog entry whose file doesn't
+                exist.
+            freed (int)
+                The number of bytes freed.
+            complete (bool)
+                Whether cleaning finished. False if it ran out of time.
+    """
+
+    def __init__(self):
+        self.expired = []
+        self.evicted = []
+        self.uncatalogued = []
+        self.missing = []
+        self.freed = 0
+        self.complete = False
+
+
+class FileLock:
+    """
+    An exclusive lock shared by every process using the cache, held with an
+    advisory lock (fcntl.flock) on a lock file. It also keeps threads apart,
+    and a thread that holds it can take it again.
+
+    A forked process opens the lock file again instead of sharing its
+    parent's, since both would otherwise hold the same lock.
+
+        Attributes:
+            path (str)
+                The lock file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.pid = None
+        self.depth = 0
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if self.depth == 0 and fcntl is not None:
+                if self.pid != os.getpid():
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self.file = open(self.path, 'ab')
+                    self.pid = os.getpid()
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.lock.release()
+            raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class CacheStore:
+    """
+    The interface for a cache storage backend.
+
+    A store holds the encoded bytes of each cached resource along with its
+    expiration date, keyed by category and id. Every method takes an optional
+    file_name, which stores that keep one file per resource use as a hint
+    for where the resource lives. Other stores ignore it.
+
+        Attributes:
+            name (str)
+                The name of the backend, as it appears in the config file.
+            policy (EvictionPolicy)
+                Ranks the stored resources for eviction.
+            policy_lock (threading.RLock)
+                Held for every use of the policy, which readers, write-behind
+                threads and background refreshes all share.
+    """
+
+    name = None
+
+    # policy=None (EvictionPolicy):
+    #     the eviction policy. If None, the one set in the config file.
+    def __init__(self, policy=None):
+        self.policy = policy or get_eviction_policy()()
+        self.policy_lock = threading.RLock()
+        with self.policy_lock:
+            for category, id, size in self.sizes():
+                with self.policy_lock:
+                    self.policy.add((category, str(id)), size)
+
+    # Returns the bytes stored for a resource, or None if it isn't cached.
+    def read(self, category, id, file_name=None):
+        raise NotImplementedError
+
+    # Stores the bytes for a resource along with its expiration date in epoch
+    # seconds (None if it never expires) and the validators Pokeapi sent with
+    # it (see get_validators()).
+    def write(self, category, id, data, expiration, file_name=None,
+              validators=None):
+        raise NotImplementedError
+
+    # Moves resources into the layout the settings call for. Returns how
+    # many were moved. Only stores that keep files per resource have a
+    # layout.
+    def relayout(self, max_time=None):
+        return 0
+
+    # Stores many resources at once. Stores that can do it in one go do.
+    #   entries (iterable):
+    #       (category, id, data, expiration, file_name, validators) for each
+    #       resource, as for write().
+    def write_many(self, entries):
+        for entry in entries:
+            self.write(*entry)
+
+    # Removes a resource from the store.
+    def remove(self, category, id, file_name=None):
+        raise NotImplementedError
+
+    # Returns the expiration date of a resource in epoch seconds, or None if
+    # it has none.
+    def get_expiration(self, category, id):
+        raise NotImplementedError
+
+    # Changes the expiration date of a stored resource without rewriting it.
+    def set_expiration(self, category, id, expiration):
+        raise NotImplementedError
+
+    # Returns the validators stored with a resource, a dictionary with
+    # 'etag' and 'last_modified', or None if there are none.
+    def get_validators(self, category, id):
+        raise NotImplementedError
+
+    # Returns the total size of the stored resources in bytes.
+    def get_size(self):
+        raise NotImplementedError
+
+    # Returns a list of (category, id, size) for every stored resource, from
+    # the soonest to expire to the latest.
+    def sizes(self):
+        raise NotImplementedError
+
+    # Removes expired resources and, if the store is over the maximum size,
+    # the resources that expire soonest. This is a generator that yields a
+    # CleanReport after each step, so cleaning can be stopped and resumed.
+    #   dry_run=False (bool):
+    #       if True, nothing is removed and the report says what would have
+    #       been.
+    def clean(self, dry_run=False):
+        raise NotImplementedError
+
+    # Removes resources in the order chosen by the eviction policy until the
+    # store is no bigger than max_size.
+    def evict(self, max_size):
+        with self.policy_lock:
+            victims = self.policy.victims()
+            while self.get_size() > max_size:
+                victim = next(victims, None)
+                if victim is None:
+                    break
+                self.remove(*victim)
+
+
+class DirectoryStore(CacheStore):
+    """
+    A store that keeps each resource in its own file under the cache
+    directory. The paths, expiration dates and sizes of the files are kept
+    in the catalog.
+    """
+
+    name = 'directory'
+
+    def __init__(self, policy=None):
+        catalog = get_catalog()
+        # Caches from before sizes were catalogued need their files measured
+        # once. They're all catalogued with one journal append.
+        records = []
+        for category, id, path in catalog.items('paths'):
+            if catalog.get('sizes', category, id) is None:
+                try:
+                    records.append(('sizes', category, id,
+                                    os.stat(path).st_size))
+                except FileNotFoundError:
+                    pass
+        if records:
+            catalog.set_many(records)
+        super().__init__(policy)
+
+    # A resource that isn't at file_name may still be where an older
+    # layout put it (see resource_path()), in which case it's moved there.
+    def read(self, category, id, file_name=None):
+        catalog = get_catalog()
+        path = file_name or catalog.get('paths', category, id)
+        if not path:
+            return None
+        try:
+            with open(path, mode='rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            old_path = catalog.get('paths', category, id)
+            if not old_path or old_path == path:
+                return None
+            try:
+                self.move(category, id, old_path, path)
+                with open(path, mode='rb') as file:
+                    data = file.read()
+            except FileNotFoundError:
+                return None
+        with self.policy_lock:
+            self.policy.touch((category, str(id)))
+        return data
+
+    def write(self, category, id, data, expiration, file_name=None,
+              validators=None):
+        if not file_name:
+            file_name = resource_path(category, id)
+        # Make the folder if it doesn't exist
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        write_file(file_name, data)
+        self.remove_old_file(category, id, file_name)
+        set_file_path(category, id, file_name)
+        get_catalog().set_many(self.catalog_records(
+            category, id, data, expiration, validators))
+        with self.policy_lock:
+            self.policy.add((category, str(id)), len(data))
+
+    # Writes every file first, then catalogues them all in one journal
+    # append.
+    def write_many(self, entries):
+        folders = set()
+        records = []
+        for category, id, data, expiration, file_name, validators in entries:
+            if not file_name:
+                file_name = resource_path(category, id)
+            folder = os.path.dirname(file_name)
+            if folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+            write_file(file_name, data)
+            self.remove_old_file(category, id, file_name)
+            records.append(('paths', category, id, file_name))
+            records.extend(self.catalog_records(category, id, data,
+                                                expiration, validators))
+            with self.policy_lock:
+                self.policy.add((category, str(id)), len(data))
+        get_catalog().set_many(records)
+
+    # Removes the file a resource was written to before, if it's not the
+    # one it's being written to now.
+    def remove_old_file(self, category, id, file_name):
+        old_path = get_catalog().get('paths', category, id)
+        if old_path and old_path != file_name:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    # Moves a resource's file and updates its path in the catalog.
+    def move(self, category, id, old_path, new_path):
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(old_path, new_path)
+        get_catalog().set('paths', category, id, new_path)
+
+    # Moves every resource that isn't where resource_path() says it should
+    # be, so the layout can change while the cache is in use. Resources are
+    # also moved one at a time as they're read.
+    def relayout(self, max_time=None):
+        deadline = None if max_time is None else time.monotonic() + max_time
+        moved = 0
+        for category, id, path in list(get_catalog().items('paths')):
+            new_path = resource_path(category, id)
+            if path == new_path:
+                continue
+            try:
+                self.move(category, id, path, new_path)
+            except FileNotFoundError:
+                continue
+            moved += 1
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        return moved
+
+    # Returns the catalog records for the expiration date, size and
+    # validators of a resource, as (catalog, category, id, value).
+    def catalog_records(self, category, id, data, expiration, validators):
+        return [('expiration', category, id, to_epoch(expiration)),
+                ('sizes', category, id, len(data)),
+                ('validators', category, id,
+                 json.dumps(validators) if validators else None)]
+
+    def remove(self, category, id, file_name=None):
+        remove_file(category, id, file_name)
+        with self.policy_lock:
+            self.policy.remove((category, str(id)))
+
+    def get_expiration(self, category, id):
+        return get_expiration(category, id)
+
+    def set_expiration(self, category, id, expiration):
+        get_catalog().set('expiration', category, id, to_epoch(expiration))
+
+    def get_validators(self, category, id):
+        validators = get_catalog().get('validators', category, id)
+        return json.loads(validators) if validators else None
+
+    def get_size(self):
+        return get_catalog().total_size
+
+    def sizes(self):
+        catalog = get_catalog()
+        # Resources without an expiration date go last.
+        sizes = [(catalog.get('expiration', category, id) or float('inf'),
+                  category, id, size)
+                 for category, id, size in catalog.items('sizes')]
+        sizes.sort()
+        return [(category, id, size) for date, category, id, size in sizes]
+
+    def clean(self, dry_run=False):
+        report = CleanReport()
+        started = time.time()
+        catalog = get_catalog()
+        # Load the catalogs once. Everything after this is dictionary and set
+        # lookups.
+        paths = {(category, id): path
+                 for category, id, path in catalog.items('paths')}
+        known_paths = set(paths.values())
+        expirations = {(category, id): date
+                       for category, id, date in catalog.items('expiration')}
+        # Find every file in one walk. Resources live in the category
+        # folders, so files at the top level (the catalogs, the journal) are
+        # left alone.
+        found = set()
+        cache_dir = get_cache_dir()
+        for root, dirs, files in os.walk(cache_dir):
+            if root != cache_dir:
+                found.update(os.path.join(root, file) for file in files)
+            # The compression dictionaries, quarantined entries and leases
+            # aren't resources either.
+            else:
+                dirs[:] = [folder for folder in dirs
+                           if folder not in (dictionary_folder,
+                                             quarantine_folder,
+                                             lease_folder)]
+            yield report
+        # Catalog entries for files that don't exist
+        for key, path in paths.items():
+            if path not in found:
+                report.missing.append(key)
+                if not dry_run:
+                    self.remove(*key)
+        yield report
+        # Files that no catalog entry points to. Skip anything written since
+        # cleaning started, since it may have been catalogued in the
+        # meantime.
+        for path in found - known_paths:
+            try:
+                if os.stat(path).st_mtime >= started:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            report.uncatalogued.append(path)
+            yield report
+        # Order the remaining resources by expiration date, soonest first.
+        # Resources without one go last.
+        no_expiration = float('inf')
+        heap = [(expirations.get(key) or no_expiration, key) for key in paths
+                if paths[key] in found]
+        heapq.heapify(heap)
+        # Expired resources are kept while they can still be served stale.
+        now = time.time() - get_max_stale().total_seconds()
+        size = self.get_size()
+        max_size = get_max_size()
+        while heap:
+            date, key = heap[0]
+            if date >= now and size <= max_size:
+                break
+            heapq.heappop(heap)
+            # Leave it if it was rewritten while cleaning was paused.
+            if catalog.get('expiration', *key) != expirations.get(key):
+                continue
+            entry_size = catalog.get('sizes', *key) or 0
+            if date < now:
+                report.expired.append(key)
+            else:
+                report.evicted.append(key)
+            report.freed += entry_size
+            size -= entry_size
+            if not dry_run:
+                self.remove(*key)
+            yield report
+        # Finally, remove expiration, size and validator entries to
+        # non-existent files
+        if not dry_run:
+            for name in ('expiration', 'sizes', 'validators'):
+                for category, id, value in catalog.items(name):
+                    if catalog.get('paths', category, id) is None:
+                        catalog.remove(name, category, id)
+        report.complete = True
+        yield report
+
+
+class Pack:
+    """
+    One category's packfile and its offset index.
+
+    The packfile (e.g. pokemon/pokemon.pack) holds the category's entries
+    back to back. New entries are always appended, so rewriting or removing
+    an entry leaves dead space behind, which repack() reclaims. Reads go
+    through a memory map and hand back a slice of it without copying.
+
+    The index (e.g. pokemon/pokemon.idx) is a list of fixed-size records
+    giving the offset and length of each entry, followed by its id. It's
+    only appended to, and a length of 0 marks a removal, so a write costs
+    one short append. Both files start with the same random token, so an
+    index is never used with a packfile it doesn't describe.
+
+        Attributes:
+            path (str)
+                The path of both files, without the extension.
+            offsets (dict)
+                The (offset, length) of each entry, by id.
+            dead (int)
+                The bytes in the packfile no entry uses.
+            lock (threading.RLock)
+                Guards the files, which are shared between threads.
+            file_lock (FileLock)
+                Keeps other processes from appending or repacking at the
+                same time (e.g. pokemon/pokemon.lock). Reads don't need it.
+            on_reset (function)
+                Called with no arguments, while the locks are held, when the
+                files are missing or don't match and new empty ones are
+                started, so whatever described the old entries can be
+                dropped too.
+    """
+
+    pack_magic = b'PKCPACK'
+    index_magic = b'PKCIDX\x00'
+    token_size = 8
+    header_size = 7 + token_size
+    record = struct.Struct('>QIH')
+    # Repack once more than this fraction of the packfile is dead space.
+    repack_ratio = 0.5
+
+    # on_reset=None (function):
+    #     see on_reset above.
+    def __init__(self, path, on_reset=None):
+        self.path = path
+        self.on_reset = on_reset
+        self.offsets = {}
+        self.dead = 0
+        self.map = None
+        self.index_id = None
+        self.index_offset = 0
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path + '.lock')
+        self.load()
+
+    # Reads the index, starting new files if they don't exist or don't
+    # match.
+    def load(self):
+        with self.lock, self.file_lock:
+            self.offsets = {}
+            self.dead = 0
+            self.map = None
+            try:
+                with open(self.path + '.pack', 'rb') as file:
+                    pack_header = file.read(self.header_size)
+                with open(self.path + '.idx', 'rb') as file:
+                    index_header = file.read(self.header_size)
+                valid = (pack_header[:7] == self.pack_magic and
+                         index_header[:7] == self.index_magic and
+                         pack_header[7:] == index_header[7:])
+            except FileNotFoundError:
+                valid = False
+            if not valid:
+                self.create(b'', b'')
+                if self.on_reset is not None:
+                    self.on_reset()
+            self.index_id = os.stat(self.path + '.idx').st_ino
+            self.index_offset = self.header_size
+            self.replay()
+
+    # Replaces both files with new ones holding the given entries and index
+    # records.
+    def create(self, entries, records):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        token = os.urandom(self.token_size)
+        # Write the packfile first. Until the new index is in place, the
+        # old index doesn't match it and so is never used with it.
+        for extension, magic, contents in (('.pack', self.pack_magic, entries),
+                                           ('.idx', self.index_magic,
+                                            records)):
+            write_file(self.path + extension, magic + token + contents)
 
+    # Applies the index records that haven't been applied yet. A record cut
+    # short by a crash or an append in progress is left for next time.
+    def replay(self):
+        with open(self.path + '.idx', 'rb') as file:
+            file.seek(self.index_offset)
+            data = file.read()
+        position = 0
+        while position + self.record.size <= len(data):
+            offset, length, id_length = self.record.unpack_from(data, position)
+            end = position + self.record.size + id_length
+            if end > len(data):
+                break
+            id = data[position + self.record.size:end].decode()
+            old = self.offsets.pop(id, None)
+            if old:
+                self.dead += old[1]
+            if length:
+                self.offsets[id] = (offset, length)
+            position = end
+        self.index_offset += position
 
-def set_up():
-    if not os.path.isdir(get_cache_dir()):
-        os.makedirs(get_cache_dir())
-    # Make the expiration catalog if it doesn't exist
-    if not os.path.isfile(os.path.join(get_cache_dir(),'expiration.cnf')):
-        open(os.path.join(get_cache_dir(), 'expiration.cnf'), 'a').close()
-    # Make the path catalog if it doesn't exist
-    if not os.path.isfile(os.path.join(get_cache_dir(), 'paths.cnf')):
-        open(os.path.join(get_cache_dir(), 'paths.cnf'), 'a').close()
+    # Catches up with other processes. A replaced index means the category
+    # was repacked, so everything is reloaded.
+    def refresh(self):
+        try:
+            index = os.stat(self.path + '.idx')
+        except FileNotFoundError:
+            index = None
+        if index is None or index.st_ino != self.index_id:
+            self.load()
+        elif index.st_size > self.index_offset:
+            self.replay()
 
+    # Returns a memoryview of an entry's bytes, or None if it isn't in the
+    # pack.
+    def read(self, id):
+        with self.lock:
+            self.refresh()
+            if str(id) not in self.offsets:
+                return None
+            offset, length = self.offsets[str(id)]
+            # The packfile has grown past the map, so map it again. Slices
+            # of the old map stay valid until they're let go.
+            if self.map is None or offset + length > len(self.map):
+                with open(self.path + '.pack', 'rb') as file:
+                    self.map = mmap.mmap(file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            return memoryview(self.map)[offset:offset + length]
 
-# Returns the cache directory as a string.
-def get_cache_dir():
-    # if the cache directory has been set in the config file, use that.
-    config = universal.get_config()
-    try:
-        path = config['cache']['path']
-        tempfile.TemporaryFile(dir=path).close()
-        return path
-    # Either the cache directory wasn't set or we can't write to it, so use
-    # the default
-    except:
-        default_path = universal.default_cache_path
-        if not 'cache' in config.sections():
-            config['cache'] = {}
-        config['cache']['path'] = default_path
-        universal.save_config()
-        return default_path
-
-
-# Returns the time after which a cache resource should expire.
-def get_expiration_length():
-    # If the cache expiration length has been set in the cache file,
-    # use that.
-    config = universal.get_config()
-    try:
-        length = config['cache']['expiration_length']
-        length = timedelta(**length)
-    # Eiter the cache expiration length hasn't been set or it's in an
-    # inappropriate format, so use default
-    except:
-        default_length = universal.default_expiration_length
-        # Put the default in the config file
-        if not 'cache' in config.sections():
-            config['cache'] = {}
-        config['cache']['expiration_length'] = str(default_length)
-        universal.save_config()
-        length = timedelta(hours=default_length)
-    return length
+    # Appends an entry and its index record.
+    def write(self, id, data):
+        with self.lock, self.file_lock:
+            self.refresh()
+            with open(self.path + '.pack', 'ab') as file:
+                offset = file.tell()
+                file.write(data)
+            self.append(id, offset, len(data))
+            if self.dead > self.repack_ratio * (offset + len(data)):
+                self.repack()
 
+    # Appends the index record that removes an entry.
+    def remove(self, id):
+        with self.lock, self.file_lock:
+            self.refresh()
+            if str(id) in self.offsets:
+                self.append(id, 0, 0)
 
-# Returns the maximum size of the cache. Client and clean() will delete older
-# files to reduce the size of the cache to the maximum size or smaller
-def get_max_size():
-    # If the max_size has been set in the cache file, use that.
-    config = universal.get_config()
-    try:
-        size = int(config['cache']['max_size'])
-        assert size > 0
-    # Either the cache max size hasn't been set, it's not numeric, or it's
-    # <= 0
-    except:
-        default_size = universal.default_cache_compression
-        # Put the default in the config file
-        if not 'cache' in config.sections():
-            config['cache'] = {}
-        config['cache']['compression'] = str(default_size)
-        universal.save_config()
-        size = default_size
-    return size
+    # Appends an index record and applies it.
+    def append(self, id, offset, length):
+        id = str(id).encode()
+        with open(self.path + '.idx', 'ab') as file:
+            file.write(self.record.pack(offset, length, len(id)) + id)
+        self.replay()
 
+    # Rewrites the packfile with only the live entries, and a new index to
+    # match.
+    def repack(self):
+        with self.lock, self.file_lock:
+            self.refresh()
+            entries = []
+            records = []
+            offset = self.header_size
+            with open(self.path + '.pack', 'rb') as file:
+                for id, (old_offset, length) in self.offsets.items():
+                    file.seek(old_offset)
+                    entries.append(file.read(length))
+                    records.append(self.record.pack(offset, length,
+                                                    len(id.encode())) +
+                                   id.encode())
+                    offset += length
+            self.create(b''.join(entries), b''.join(records))
+            self.load()
 
-def get_size():
-    return 0
-    # TODO: function that gets total size of cache
 
+class PackStore(DirectoryStore):
+    """
+    A store that keeps each category in a packfile (see Pack) in its cache
+    folder, e.g. pokemon/pokemon.pack for 'pokemon/pokemon/'. Expiration
+    dates and sizes are kept in the catalog, like a directory cache.
 
-# Returns whether the cache files should be compressed.
-def get_compression():
-    # If the max_size has been set in the cache file, use that.
-    config = universal.get_config()
-    try:
-        compression = config['cache']['compression']
-        assert compression in ['True', 'False']
-        compression = bool(compression)
-    # Either the cache max size hasn't been set, it's not numeric, or it's
-    # <= 0
-    except:
-        default_compression = universal.default_cache_compression
-        # Put the default in the config file
-        if not 'cache' in config.sections():
-            config['cache'] = {}
-        config['cache']['compression'] = str(default_compression)
-        universal.save_config()
-        compression = default_compression
-    return compression
-
-
-
-# Reads a file from the cache
+        Attributes:
+            packs (dict)
+                The open packs, by category.
+    """
+
+    name = 'pack'
+
+    def __init__(self, policy=None):
+        self.packs = {}
+        self.lock = threading.Lock()
+        super().__init__(policy)
+
+    # Returns the pack for a category, opening it if needed.
+    def pack(self, category):
+        with self.lock:
+            if category not in self.packs:
+                folder = category_folders.get(category, category).strip('/')
+                self.packs[category] = Pack(
+                    os.path.join(get_cache_dir(), folder),
+                    lambda: self.forget(category))
+            return self.packs[category]
+
+    # Drops everything recorded about a category's resources, for when its
+    # pack has been started again and no longer holds them.
+    def forget(self, category):
+        catalog = get_catalog()
+        ids = {id for name in ('expiration', 'sizes', 'validators')
+               for entry_category, id, value in catalog.items(name)
+               if entry_category == category}
+        if not ids:
+            return
+        catalog.set_many([(name, category, id, None) for id in ids
+                          for name in ('expiration', 'sizes', 'validators')])
+        with self.policy_lock:
+            for id in ids:
+                self.policy.remove((category, str(id)))
+        if _memory_tier is not None:
+            for id in ids:
+                _memory_tier.remove(category, id)
+
+    def read(self, category, id, file_name=None):
+        data = self.pack(category).read(id)
+        if data is not None:
+            with self.policy_lock:
+                self.policy.touch((category, str(id)))
+        return data
+
+    # Packs have no layout to migrate.
+    def relayout(self, max_time=None):
+        return 0
+
+    def write(self, category, id, data, expiration, file_name=None,
+              validators=None):
+        self.pack(category).write(id, data)
+        get_catalog().set_many(self.catalog_records(
+            category, id, data, expiration, validators))
+        with self.policy_lock:
+            self.policy.add((category, str(id)), len(data))
+
+    def write_many(self, entries):
+        records = []
+        for category, id, data, expiration, file_name, validators in entries:
+            self.pack(category).write(id, data)
+            records.extend(self.catalog_records(category, id, data,
+                                                expiration, validators))
+            with self.policy_lock:
+                self.policy.add((category, str(id)), len(data))
+        get_catalog().set_many(records)
+
+    def remove(self, category, id, file_name=None):
+        self.pack(category).remove(id)
+        catalog = get_catalog()
+        catalog.remove('expiration', category, id)
+        catalog.remove('sizes', category, id)
+        catalog.remove('validators', category, id)
+        with self.policy_lock:
+            self.policy.remove((category, str(id)))
+        if _memory_tier is not None:
+            _memory_tier.remove(category, id)
+
+    def clean(self, dry_run=False):
+        report = CleanReport()
+        catalog = get_catalog()
+        # Order the resources by expiration date, soonest first. Resources
+        # without one go last.
+        no_expiration = float('inf')
+        heap = [(catalog.get('expiration', category, id) or no_expiration,
+                 (category, id))
+                for category, id, size in catalog.items('sizes')]
+        heapq.heapify(heap)
+        # Expired resources are kept while they can still be served stale.
+        now = time.time() - get_max_stale().total_seconds()
+        size = self.get_size()
+        max_size = get_max_size()
+        while heap:
+            date, key = heap[0]
+            if date >= now and size <= max_size:
+                break
+            heapq.heappop(heap)
+            # Leave it if it was rewritten while cleaning was paused.
+            if (catalog.get('expiration', *key) or no_expiration) != date:
+                continue
+            entry_size = catalog.get('sizes', *key) or 0
+            if date < now:
+                report.expired.append(key)
+            else:
+                report.evicted.append(key)
+            report.freed += entry_size
+            size -= entry_size
+            if not dry_run:
+                self.remove(*key)
+            yield report
+        # Reclaim the space the removed entries leave behind.
+        if not dry_run:
+            for category in {category for category, id in
+                             report.expired + report.evicted}:
+                self.pack(category).repack()
+                yield report
+        report.complete = True
+        yield report
+
+
+class SQLiteStore(CacheStore):
+    """
+    A store that keeps every resource in a single SQLite database. Resources
+    live in one table whose primary key is (category, id), so reads and
+    writes are index lookups rather than catalog scans, and every write
+    happens in a transaction.
+
+        Attributes:
+            path (str)
+                The path of the database file.
+            connection (sqlite3.Connection)
+                The connection to the database. It's shared between threads,
+                so it's only used while holding lock.
+            lock (threading.RLock)
+                Serializes access to the connection.
+            legacy (bool)
+                Whether the table still has the ISO date expiration column
+                of older databases. Its dates are moved into the expires
+                column as they're read, and all at once by clean().
+
+    The total size of the resources is kept in the totals table by triggers,
+    in the same transaction as each change, so get_size() doesn't have to
+    add up the whole table.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, policy=None):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Lets the delete trigger see rows that INSERT OR REPLACE replaces.
+        self.connection.execute('PRAGMA recursive_triggers = ON')
+        self.lock = threading.RLock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'category TEXT NOT NULL, '
+                'id TEXT NOT NULL, '
+                'payload BLOB NOT NULL, '
+                'expires INTEGER, '
+                'size INTEGER NOT NULL, '
+                'PRIMARY KEY (category, id)) WITHOUT ROWID')
+            columns = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(entries)')]
+            self.legacy = 'expiration' in columns
+            if 'expires' not in columns:
+                self.connection.execute(
+                    'ALTER TABLE entries ADD COLUMN expires INTEGER')
+            if 'validators' not in columns:
+                self.connection.execute(
+                    'ALTER TABLE entries ADD COLUMN validators TEXT')
+            # clean() removes resources in order of expiration.
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_expires '
+                'ON entries (expires)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS totals ('
+                'name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_insert '
+                'AFTER INSERT ON entries BEGIN '
+                "UPDATE totals SET value = value + NEW.size "
+                "WHERE name = 'size'; END")
+            self.connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_delete '
+                'AFTER DELETE ON entries BEGIN '
+                "UPDATE totals SET value = value - OLD.size "
+                "WHERE name = 'size'; END")
+            self.connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS entries_update '
+                'AFTER UPDATE OF size ON entries BEGIN '
+                "UPDATE totals SET value = value + NEW.size - OLD.size "
+                "WHERE name = 'size'; END")
+            # Databases from before the total was kept are added up once.
+            self.connection.execute(
+                'INSERT OR IGNORE INTO totals '
+                "SELECT 'size', COALESCE(SUM(size), 0) FROM entries")
+        super().__init__(policy)
+
+    def read(self, category, id, file_name=None):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT payload FROM entries WHERE category = ? AND id = ?',
+                (category, str(id))).fetchone()
+        if not row:
+            return None
+        with self.policy_lock:
+            self.policy.touch((category, str(id)))
+        return row[0]
+
+    def write(self, category, id, data, expiration, file_name=None,
+              validators=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(category, id, payload, expires, size, validators) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (category, str(id), data, to_epoch(expiration), len(data),
+                 json.dumps(validators) if validators else None))
+        with self.policy_lock:
+            self.policy.add((category, str(id)), len(data))
+
+    # Inserts every resource in one transaction.
+    def write_many(self, entries):
+        rows = [(category, str(id), data, to_epoch(expiration), len(data),
+                 json.dumps(validators) if validators else None)
+                for category, id, data, expiration, file_name, validators
+                in entries]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO entries '
+                '(category, id, payload, expires, size, validators) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        with self.policy_lock:
+            for category, id, data, expiration, size, validators in rows:
+                self.policy.add((category, id), size)
+
+    def remove(self, category, id, file_name=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM entries WHERE category = ? AND id = ?',
+                (category, str(id)))
+        with self.policy_lock:
+            self.policy.remove((category, str(id)))
+        if _memory_tier is not None:
+            _memory_tier.remove(category, id)
+
+    def get_expiration(self, category, id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT expires FROM entries WHERE category = ? AND id = ?',
+                (category, str(id))).fetchone()
+            if row and row[0] is None and self.legacy:
+                return self.migrate_expirations(category, str(id))
+        return row[0] if row else None
+
+    def set_expiration(self, category, id, expiration):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE entries SET expires = ? WHERE category = ? AND id = ?',
+                (to_epoch(expiration), category, str(id)))
+
+    def get_validators(self, category, id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT validators FROM entries '
+                'WHERE category = ? AND id = ?',
+                (category, str(id))).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    # Moves ISO dates from the old expiration column into expires. Returns
+    # the last date moved.
+    #   category=None, id=None (str):
+    #       the resource to move the date of. If None, every date is moved.
+    def migrate_expirations(self, category=None, id=None):
+        query = ('SELECT category, id, expiration FROM entries '
+                 'WHERE expires IS NULL AND expiration IS NOT NULL')
+        parameters = ()
+        if category is not None:
+            query += ' AND category = ? AND id = ?'
+            parameters = (category, id)
+        expires = None
+        with self.lock, self.connection:
+            rows = self.connection.execute(query, parameters).fetchall()
+            for category, id, expiration in rows:
+                expires = to_epoch(expiration)
+                self.connection.execute(
+                    'UPDATE entries SET expires = ?, expiration = NULL '
+                    'WHERE category = ? AND id = ?', (expires, category, id))
+        return expires
+
+    def get_size(self):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM totals WHERE name = 'size'").fetchone()
+        return row[0]
+
+    def sizes(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT category, id, size FROM entries '
+                'ORDER BY expires IS NULL, expires').fetchall()
+
+    def clean(self, dry_run=False):
+        report = CleanReport()
+        if self.legacy:
+            self.migrate_expirations()
+        # Expired resources are kept while they can still be served stale.
+        now = time.time() - get_max_stale().total_seconds()
+        with self.lock:
+            expired = self.connection.execute(
+                'SELECT category, id, size FROM entries '
+                'WHERE expires < ?', (now,)).fetchall()
+        for category, id, size in expired:
+            report.expired.append((category, id))
+            report.freed += size
+        if not dry_run:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'DELETE FROM entries WHERE expires < ?', (now,))
+            with self.policy_lock:
+                for key in report.expired:
+                    self.policy.remove(key)
+        yield report
+        excess = self.get_size() - get_max_size()
+        if dry_run:
+            excess -= report.freed
+        # We've gone over our size limit, so remove in order of expiration
+        # date (soonest to latest, then those that never expire)
+        if excess > 0:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT category, id, size FROM entries '
+                    'WHERE expires >= ? OR expires IS NULL '
+                    'ORDER BY expires IS NULL, expires',
+                    (now,)).fetchall()
+            for category, id, size in rows:
+                # We've removed enough, so no need to continue
+                if excess <= 0:
+                    break
+                report.evicted.append((category, id))
+                report.freed += size
+                excess -= size
+                if not dry_run:
+                    self.remove(category, id)
+                yield report
+        report.complete = True
+        yield report
+
+    # Moves the resources of a directory cache into the database, then
+    # removes the old files and catalogs. The catalogs are read with the
+    # journal replayed over them, so nothing written since the last
+    # compaction is lost. Does nothing if there's no directory cache to
+    # migrate.
+    #   cache_dir (str):
+    #       the cache directory holding the catalog snapshots and journal.
+    def migrate(self, cache_dir):
+        journal_file = os.path.join(cache_dir, Catalog.journal_name)
+        snapshots = [os.path.join(cache_dir, name + '.cnf')
+                     for name in Catalog.names]
+        if not any(os.path.isfile(path)
+                   for path in snapshots + [journal_file]):
+            return
+        catalog = Catalog(cache_dir, get_journal_compact_size())
+        try:
+            expirations = {(category, id): date for category, id, date
+                           in catalog.items('expiration')}
+            validators = {(category, id): value for category, id, value
+                          in catalog.items('validators')}
+            paths = catalog.items('paths')
+        finally:
+            catalog.close()
+        migrated = []
+        # Insert everything in one transaction, so an interrupted migration
+        # leaves the directory cache untouched and is simply redone.
+        with self.lock, self.connection:
+            for category, id, path in paths:
+                try:
+                    with open(path, mode='rb') as file:
+                        data = file.read()
+                except OSError:
+                    continue
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO entries '
+                    '(category, id, payload, expires, size, validators) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (category, id, data, expirations.get((category, id)),
+                     len(data), validators.get((category, id))))
+                migrated.append((category, id, path, len(data)))
+        with self.policy_lock:
+            for category, id, path, size in migrated:
+                self.policy.add((category, id), size)
+        # The resources are safely in the database, so remove the old cache.
+        for category, id, path, size in migrated:
+            os.remove(path)
+        for path in snapshots + [journal_file]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+class Catalog:
+    """
+    The paths, expiration, sizes and validators catalogs of a directory
+    cache, held in memory. Expiration dates are kept as epoch seconds. ISO
+    dates written by older versions are converted as they're loaded, and
+    the next compaction writes them back as epoch seconds.
+
+    paths.cnf, expiration.cnf, sizes.cnf and validators.cnf are snapshots.
+    Every change after the last snapshot is appended as one record to
+    catalog.journal, so a write costs one short append no matter how big the
+    catalogs are. Loading reads the snapshots and replays the journal over
+    them. A record torn by a crash is skipped, and cut off by the next
+    append. Once the journal grows past compact_size bytes, a background
+    thread writes new snapshots and starts an empty journal.
+
+    Other processes are noticed by checking the snapshots' modification
+    times and the journal's size before each lookup. Appends and compactions
+    hold catalog.lock (see FileLock), so every process appends after the
+    last record it has replayed and none appends to a journal that's being
+    replaced. Lookups take no lock, since a record is only replayed once its
+    newline is written.
+
+        Attributes:
+            cache_dir (str)
+                The cache directory holding the snapshots and journal.
+            compact_size (int)
+                The journal size in bytes that triggers a compaction.
+            entries (dict)
+                For each catalog ('paths', 'expiration', 'sizes' and
+                'validators'), a dictionary of categories to dictionaries of
+                ids to values.
+            total_size (int)
+                The sum of the sizes catalog, kept up to date as it changes.
+            journal (file)
+                The journal, open for appending.
+            journal_offset (int)
+                How much of the journal has been replayed into entries.
+            lock (threading.RLock)
+                Guards the catalogs, which are shared between threads.
+            file_lock (FileLock)
+                Keeps other processes from appending or compacting at the
+                same time. Always taken before lock.
+    """
+
+    names = ('paths', 'expiration', 'sizes', 'validators')
+    journal_name = 'catalog.journal'
+    lock_name = 'catalog.lock'
+
+    def __init__(self, cache_dir, compact_size):
+        self.cache_dir = cache_dir
+        self.compact_size = compact_size
+        self.entries = {name: {} for name in self.names}
+        self.total_size = 0
+        self.mtimes = {}
+        self.journal = None
+        self.journal_id = None
+        self.journal_offset = 0
+        self.compactor = None
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(os.path.join(cache_dir, self.lock_name))
+        self.load()
+        atexit.register(self.close)
+
+    # Returns the path of one of the catalog snapshots.
+    def file_path(self, name):
+        return os.path.join(self.cache_dir, name + '.cnf')
+
+    # Returns the path of the journal.
+    def journal_path(self):
+        return os.path.join(self.cache_dir, self.journal_name)
+
+    # Returns the modification time of one of the catalog snapshots, or None
+    # if it doesn't exist.
+    def mtime(self, name):
+        try:
+            return os.stat(self.file_path(name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Reads the snapshots, then replays the journal over them.
+    def load(self):
+        with self.lock:
+            for name in self.names:
+                parser = configparser.ConfigParser(interpolation=None)
+                parser.read(self.file_path(name))
+                self.entries[name] = {category: dict(parser[category])
+                                      for category in parser.sections()}
+                self.mtimes[name] = self.mtime(name)
+            # The snapshots hold strings, but sizes are added up and
+            # expiration dates compared with the time.
+            self.total_size = 0
+            for section in self.entries['sizes'].values():
+                for id, size in section.items():
+                    section[id] = int(size)
+                    self.total_size += section[id]
+            for section in self.entries['expiration'].values():
+                for id, date in section.items():
+                    section[id] = to_epoch(date)
+            self.open_journal()
+            self.journal_offset = 0
+            self.replay()
+
+    # Opens the journal for appending, creating it if it doesn't exist.
+    def open_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path(), 'ab')
+        self.journal_id = os.fstat(self.journal.fileno()).st_ino
+
+    # Applies the records in the journal that haven't been applied yet. A
+    # record without a newline is either another process's append in
+    # progress or was torn by a crash, so replaying stops there.
+    def replay(self):
+        with open(self.journal_path(), 'rb') as file:
+            file.seek(self.journal_offset)
+            for line in file:
+                try:
+                    assert line.endswith(b'\n')
+                    name, category, id, value = json.loads(line.decode())
+                    assert name in self.names
+                except (AssertionError, ValueError):
+                    break
+                self.apply(name, category, id, value)
+                self.journal_offset += len(line)
+
+    # Changes an entry in memory.
+    def apply(self, name, category, id, value):
+        # Older journals hold ISO dates.
+        if name == 'expiration':
+            value = to_epoch(value)
+        section = self.entries[name].setdefault(category, {})
+        if value is None:
+            old = section.pop(id, None)
+        else:
+            old = section.get(id)
+            section[id] = value
+        if name == 'sizes':
+            self.total_size += (value or 0) - (old or 0)
+
+    # Catches up with changes made by other processes. If either snapshot
+    # changed or the journal was replaced, everything is reloaded. If the
+    # journal just grew, only the new records are replayed.
+    def refresh(self):
+        try:
+            journal = os.stat(self.journal_path())
+        except FileNotFoundError:
+            journal = None
+        if (any(self.mtime(name) != self.mtimes[name] for name in self.names)
+                or journal is None or journal.st_ino != self.journal_id
+                or journal.st_size < self.journal_offset):
+            self.load()
+        elif journal.st_size > self.journal_offset:
+            self.replay()
+
+    # Returns the value of an entry, or None if there isn't one.
+    #   name (str):
+    #       the catalog: 'paths', 'expiration', 'sizes' or 'validators'.
+    def get(self, name, category, id):
+        with self.lock:
+            self.refresh()
+            return self.entries[name].get(category, {}).get(str(id))
+
+    # Sets the value of an entry by appending a record to the journal. A
+    # value of None removes the entry.
+    #   name (str):
+    #       the catalog: 'paths', 'expiration', 'sizes' or 'validators'.
+    def set(self, name, category, id, value):
+        self.set_many([(name, category, id, value)])
+
+    # Sets many entries with one append to the journal.
+    #   records (list):
+    #       (name, category, id, value) for each entry, as for set().
+    def set_many(self, records):
+        records = [(name, category, str(id), value)
+                   for name, category, id, value in records]
+        data = b''.join((json.dumps(record) + '\n').encode()
+                        for record in records)
+        with self.file_lock, self.lock:
+            self.refresh()
+            # Closed at exit, but something is still being written.
+            if self.journal is None:
+                self.open_journal()
+            # No one else is appending, so anything past the last record
+            # replayed was torn by a crash. Cut it off, so new records aren't
+            # appended to it.
+            if fcntl is not None:
+                self.journal.truncate(self.journal_offset)
+            self.journal.write(data)
+            self.journal.flush()
+            self.journal_offset += len(data)
+            for record in records:
+                self.apply(*record)
+            # Compact in the background once the journal gets too big.
+            if (self.journal_offset > self.compact_size and
+                    self.compactor is None):
+                self.compactor = threading.Thread(
+                    target=self.compact_in_background, daemon=True)
+                self.compactor.start()
+
+    # Removes an entry.
+    def remove(self, name, category, id):
+        self.set(name, category, id, None)
+
+    # Returns a list of (category, id, value) for every entry in a catalog.
+    def items(self, name):
+        with self.lock:
+            self.refresh()
+            return [(category, id, value)
+                    for category, section in self.entries[name].items()
+                    for id, value in section.items()]
+
+    # Writes new snapshots and starts an empty journal. Appends from every
+    # process wait until it's done, but lookups in this one don't, since the
+    # snapshots are written without holding the lock.
+    def compact(self):
+        with self.file_lock:
+            with self.lock:
+                self.refresh()
+                # Another process compacted first.
+                if not self.journal_offset:
+                    return
+                entries = {name: {category: dict(section)
+                                  for category, section in catalog.items()
+                                  if section}
+                           for name, catalog in self.entries.items()}
+            # Write the snapshots with write_file(), so a crash never leaves
+            # a half-written snapshot.
+            for name in self.names:
+                parser = configparser.ConfigParser(interpolation=None)
+                parser.read_dict(entries[name])
+                text = io.StringIO()
+                parser.write(text)
+                write_file(self.file_path(name), text.getvalue().encode())
+            with self.lock:
+                # Nothing can have been appended since, so the new journal
+                # starts empty.
+                write_file(self.journal_path(), b'')
+                self.open_journal()
+                self.journal_offset = 0
+                for name in self.names:
+                    self.mtimes[name] = self.mtime(name)
+
+    # Compacts, then lets the next oversized journal start another compaction.
+    def compact_in_background(self):
+        try:
+            self.compact()
+        finally:
+            self.compactor = None
+
+    # Writes everything to the snapshots.
+    def flush(self):
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        if self.journal_offset:
+            self.compact()
+
+    # Closes the journal.
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+class Lease:
+    """
+    A claim on fetching a resource (see take_lease()). It's an advisory lock
+    (fcntl.flock) on a file in the leases folder, so it's let go if the
+    process holding it dies.
+
+    Whoever takes it releases it, and so does anyone they hand it to with
+    hold(), like a queued write. It's only let go once all of them have,
+    and the file is removed then, so leases don't pile up. A file left by a
+    process that died is removed by whoever takes the lease next.
+
+        Attributes:
+            path (str)
+                The lease file, e.g. leases/pokemon/25.
+            holds (int)
+                How many releases are still to come.
+    """
+
+    def __init__(self, path, file):
+        self.path = path
+        self.file = file
+        self.holds = 1
+        self.lock = threading.Lock()
+
+    # Keeps the lease until one more release().
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            if self.holds or self.file is None:
+                return
+            # Removed while it's still locked, so take_lease() can tell if
+            # it locked a file that's gone.
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class WriteBehind:
+    """
+    A queue of resources waiting to be written to the cache by a pool of
+    background threads, so write_cache() can return straight away.
+
+    Writes are keyed by (category, id). Writing a resource that's already
+    queued replaces the queued copy instead of adding a second write, and
+    read_cache() answers from the queue so nothing is missed in the
+    meantime. flush() waits for the queue to empty. It runs at exit too.
+
+        Attributes:
+            pending (collections.OrderedDict)
+                The queued writes, oldest first, by (category, id). Each is
+                (resource, file name, expiration length, validators, time
+                queued, leases). The leases (see Lease) are released once
+                the resource is written.
+            queue_size (int)
+                The most writes that can be queued. put() waits for room
+                beyond that.
+            workers (list of threading.Thread)
+                The background threads.
+            condition (threading.Condition)
+                Guards the queue and wakes waiting threads.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.pending = collections.OrderedDict()
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.write_time = 0.0
+        self.condition = threading.Condition()
+        self.workers = [threading.Thread(target=self.run, daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        atexit.register(self.flush)
+
+    # Queues a resource to be written. Takes the same arguments as
+    # write_cache().
+    def put(self, resource, category, id, file_name=None,
+            expiration_length=None, validators=None, lease=None):
+        key = (category, str(id))
+        leases = []
+        if lease is not None:
+            lease.hold()
+            leases.append(lease)
+        with self.condition:
+            if key in self.pending:
+                self.coalesced += 1
+                # The replaced write's leases wait for this one instead.
+                leases.extend(self.pending[key][5])
+            else:
+                while len(self.pending) >= self.queue_size:
+                    self.condition.wait()
+            self.pending[key] = (resource, file_name, expiration_length,
+                                 validators, time.perf_counter(), leases)
+            self.condition.notify_all()
+
+    # Returns the queued copy of a resource, or None if it isn't queued.
+    def get(self, category, id):
+        with self.condition:
+            queued = self.pending.get((category, str(id)))
+        return queued[0] if queued else None
+
+    # Writes queued resources, oldest first, until the process ends.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                (key, (resource, file_name, expiration_length, validators,
+                       queued, leases)) = self.pending.popitem(last=False)
+                self.in_flight += 1
+                self.condition.notify_all()
+            started = time.perf_counter()
+            try:
+                store_resource(resource, key[0], key[1], file_name,
+                               expiration_length, validators)
+                failed = False
+            except Exception:
+                failed = True
+            finished = time.perf_counter()
+            for lease in leases:
+                lease.release()
+            with self.condition:
+                self.in_flight -= 1
+                if failed:
+                    self.errors += 1
+                else:
+                    self.writes += 1
+                    self.latency += finished - queued
+                    self.write_time += finished - started
+                self.condition.notify_all()
+
+    # Waits for every queued write to finish.
+    def flush(self):
+        with self.condition:
+            while self.pending or self.in_flight:
+                self.condition.wait()
+
+    def stats(self):
+        with self.condition:
+            return {'queue_depth': len(self.pending),
+                    'in_flight': self.in_flight,
+                    'writes': self.writes,
+                    'coalesced': self.coalesced,
+                    'errors': self.errors,
+                    'latency': self.latency / self.writes
+                    if self.writes else None,
+                    'write_time': self.write_time / self.writes
+                    if self.writes else None}
+
+
+class MemoryTier:
+    """
+    Keeps recently used resources decoded in memory, so reading them again
+    is a dictionary lookup instead of a read, decompress and parse.
+
+    Each resource is kept with its expiration date and is dropped once that
+    has passed. Writing or removing a resource through this module replaces
+    or drops the copy here.
+
+        Attributes:
+            entries (dict)
+                (resource, expiration date, size) by (category, id).
+            policy (EvictionPolicy)
+                Chooses which resources to drop when the tier is full.
+            max_entries (int)
+                The most resources to keep.
+            max_size (float)
+                The most bytes to keep, counting each resource as the size
+                of its stored entry.
+            size (int)
+                The bytes kept.
+    """
+
+    def __init__(self, policy, max_entries, max_size=float('inf')):
+        self.entries = {}
+        self.policy = policy
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Returns a resource, or None if it isn't kept or has expired.
+    def get(self, category, id):
+        entry = self.get_entry(category, id)
+        return entry[0] if entry else None
+
+    # Returns (resource, expiration date) for a resource, or None if it
+    # isn't kept or expired over max_stale seconds ago.
+    def get_entry(self, category, id, max_stale=0):
+        key = (category, str(id))
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and entry[1] is not None and
+                    time.time() > entry[1] + max_stale):
+                self.discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.policy.touch(key)
+            return entry[:2]
+
+    # Keeps a resource, dropping others if the tier is full.
+    #   expiration (int):
+    #       when the resource expires in epoch seconds, or None if it
+    #       doesn't.
+    #   size (int):
+    #       the size of the stored entry in bytes.
+    def put(self, category, id, resource, expiration, size):
+        key = (category, str(id))
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (resource, expiration, size)
+            self.size += size
+            self.policy.add(key, size)
+            if (len(self.entries) <= self.max_entries and
+                    self.size <= self.max_size):
+                return
+            victims = self.policy.victims()
+            while (len(self.entries) > self.max_entries or
+                   self.size > self.max_size):
+                victim = next(victims, None)
+                if victim is None:
+                    break
+                self.discard(victim)
+
+    # Changes the expiration date of a resource, if it's kept.
+    def set_expiration(self, category, id, expiration):
+        key = (category, str(id))
+        with self.lock:
+            if key in self.entries:
+                resource, old, size = self.entries[key]
+                self.entries[key] = (resource, expiration, size)
+
+    def remove(self, category, id):
+        with self.lock:
+            self.discard((category, str(id)))
+
+    # Drops a resource. The lock must be held.
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+            self.policy.remove(key)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class Bundle:
+    """
+    A frozen, read-only copy of the cache in one file, made by freeze().
+
+    Reading a bundle involves no catalogs, expiration dates or config file:
+    the file is memory mapped, and resources are found with a binary search
+    of its sorted index. Every resource in a bundle is current for as long
+    as the bundle is deployed.
+
+    The file starts with a header giving the format version, the number of
+    entries, where the index starts, when the bundle was made and a label.
+    The entries follow, each one its key ('category/id') and then the bytes
+    the cache stored for it. The index is a fixed-size record for each entry
+    giving a hash of its key and its offset and length, sorted by hash.
+
+    A new bundle is deployed by replacing the file in one step (freeze()
+    does this). A Bundle notices the new file within check_interval seconds
+    and switches to it.
+
+        Attributes:
+            path (str)
+                The bundle file.
+            label (str)
+                The label given to freeze(), e.g. a version number.
+            created (int)
+                When the bundle was made, in epoch seconds.
+            count (int)
+                The number of resources in the bundle.
+            memory (MemoryTier)
+                The resources decoded recently.
+            check_interval (float)
+                How often, in seconds, to check whether the file has been
+                replaced, or None to never check, as with
+                config_check_interval.
+    """
+
+    magic = b'PKCBNDL'
+    version = 1
+    header = struct.Struct('>7sBIQQH')
+    record = struct.Struct('>QQI')
+    key_length = struct.Struct('>H')
+
+    def __init__(self, path, memory_entries=universal.default_memory_entries,
+                 check_interval=None):
+        self.path = path
+        self.memory = MemoryTier(LRUPolicy(), memory_entries,
+                                 universal.default_memory_size)
+        self.check_interval = (config_check_interval if check_interval is None
+                               else check_interval)
+        self.lock = threading.Lock()
+        self.open()
+
+    # Maps the file and reads its header.
+    def open(self):
+        with open(self.path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset, created, label_length = \
+            self.header.unpack_from(map)
+        if magic != self.magic or version != self.version:
+            raise ValueError('{} is not a version {} bundle.'.format(
+                self.path, self.version))
+        # Read together, so a reader never mixes two files.
+        self.view = (map, count, index_offset)
+        self.count = count
+        self.created = created
+        self.label = map[self.header.size:
+                         self.header.size + label_length].decode()
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+        self.checked = time.monotonic()
+        self.memory.clear()
+
+    # Switches to a new file if the bundle has been replaced.
+    def refresh(self):
+        now = time.monotonic()
+        if (self.check_interval is None or
+                now - self.checked < self.check_interval):
+            return
+        with self.lock:
+            self.checked = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if (stat.st_ino, stat.st_mtime_ns) != self.file_id:
+                self.open()
+
+    # Returns a hash of a key, for the index.
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(),
+                              'big')
+
+    # Returns the bytes stored for a resource, or None if it isn't in the
+    # bundle.
+    def read(self, category, id):
+        self.refresh()
+        key = '{}/{}'.format(category, id).encode()
+        target = self.hash(key)
+        map, count, index_offset = self.view
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record.unpack_from(
+                    map, index_offset + middle * self.record.size)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        # Keys whose hashes collide sit next to each other.
+        for position in range(low, count):
+            hash, offset, length = self.record.unpack_from(
+                map, index_offset + position * self.record.size)
+            if hash != target:
+                break
+            key_length, = self.key_length.unpack_from(map, offset)
+            start = offset + self.key_length.size
+            if map[start:start + key_length] == key:
+                start += key_length
+                return memoryview(map)[start:start + length]
+        return None
+
+    # Returns a resource, or None if it isn't in the bundle.
+    def get(self, category, id):
+        self.refresh()
+        resource = self.memory.get(category, id)
+        if resource is not None:
+            return resource
+        data = self.read(category, id)
+        if data is None:
+            return None
+        resource = decode(data, category)
+        if resource is not None:
+            self.memory.put(category, id, resource, None, len(data))
+        return resource
+
+
+# Reads a resource from the cache
 #   category (str):
 #       the category (name of resource class) the resource belongs to.
 #   id (integer):
 #       the id of the cached resource.
 #   file_name (str)
 #       the file name for the file to read.
+#   immutable=None (bool)
+#       if True, the expiration date isn't checked. If None, whether the
+#       category is set as immutable in the config file.
 # Either category and id or file_name must be provided
 # Returns either the contents of the cache file (usually a list of a
 # resource type with one member) or, if the file can't be read, doesn't
 # exist, or is expired, None.
-def read_cache(category, id, file_name=None):
-    # If the file is expired, remove it and return None
-    if check_expiration(category, id):
-        os.remove(file_name)
+def read_cache(category, id, file_name=None, immutable=None):
+    resource, expiration = read_entry(category, id, file_name, immutable)
+    if expiration is not None and time.time() > expiration:
         return None
-    # Get the file name if not provided
-    if not file_name:
-        file_name = get_file_path(category, id)
-    # if our cache setting is to compress, assume the file is compressed
-    if get_compression():
-        try:
-            with gzip.open(file_name, mode='rb') as file:
-                cached = yaml.load(file.read(), Loader=YAMLLoader)
-        except FileNotFoundError:
-            return None
-        # The file isn't compressed or is corrupted
-        except OSError:
-            try:
-                with open(file_name, mode='r+') as file:
-                    cached = yaml.load(file, Loader=YAMLLoader)
-            except yaml.reader.ReaderError:
-                return None
-    # Our cache setting is to not compress, so assume the file isn't compressed
-    else:
-        try:
-            with open(file_name, mode='r+') as file:
-                cached = yaml.load(file, Loader=YAMLLoader)
-        except FileNotFoundError:
-            return None
-        # The file is either compressed (hopefully) or is corrupted
-        except yaml.reader.ReaderError:
-            try:
-                with gzip.open(file_name, mode='rb') as file:
-                    cached = yaml.load(file.read(), Loader=YAMLLoader)
-            except yaml.reader.ReaderError:
-                return None
-    return cached
+    return resource
+
+
+# Reads a resource from the cache along with its expiration date in epoch
+# seconds, even if it has expired, as long as it expired no longer ago than
+# max_stale. Resources that expired before that are removed. Takes the same
+# arguments as read_cache(), and
+#   max_stale=None (datetime.timedelta)
+#       how long ago the resource can have expired. If None, as long as
+#       stale data can be served (see get_max_stale()).
+# Returns (resource, expiration date), or (None, None) if the resource isn't
+# cached. The expiration date is None for resources that don't expire.
+def read_entry(category, id, file_name=None, immutable=None, max_stale=None):
+    started = time.perf_counter()
+    resource, expiration, outcome = find_entry(category, id, file_name,
+                                               immutable, max_stale)
+    if resource is None:
+        outcome = outcome if outcome in ('expired', 'corrupt') else 'miss'
+    elif expiration is not None and time.time() > expiration:
+        outcome = 'stale'
+    cache_reads.increment(category, outcome)
+    cache_read_seconds.observe(time.perf_counter() - started, category,
+                               outcome)
+    return resource, expiration
+
+
+# Does the work of read_entry(). Returns (resource, expiration date, where
+# it was found for the metrics: 'memory', 'hit', 'expired' or 'miss').
+def find_entry(category, id, file_name, immutable, max_stale):
+    # A resource waiting to be written is the newest copy.
+    if _write_behind is not None:
+        queued = _write_behind.get(category, id)
+        if queued is not None:
+            return queued, None, 'memory'
+    if max_stale is None:
+        max_stale = get_max_stale()
+    max_stale = max_stale.total_seconds()
+    memory = get_memory_tier()
+    if memory is not None:
+        entry = memory.get_entry(category, id, max_stale)
+        # An expired copy may have been fetched again by another process,
+        # so the store is checked for a fresh one.
+        if entry is not None and (entry[1] is None or
+                                  time.time() <= entry[1]):
+            return entry + ('memory',)
+    store = get_store()
+    if immutable is None:
+        immutable = is_immutable(category)
+    # If the resource is too stale to use, remove it and return None
+    expiration = None if immutable else store.get_expiration(category, id)
+    if expiration is not None and time.time() > expiration + max_stale:
+        store.remove(category, id, file_name)
+        return None, None, 'expired'
+    data = store.read(category, id, file_name)
+    if data is None:
+        return None, None, 'miss'
+    if len(data) == len(missing_entry) and bytes(data) == missing_entry:
+        return None, None, 'miss'
+    resource = decode(data, category)
+    # It can't be read, so it's set aside and fetched again.
+    if resource is None:
+        quarantine(category, id, data, file_name)
+        return None, None, 'corrupt'
+    if memory is not None:
+        memory.put(category, id, resource, expiration, len(data))
+    return resource, expiration, 'hit'
 
 
 # Writes a resource to its cache file
@@ -178,71 +3322,312 @@ def read_cache(category, id, file_name=None):
 #       The resource that is to be cached.
 #   file_name
 #       Where in the cache folder to put the resource.
+#   expiration_length=None (datetime.timedelta)
+#       How long until the resource expires, or never. If None, the length
+#       set for the category (see get_expiration_length()).
+#   validators=None (dict)
+#       The 'etag' and 'last_modified' Pokeapi sent with the resource, for
+#       checking later whether it has changed (see get_validators()).
+#   lease=None (Lease)
+#       the lease taken to fetch the resource (see take_lease()). If it's
+#       written in the background, the lease is held until then too, so
+#       whoever waits on it finds the new copy.
 # Either category and id or file_name must be provided. Category and id only
 # work if the file already exists and is being rewritten
-def write_cache(resource, category=None, id=None, file_name=None):
-    if not file_name:
-        file_name = get_file_path(category, id)
-    # TODO: Make this threaded
-    cached = yaml.dump_all([resource], Dumper=YAMLDumper)
-    # If using compression, write the file with gzip
-    if get_compression():
-        with gzip.open(file_name, mode='wb', compresslevel=6) as file:
-            file.write(cached.encode())
-    # Not using compression, so write normally
-    else:
-        with open(file_name, mode='w+') as file:
-            print(cached, file=file)
+def write_cache(resource, category=None, id=None, file_name=None,
+                expiration_length=None, validators=None, lease=None):
     # Get the category and id if not provided
     if not (category and id):
         category = resource.Meta.name.lower()
         id = resource.id
-    set_expiration(category, id)
-    # If we've gone over the maximum size, clean the cache to reduce it.
-    if get_size() > get_max_size():
-        clean()
+    # If writing in the background, hand the resource to a worker thread.
+    write_behind = get_write_behind()
+    if write_behind is not None:
+        write_behind.put(resource, category, id, file_name,
+                         expiration_length, validators, lease)
+        cache_writes.increment(category, 'queued')
+    else:
+        store_resource(resource, category, id, file_name, expiration_length,
+                       validators)
 
-def get_file_path(category, id):
-    # If the path catalog doesn't exist, nothing has a path
-    if not os.path.isfile(os.path.join(get_cache_dir(), 'paths.cnf')):
+
+# Encodes a resource and stores it, evicting other resources if that takes
+# the cache over its maximum size. Takes the same arguments as write_cache(),
+# but category and id are required.
+def store_resource(resource, category, id, file_name=None,
+                   expiration_length=None, validators=None):
+    started = time.perf_counter()
+    try:
+        cached = encode(resource, category)
+        expiration = expiration_date(category, expiration_length)
+        store = get_store()
+        store.write(category, id, cached, expiration, file_name, validators)
+    except Exception:
+        cache_writes.increment(category, 'error')
+        raise
+    cache_writes.increment(category, 'written')
+    cache_write_seconds.observe(time.perf_counter() - started, category)
+    memory = get_memory_tier()
+    if memory is not None:
+        memory.put(category, id, resource, expiration, len(cached))
+    # If we've gone over the maximum size, evict resources to reduce it.
+    # There's nothing to check if the cache can grow without limit.
+    max_size = get_max_size()
+    if max_size != float('inf') and store.get_size() > max_size:
+        store.evict(max_size)
+
+
+# Returns the expiration date, in epoch seconds, of a resource written now,
+# or None if it never expires.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   expiration_length=None (datetime.timedelta):
+#       how long until the resource expires. If None, the length set for the
+#       category.
+def expiration_date(category, expiration_length=None):
+    if expiration_length is None:
+        expiration_length = get_expiration_length(category)
+    if expiration_length == never:
         return None
-    # Read the catalog
-    parser = configparser.ConfigParser()
-    parser.read(os.path.join(get_cache_dir(), 'paths.cnf'))
-    if category in parser.sections():
-        # Check that the file exists in the path catalog.
-        if str(id) in parser[category]:
-            # Parse the date from a string.
-            path = parser[category][str(id)]
-            # check that the file actually exists at that path
-            if os.path.isfile(path):
-                return path
-            else:
-                return None
+    return to_epoch(datetime.now() + expiration_length)
+
+
+# Pushes back the expiration date of a cached resource that Pokeapi says
+# hasn't changed, without rewriting it.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the cached resource.
+#   expiration_length=None (datetime.timedelta):
+#       how long from now until the resource expires. If None, the length
+#       set for the category.
+def extend_expiration(category, id, expiration_length=None):
+    expiration = expiration_date(category, expiration_length)
+    get_store().set_expiration(category, id, expiration)
+    if _memory_tier is not None:
+        _memory_tier.set_expiration(category, id, expiration)
+
+
+# Moves an entry that can't be read out of the store and into the quarantine
+# folder, where it can be looked at later. Only the latest bad entry of each
+# resource is kept.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the cached resource.
+#   data (bytes):
+#       the entry.
+#   file_name=None (str):
+#       where the store keeps the entry, if it keeps it in a file.
+def quarantine(category, id, data, file_name=None):
+    path = os.path.join(get_cache_dir(), quarantine_folder, category,
+                        str(id))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, data)
+    # Keeping a copy is only a courtesy.
+    except OSError:
+        pass
+    get_store().remove(category, id, file_name)
+
+
+# Tries to take the lease on fetching a resource, so that other processes
+# and threads missing it at the same time can wait for the fetch (see
+# wait_for_lease()) instead of all calling Pokeapi and writing the same
+# entry. Without fcntl, every caller gets a lease and nothing waits.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the resource.
+# Returns a Lease, or None if someone else holds it.
+def take_lease(category, id):
+    path = lease_path(category, id)
+    if fcntl is None:
+        return Lease(path, None)
+    while True:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, 'ab')
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        # If the last holder removed the file after it was opened, the lock
+        # is on a file no one else can find, so start again.
+        try:
+            if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                return Lease(path, file)
+        except FileNotFoundError:
+            pass
+        file.close()
+
+
+# Returns the path of the file a resource's lease is held on.
+def lease_path(category, id):
+    return os.path.join(get_cache_dir(), lease_folder, category, str(id))
+
+
+# Waits until no one holds the lease on fetching a resource. Takes the same
+# arguments as take_lease(), and
+#   timeout (float):
+#       the most seconds to wait.
+# Returns whether the lease was let go in time.
+def wait_for_lease(category, id, timeout):
+    if fcntl is None:
+        return True
+    path = lease_path(category, id)
+    deadline = time.monotonic() + timeout
+    try:
+        file = open(path, 'rb')
+    # It's never been taken.
+    except FileNotFoundError:
+        return True
+    with file:
+        while True:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(lease_poll_interval)
+
+
+# Returns whether a resource is cached and hasn't expired.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the cached resource.
+def is_fresh(category, id):
+    store = get_store()
+    expiration = store.get_expiration(category, id)
+    if expiration is not None:
+        return time.time() <= expiration
+    # Without an expiration date, it either never expires or isn't cached.
+    return store.read(category, id) is not None
+
+
+# Records that Pokeapi has no resource with an id or name, so asking again
+# can fail without a request until the negative entry expires. Reading the
+# resource from the cache finds nothing, as before.
+#   category (str):
+#       the category (name of resource class) looked in.
+#   id (integer or str):
+#       the id or name that wasn't found.
+#   expiration_length=None (datetime.timedelta):
+#       how long until the entry expires. If None, the length set for
+#       negative entries (see get_missing_expiration_length()).
+def write_missing(category, id, expiration_length=None):
+    if expiration_length is None:
+        expiration_length = get_missing_expiration_length()
+    expiration = expiration_date(category, expiration_length)
+    store = get_store()
+    store.write(category, id, missing_entry, expiration)
+    # The memory tier holds None, which reads as nothing cached.
+    memory = get_memory_tier()
+    if memory is not None:
+        memory.put(category, id, None, expiration, len(missing_entry))
+
+
+# Returns whether there's an unexpired negative entry for a resource (see
+# write_missing()).
+#   category (str):
+#       the category (name of resource class) looked in.
+#   id (integer or str):
+#       the id or name.
+def is_missing(category, id):
+    memory = get_memory_tier()
+    if memory is not None:
+        entry = memory.get_entry(category, id)
+        if entry is not None:
+            return entry[0] is None
+    store = get_store()
+    expiration = store.get_expiration(category, id)
+    if expiration is not None and time.time() > expiration:
+        return False
+    data = store.read(category, id)
+    if data is None or bytes(data) != missing_entry:
+        return False
+    if memory is not None:
+        memory.put(category, id, None, expiration, len(missing_entry))
+    return True
+
+
+# Returns the validators stored with a cached resource: a dictionary with
+# the 'etag' and 'last_modified' Pokeapi sent, either of which may be None.
+# Returns None if the resource has no validators.
+def get_validators(category, id):
+    return get_store().get_validators(category, id)
+
+
+# Returns where the directory store keeps a resource: in its category's
+# cache folder (see register_category()), or a folder named after the
+# category if it has none. The shard_levels setting spreads each category
+# over that many levels of folders, named after pairs of hex digits from a
+# hash of the id, so no folder holds too many files. With
+#   [cache]
+#   shard_levels = 2
+# Pokemon 25 is kept in pokemon/pokemon/8e/29/25. Resources written under
+# another layout are moved the next time they're read (see migrate_layout()).
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer or str):
+#       the id or name of the resource.
+def resource_path(category, id):
+    settings = get_settings()
+    folder = os.path.join(settings.path,
+                          category_folders.get(category, category))
+    id = str(id)
+    if settings.shard_levels:
+        digest = hashlib.md5(id.encode()).hexdigest()
+        folder = os.path.join(folder, *(digest[level * 2:level * 2 + 2]
+                                        for level in
+                                        range(settings.shard_levels)))
+    return os.path.join(folder, id)
+
+
+# Moves cached resources into the layout the settings call for (see
+# resource_path()), so a cache can change layout without losing anything.
+# Returns how many were moved.
+#   max_time=None (float):
+#       the most seconds to spend. The rest are moved on the next call, or as
+#       they're read.
+def migrate_layout(max_time=None):
+    return get_store().relayout(max_time)
+
+
+# Returns the path of a cached resource from the paths catalog, or None if
+# it isn't catalogued or the file doesn't exist.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the cached resource.
+def get_file_path(category, id):
+    path = get_catalog().get('paths', category, id)
+    # check that the file actually exists at that path
+    if path and os.path.isfile(path):
+        return path
     return None
 
 
+# Sets the path of a cached resource in the paths catalog.
+#   category (str):
+#       the category (name of resource class) the resource belongs to.
+#   id (integer):
+#       the id of the cached resource.
+#   path (str):
+#       the path to the file, either absolute or relative to the cache
+#       directory.
 def set_file_path(category, id, path):
     cache_dir = get_cache_dir()
-    # Make the path catalog if it doesn't exist
-    if not os.path.isfile(os.path.join(get_cache_dir(), 'paths.cnf')):
-        open(os.path.join(cache_dir, 'paths.cnf'), 'a').close()
-    # Load the expiration catalog
-    parser = configparser.ConfigParser()
-    file_path = os.path.join(cache_dir, 'paths.cnf')
-    parser.read(file_path)
     # If the path doesn't include the cache directory, add it on
     if not cache_dir in path:
         path = os.path.join(cache_dir, path)
     # Check that the file actually exists
     if not os.path.isfile(path):
         raise AttributeError('File {} cannot be found.'.format(path))
-    # Set the path in the catalog
-    if category not in parser:
-        parser[category] = {}
-    parser[category][str(id)] = path
-    with open(file_path, 'w+') as expir_file:
-        parser.write(expir_file)
+    get_catalog().set('paths', category, id, path)
 
 
 # Set the expiration date for a cached resource.
@@ -250,24 +3635,15 @@ def set_file_path(category, id, path):
 #       the category (name of resource class) the resource belongs to.
 #   id (integer):
 #       the id of the cached resource.
-def set_expiration(category, id):
-    # Make the expiration catalog if it doesn't exist
-    if not os.path.isfile(os.path.join(get_cache_dir(), 'expiration.cnf')):
-        open(os.path.join(get_cache_dir(), 'expiration.cnf'), 'a').close()
-    # Load the expiration catalog
-    parser = configparser.ConfigParser()
-    file_path = os.path.join(get_cache_dir(), 'expiration.cnf')
-    parser.read(file_path)
+#   date=None (datetime or int):
+#       the expiration date, as a datetime or epoch seconds. If None, it will
+#       be a fixed distance into the future.
+def set_expiration(category, id, date=None):
     # The expiration date is a fixed distance into the future.
-    date = datetime.now() + get_expiration_length()
-    # Set the date in the catalog
-    if category not in parser:
-        parser[category] = {}
-    # Turn the expiration date into a string and put it in the expiration
-    # catalog.
-    parser[category][str(id)] = datetime.isoformat(date, sep=':')
-    with open(file_path, 'w+') as expir_file:
-        parser.write(expir_file)
+    if not date:
+        length = get_expiration_length(category)
+        date = None if length == never else datetime.now() + length
+    get_catalog().set('expiration', category, id, to_epoch(date))
 
 
 # Finds whether cached resource is expired
@@ -276,98 +3652,131 @@ def set_expiration(category, id):
 #   id (integer):
 #       the id of the cached resource.
 def check_expiration(category, id):
-    expiration = get_expiration(category, id)
+    expiration = get_store().get_expiration(category, id)
     # If the expiration has been set and the expiration date is in teh past,
     # return True
-    if expiration:
-        if datetime.now() > expiration:
+    if expiration is not None:
+        if time.time() > expiration:
             return True
     return False
 
 
+# Returns the expiration date of a resource from the expiration catalog, in
+# epoch seconds, or None if it has none.
 def get_expiration(category, id):
-    # If the expiration catalog doesn't exist, nothing can be expired
-    if not os.path.isfile(os.path.join(get_cache_dir(), 'expiration.cnf')):
-        return None
-    # Read the cataloo
-    parser = configparser.ConfigParser()
-    parser.read(os.path.join(get_cache_dir(), 'expiration.cnf'))
-    if category in parser.sections():
-        # The resource has to be in the catalog to be expired.
-        if str(id) in parser[category]:
-            # Parse the date from a string.
-            expir_date = parser[category][str(id)]
-            expir_date = datetime.strptime(expir_date,
-                                           '%Y-%m-%d:%H:%M:%S.%f')
-            return expir_date
-    return None
+    return get_catalog().get('expiration', category, id)
 
 
+# Returns the size of a cached resource in bytes from the sizes catalog.
 def get_file_size(category, id):
-    return os.stat(get_file_path(category, id)).st_size
-
-
-def clean():
-    # First, collect all files while removing expired ones
-    all_files = []
-    paths_parser = configparser.ConfigParser()
-    paths_parser.read(os.path.join(get_cache_dir(), 'paths.cnf'))
-    # Loop through each file stored in the paths category
-    for category in paths_parser.sections():
-        for id in paths_parser[category]:
-            path = paths_parser[category][str(id)]
-            # If the file actually exists, add it to the list of files to
-            # manage
-            if os.path.exists(path):
-                # The file is expired, so remove it
-                if check_expiration(category, id):
-                    remove_file(category, id, path)
-                else:
-                    size = get_size(category, id)
-                    expiration = get_expiration(category, id)
-                    all_files.append({'category': category,
-                                      'id': id,
-                                      'path': path,
-                                      'size': size,
-                                      'expiration': expiration})
-            # The file doesn't exist, so remove it from the paths catalog
-            else:
-                paths_parser.remove_option(category, id)
-    size = get_size()
-    max_size = get_max_size()
-    # We've gone over our size limit, so remove in order of expiration date
-    # (soonest to latest)
-    if size > max_size:
-        total_removed = 0
-        # Sort by expiration date
-        all_files.sort(key=lambda x: x['expiration'])
-        target_size = size - max_size
-        for file in all_files:
-            remove_file(file['category'], file['id'], file['path'])
-            total_removed += file['size']
-            # We've removed enough files, so no need to continue
-            if total_removed >= target_size:
-                break
-    known_paths = [file['path'] for file in all_files]
-    # Now remove uncatalogued files.
-    # Loop through all files in cache directory.
-    for root, dirs, files in os.walk(get_cache_dir()):
-        for file in files:
-            file_path = os.path.join(root, file)
-            # If the file isn't in the paths catalog we can't find it,
-            # so remove it.
-            if not file_path in known_paths:
-                os.remove(file_path)
-    # Finally, remove expiration entries to non-existent files
-    if os.path.isfile(os.path.join(get_cache_dir(), 'expiration.cnf')):
-        expiration_parser = configparser.ConfigParser()
-        # Loop through expiration entries
-        for category in expiration_parser.sections():
-            if not category in paths_parser.sections():
-                expiration_parser.remove_section(category)
-            for id in expiration_parser[category]:
-                if not id in paths_parser[category]:
-                    expiration_parser.remove_option(category, id)
+    return get_catalog().get('sizes', category, id)
+
+
+# Removes expired resources and, if the cache is over its maximum size, the
+# resources that expire soonest. A directory cache also loses files that
+# aren't in the catalogs and catalog entries for files that don't exist.
+# Expired resources that can still be served stale (see get_max_stale()) are
+# kept.
+#   dry_run=False (bool):
+#       if True, nothing is removed and the report says what would have been.
+#   max_time=None (float):
+#       the most seconds to spend. If cleaning isn't finished in time, the
+#       next call picks up where this one left off, so it can run a little at
+#       a time inside a request loop.
+# Returns a CleanReport.
+def clean(dry_run=False, max_time=None):
+    global _cleaner
+    # A dry run always starts from the beginning.
+    if dry_run:
+        cleaner = get_store().clean(dry_run=True)
+    else:
+        if _cleaner is None:
+            _cleaner = get_store().clean()
+        cleaner = _cleaner
+    deadline = None if max_time is None else time.monotonic() + max_time
+    for report in cleaner:
+        if report.complete:
+            break
+        # Out of time, so stop here and resume next call.
+        if deadline is not None and time.monotonic() >= deadline:
+            return report
+    if not dry_run:
+        _cleaner = None
+    return report
+
+
+# Writes everything in the cache to a bundle file (see Bundle), replacing
+# the file in one step once the bundle is complete, so readers of the old
+# bundle switch straight to the new one. Entries compressed with a trained
+# dictionary are recompressed without it, since the bundle is used where
+# the dictionaries aren't. Returns the number of resources in the bundle.
+#   path (str):
+#       the bundle file.
+#   label='' (str):
+#       a label for the bundle, e.g. a version number.
+#   include_expired=False (bool):
+#       if True, expired resources are frozen too.
+def freeze(path, label='', include_expired=False):
+    flush()
+    store = get_store()
+    now = time.time()
+    label = label.encode()
+    temp_path = temp_file_name(path)
+    try:
+        count = write_bundle(temp_path, store, label, now, include_expired)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+# Does the work of freeze(), writing the bundle to temp_path. Returns the
+# number of resources in it.
+def write_bundle(temp_path, store, label, now, include_expired):
+    records = []
+    with open(temp_path, 'wb') as file:
+        # The header is written last, once the index offset is known.
+        file.write(b'\0' * Bundle.header.size + label)
+        for category, id, size in store.sizes():
+            expiration = store.get_expiration(category, id)
+            if (expiration is not None and now > expiration and
+                    not include_expired and not is_immutable(category)):
+                continue
+            data = store.read(category, id)
+            if data is None:
+                continue
+            data = bytes(data)
+            # A bundle only holds resources.
+            if data == missing_entry:
+                continue
+            # Damaged entries are left out.
+            unpacked = unpack(data)
+            if unpacked is None:
+                continue
+            if entry_dictionary(data):
+                resource = decode(data, category)
+                if resource is None:
+                    continue
+                serializer = get_serializer()
+                data = pack_entry(serializer, codecs['zlib'], 0,
+                                  codecs['zlib'].compress(
+                                      serializer.dumps(resource)))
+            key = '{}/{}'.format(category, id).encode()
+            records.append((Bundle.hash(key), file.tell(), len(data)))
+            file.write(Bundle.key_length.pack(len(key)) + key + data)
+        records.sort()
+        index_offset = file.tell()
+        for record in records:
+            file.write(Bundle.record.pack(*record))
+        file.seek(0)
+        file.write(Bundle.header.pack(Bundle.magic, Bundle.version,
+                                      len(records), index_offset, int(now),
+                                      len(label)))
+    return len(records)
 
 
 # Removes a file and all references to it in the catalogs.
@@ -379,20 +3788,17 @@ def clean():
 #       the path to the file. If None, the path will be determined from the
 #       category and id.
 def remove_file(category, id, path=None):
-    path_parser = configparser.ConfigParser()
-    path_parser.read(os.path.join(get_cache_dir(), 'paths.cnf'))
-    expiration_parser = configparser.ConfigParser()
-    expiration_parser.read(os.path.join(get_cache_dir(), 'expiration.cnf'))
+    if _memory_tier is not None:
+        _memory_tier.remove(category, id)
+    catalog = get_catalog()
     # Get the path from the paths catalog if it wasn't provided
     if not path:
-        path = path_parser[category][str(id)]
-    # Remove the file from the path catalog
-    if category in path_parser.sections():
-        path_parser.remove_option(category, str(id))
-    # Remove the file from the expiration catalog
-    if category in expiration_parser.sections():
-        expiration_parser.remove_option(category, str(id))
+        path = catalog.get('paths', category, id)
+    # Remove the file from the catalogs
+    catalog.remove('paths', category, id)
+    catalog.remove('expiration', category, id)
+    catalog.remove('sizes', category, id)
+    catalog.remove('validators', category, id)
     # Remove the actual file from the cache
-    if os.path.isfile(path):
+    if path and os.path.isfile(path):
         os.remove(path)
-
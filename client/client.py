@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from beckett import clients
-import os
+from beckett.exceptions import InvalidStatusCodeError
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import cache
+import metrics
 from resources import (
     AbilityResource,
     BerryResource,
@@ -109,6 +114,142 @@ class BeckettClient(clients.BaseClient):
             VersionGroupResource
         )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The last response each thread got.
+        self.local = threading.local()
+
+    # Adds conditional request headers when a getter is called with
+    # validators (see cache.get_validators()).
+    def get_http_headers(self, client_name, method_name, validators=None,
+                         **kwargs):
+        headers = super().get_http_headers(client_name, method_name,
+                                           **kwargs)
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    # Remembers the response, so its headers can be cached. A 304 Not
+    # Modified returns None instead of resources.
+    def _handle_response(self, response, valid_status_codes, resource):
+        self.local.response = response
+        if response.status_code == 304:
+            return None
+        return super()._handle_response(response, valid_status_codes,
+                                        resource)
+
+    # Returns the last response this thread got, or None.
+    def last_response(self):
+        return getattr(self.local, 'response', None)
+
+
+class NotFoundError(InvalidStatusCodeError):
+    """
+    Pokeapi has no resource with the id or name asked for. Raised by the
+    PokemonClient getters, either for a 404 response or because an earlier
+    404 is still cached (see cache.write_missing()).
+
+        Attributes:
+            category (str)
+                The category (name of resource class) looked in.
+            uid (int or str)
+                The id or name asked for.
+    """
+
+    def __init__(self, category, uid):
+        super().__init__(404, (200,))
+        self.category = category
+        self.uid = uid
+
+    def __str__(self):
+        return 'No {} with the id or name {!r}'.format(self.category,
+                                                      self.uid)
+
+
+# Returns the validators in a response's headers, for making the request
+# conditional next time, or None if there aren't any.
+def get_validators(headers):
+    validators = {'etag': headers.get('ETag'),
+                  'last_modified': headers.get('Last-Modified')}
+    if any(validators.values()):
+        return validators
+    return None
+
+
+# Returns the max-age in a response's Cache-Control header as a timedelta,
+# or None if there isn't one.
+def get_max_age(headers):
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                return timedelta(seconds=int(value.strip('"')))
+            except ValueError:
+                return None
+    return None
+
+
+# What the client records to metrics.registry (see metrics.py).
+request_count = metrics.registry.counter(
+    'pykachu_requests_total',
+    'PokemonClient getter calls, by category and outcome: hit, stale '
+    '(served expired), expired (fetched again), miss, coalesced (fetched '
+    'by another process), not_found or error.',
+    ('category', 'outcome'))
+request_seconds = metrics.registry.histogram(
+    'pykachu_request_seconds',
+    'Seconds PokemonClient getter calls took, by category and outcome.',
+    ('category', 'outcome'))
+fetch_seconds = metrics.registry.histogram(
+    'pykachu_fetch_seconds',
+    'Seconds requests to Pokeapi took, by category and outcome: ok, '
+    'not_modified, not_found or error.',
+    ('category', 'outcome'))
+
+
+# Records a getter call that started at started (from time.perf_counter()).
+def record_request(category, outcome, started):
+    request_count.increment(category, outcome)
+    request_seconds.observe(time.perf_counter() - started, category, outcome)
+
+
+# The resources being fetched in the background, so each is only fetched
+# once at a time, and the threads fetching them.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_refresher = None
+refresh_workers = 4
+
+
+# Fetches a resource on a background thread, unless it's already being
+# fetched. Failures are ignored, leaving the stale copy in the cache.
+#   key (tuple):
+#       (category, id) of the resource.
+#   fetch (function):
+#       fetches the resource and writes it to the cache.
+def refresh_in_background(key, fetch):
+    global _refresher
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        if _refresher is None:
+            _refresher = ThreadPoolExecutor(refresh_workers)
+
+    def refresh():
+        try:
+            fetch()
+        except Exception:
+            pass
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _refresher.submit(refresh)
+
 
 class PokemonClient():
 
@@ -120,16 +261,83 @@ class PokemonClient():
     #   write_cache (bool):
     #       If true, the client will write any data it retrieves from the api
     #       to the cache. Othrwise it won't.
-    def __init__(self, *args, read_cache=True, write_cache=True, **kwargs):
+    #   settings (cache.Settings):
+    #       The cache settings to use. If None, they're read from the config
+    #       file.
+    #   expiration_lengths (dict):
+    #       How long resources expire after, by resource class or category
+    #       name, overriding the config file. See set_expiration_length().
+    #   bundle (str or cache.Bundle):
+    #       A bundle made by cache.freeze(), or its path. If given, the
+    #       client is read-only: resources come from the bundle, without
+    #       touching the cache or the config file, and anything the bundle
+    #       doesn't have is fetched from Pokeapi but not cached.
+    def __init__(self, *args, read_cache=True, write_cache=True,
+                 settings=None, expiration_lengths=None, bundle=None,
+                 **kwargs):
         self.beckett_client = BeckettClient(*args, **kwargs)
-        self.read = read_cache
-        self.write = write_cache
+        if isinstance(bundle, str):
+            bundle = cache.Bundle(bundle)
+        self.bundle = bundle
+        self.read = read_cache and bundle is None
+        self.write = write_cache and bundle is None
+        self.expiration_lengths = {}
+        self.immutable = set()
+        for resource, length in (expiration_lengths or {}).items():
+            self.set_expiration_length(resource, length)
         if self.read or self.write:
-            cache.set_up()
+            self.settings = cache.set_up(settings)
+        elif bundle is not None:
+            self.settings = settings
+        else:
+            self.settings = settings or cache.get_settings()
         self.set_attributes()
 
+    # Sets how long a resource type stays in the cache for this client,
+    # overriding the config file.
+    #   resource (class or str):
+    #       the resource class or its category name, e.g. TypeResource or
+    #       'type'.
+    #   length (datetime.timedelta, float or str):
+    #       a timedelta, a number of hours, 'never' for resources that don't
+    #       expire, or 'immutable' for resources that don't expire and are
+    #       read without checking.
+    def set_expiration_length(self, resource, length):
+        if not isinstance(resource, str):
+            resource = resource.Meta.name
+        category = resource.lower()
+        self.immutable.discard(category)
+        if length == 'immutable':
+            self.immutable.add(category)
+            length = cache.never
+        elif length == 'never':
+            length = cache.never
+        elif not isinstance(length, timedelta):
+            length = timedelta(hours=length)
+        self.expiration_lengths[category] = length
+
+    # Returns how long a resource fetched from Pokeapi stays fresh: the
+    # length set on the client, or else the one in the config file, or else
+    # the max-age Pokeapi sent. A max-age of 0 stores the resource already
+    # expired, so it's revalidated the next time it's read. Returns None if
+    # none of them is set, for the length set for the whole cache.
+    #   category (str):
+    #       the category (name of resource class).
+    #   headers (dict):
+    #       the headers of Pokeapi's response.
+    def expiration_length(self, category, headers):
+        length = self.expiration_lengths.get(category)
+        if length is None:
+            length = cache.get_category_expiration_length(category)
+        if length is None:
+            length = get_max_age(headers)
+        return length
+
     def set_attributes(self):
         for resource in self.beckett_client.Meta.resources:
+            cache.register_category(resource.Meta.name.lower(),
+                                    resource.Meta.cache_folder,
+                                    resource.__name__)
             method_name = resource.get_method_name(resource, 'GET')
             getter = self.getter_factory(resource, method_name)
             setattr(self, method_name, getter)
@@ -142,10 +350,8 @@ class PokemonClient():
     #       the resource name in lower case or the same as the method for the
     #       resource in the BeckettClient.
     def getter_factory(self, resource, method_name):
-        # Where the cache is located.
-        cache_dir = cache.get_cache_dir()
-        # Where the resource is cached
-        cache_subdir = os.path.join(cache_dir, resource.Meta.cache_folder)
+        if self.bundle is not None:
+            return self.bundle_getter_factory(resource, method_name)
         # The method used to get the resource from Pokeapi
         beckett_method = getattr(self.beckett_client, method_name)
 
@@ -153,38 +359,202 @@ class PokemonClient():
         #   kwargs:
         #       These are the same as for the normal Beckett client.
         def get(**kwargs):
+            started = time.perf_counter()
+            category = resource.Meta.name.lower()
+            outcome = 'error'
+            try:
+                result, outcome = lookup(**kwargs)
+                return result
+            except NotFoundError:
+                outcome = 'not_found'
+                raise
+            finally:
+                record_request(category, outcome, started)
+
+        # Does the work of get(). Returns (resource, outcome for the
+        # metrics).
+        def lookup(**kwargs):
             # We need the id number, but uid can also be a name for some
             # resources.
             resource_id = self.identifier(uid=kwargs['uid'])
-            # Only bother with the cache if the client is set up to read or
-            # write to it.
-            if self.read or self.write:
-                # Make the cache directory if it doesn't exist
-                if not os.path.isdir(cache_subdir):
-                    os.makedirs(cache_subdir)
-                # This is the file that will be read or written to.
-                file_name = os.path.join(cache_subdir, str(resource_id))
-            # We can'read unless the file actually exists
-            if self.read and os.path.isfile(file_name):
-                read_result = cache.read_cache(
-                    category=resource.Meta.name.lower(),
-                    id=resource_id, file_name=file_name)
+            category = resource.Meta.name.lower()
+            # This is the file that will be read or written to if the cache
+            # keeps one file per resource.
+            file_name = cache.resource_path(category, resource_id)
+
+            # Calls Pokeapi and writes the result to the cache. If there's
+            # a cached copy, the request asks Pokeapi to only send the
+            # resource if it's changed. If it hasn't, the cached copy is
+            # kept for another expiration length and returned.
+            #   cached=None (list):
+            #       the expired resource from the cache.
+            #   lease=None (cache.Lease):
+            #       the lease taken to fetch it, held until it's written.
+            def fetch(cached=None, lease=None):
+                validators = None
+                if cached and self.write:
+                    validators = cache.get_validators(category, resource_id)
+                started = time.perf_counter()
+                outcome = 'error'
+                try:
+                    if validators:
+                        beckett_result = beckett_method(
+                            validators=validators, **kwargs)
+                    else:
+                        beckett_result = beckett_method(**kwargs)
+                    outcome = 'ok' if beckett_result is not None else \
+                        'not_modified'
+                except InvalidStatusCodeError as error:
+                    if error.status_code == 404:
+                        outcome = 'not_found'
+                    raise
+                finally:
+                    fetch_seconds.observe(time.perf_counter() - started,
+                                          category, outcome)
+                response = self.beckett_client.last_response()
+                headers = response.headers if response is not None else {}
+                expiration_length = self.expiration_length(category, headers)
+                if beckett_result is None and validators:
+                    cache.extend_expiration(category, resource_id,
+                                            expiration_length)
+                    return cached
+                if self.write:
+                    cache.write_cache(
+                        beckett_result, category=category, id=resource_id,
+                        file_name=file_name,
+                        expiration_length=expiration_length,
+                        validators=get_validators(headers), lease=lease)
+                return beckett_result
+
+            # Reads the resource from the cache. Categories immutable for
+            # this client skip the expiration check. The rest leave it to
+            # the config file. An expired copy is worth having if it can be
+            # revalidated.
+            def read():
+                return cache.read_entry(
+                    category=category, id=resource_id, file_name=file_name,
+                    immutable=category in self.immutable or None,
+                    max_stale=cache.never if self.write else None)
+
+            # Takes the lease on fetching the resource. If another process
+            # or thread holds it, waits for them to let it go and reads what
+            # they wrote, trying again if they failed.
+            # Returns (lease, None) to fetch the resource with the lease,
+            # (None, resource) if someone else fetched it, or (None, None)
+            # to fetch it without the lease after waiting too long.
+            def coalesce():
+                deadline = time.monotonic() + cache.get_coalesce_timeout()
+                while True:
+                    lease = cache.take_lease(category, resource_id)
+                    if lease is not None:
+                        return lease, None
+                    if not cache.wait_for_lease(category, resource_id,
+                                                deadline - time.monotonic()):
+                        return None, None
+                    read_result, expiration = read()
+                    if read_result and (expiration is None or
+                                        time.time() <= expiration):
+                        return None, read_result
+                    if not read_result and cache.is_missing(category,
+                                                            resource_id):
+                        raise NotFoundError(category, kwargs['uid'])
+
+            # Fetches an expired resource in the background, unless another
+            # process or thread is already fetching it.
+            def refresh(cached):
+                lease = None
+                if coalescing:
+                    lease = cache.take_lease(category, resource_id)
+                    if lease is None:
+                        return
+                try:
+                    fetch(cached, lease)
+                finally:
+                    if lease is not None:
+                        lease.release()
+
+            # Only one process fetches a resource at a time, if the others
+            # can read what it wrote.
+            coalescing = (self.read and self.write and
+                          cache.get_coalesce_timeout() > 0)
+            # The cache knows whether it holds the resource, so just ask it.
+            cached = stale_result = None
+            if self.read:
+                read_result, expiration = read()
                 if read_result:
-                    return read_result
-            # There's nothing from the cache, so call Pokeapi
-            beckett_result = beckett_method(**kwargs)
-            # Write to the cache.
-            if self.write:
-                cache.write_cache(beckett_result,
-                                  category=resource.Meta.name.lower(),
-                                  id=resource_id,
-                                  file_name=file_name)
-            return beckett_result
+                    if expiration is None or time.time() <= expiration:
+                        return read_result, 'hit'
+                    cached = read_result
+                    # It's expired, but recently enough to serve while a
+                    # fresh copy is fetched, or if fetching fails.
+                    stale_for = timedelta(seconds=time.time() - expiration)
+                    if stale_for <= cache.get_max_stale():
+                        if cache.get_stale_while_revalidate() and self.write:
+                            refresh_in_background(
+                                (category, str(resource_id)),
+                                lambda: refresh(cached))
+                            return cached, 'stale'
+                        stale_result = cached
+                # Pokeapi said recently that it doesn't exist.
+                elif cache.is_missing(category, resource_id):
+                    raise NotFoundError(category, kwargs['uid'])
+            # There's nothing fresh in the cache, so call Pokeapi, unless
+            # someone else already is.
+            lease = None
+            if coalescing:
+                lease, result = coalesce()
+                if result is not None:
+                    return result, 'coalesced'
+            try:
+                return fetch(cached, lease), 'expired' if cached else 'miss'
+            except Exception as error:
+                # It's gone, so it isn't served stale either.
+                if (isinstance(error, InvalidStatusCodeError) and
+                        error.status_code == 404):
+                    if self.write:
+                        cache.write_missing(category, resource_id)
+                    raise NotFoundError(category, kwargs['uid']) from error
+                if stale_result and cache.get_stale_if_error():
+                    return stale_result, 'stale'
+                raise
+            finally:
+                if lease is not None:
+                    lease.release()
 
         get.__doc__ = resource.attr_docs[resource.Meta.name.lower()]
 
         return get
 
+    # Creates a getter for a resource that reads from the bundle. Takes the
+    # same arguments as getter_factory().
+    def bundle_getter_factory(self, resource, method_name):
+        beckett_method = getattr(self.beckett_client, method_name)
+        category = resource.Meta.name.lower()
+
+        def get(**kwargs):
+            started = time.perf_counter()
+            result = self.bundle.get(category,
+                                     self.identifier(uid=kwargs['uid']))
+            if result is not None:
+                record_request(category, 'hit', started)
+                return result
+            outcome = 'error'
+            try:
+                result = beckett_method(**kwargs)
+                outcome = 'miss'
+                return result
+            except InvalidStatusCodeError as error:
+                if error.status_code == 404:
+                    outcome = 'not_found'
+                    raise NotFoundError(category, kwargs['uid']) from error
+                raise
+            finally:
+                record_request(category, outcome, started)
+
+        get.__doc__ = resource.attr_docs[category]
+
+        return get
+
     def identifier(self, resource=None, uid=None):
         # TODO: find identifier for unspecified
         if uid:
@@ -0,0 +1,228 @@
+# /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fills the cache from an offline copy of Pokeapi's static JSON data, laid
+# out as api/v2/<resource>/<id>/index.json, without touching the network.
+# Run it with
+#   python importer.py [--processes N] [--expiration-length HOURS|never]
+#                      DUMP [resource ...]
+# where DUMP is the folder holding api/v2 (or api/v2 itself) and each
+# resource is a category name ('pokemon', 'egg group') or a resource class
+# name ('PokemonResource'). With none, every resource type is imported.
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import client
+import cache
+from warmer import find_resources, print_progress
+
+
+class ImportReport:
+    """
+    What import_dump() did.
+
+        Attributes:
+            imported (list)
+                (category, id) of the resources written to the cache.
+            failed (list)
+                (category, id) of the resources whose files couldn't be read
+                or built into resources.
+            missing (list)
+                The categories with no folder in the dump.
+    """
+
+    def __init__(self):
+        self.imported = []
+        self.failed = []
+        self.missing = []
+
+
+# Returns the folder holding a folder for each resource type: api/v2 inside
+# root, or root itself if it has no api/v2.
+def find_dump_dir(root):
+    dump_dir = os.path.join(root, 'api', 'v2')
+    return dump_dir if os.path.isdir(dump_dir) else root
+
+
+# Returns the ids in a resource type's folder of the dump, in order. Folders
+# that aren't ids, like the list at the top of the folder, are left out.
+def list_ids(folder):
+    return sorted(int(name) for name in os.listdir(folder)
+                  if name.isdigit() and
+                  os.path.isfile(os.path.join(folder, name, 'index.json')))
+
+
+# Sets up a worker process to encode resources as the parent would.
+def start_worker(settings):
+    cache.configure(settings)
+    for resource in client.BeckettClient.Meta.resources:
+        cache.register_category(resource.Meta.name.lower(),
+                                resource.Meta.cache_folder,
+                                resource.__name__)
+
+
+# Builds resources from their files in the dump and encodes them for the
+# cache. Runs in a worker process.
+#   resource (class):
+#       the resource class.
+#   folder (str):
+#       the resource type's folder in the dump.
+#   ids (list):
+#       the ids of the resources to encode.
+# Returns (list of (id, encoded bytes), list of ids that failed).
+def encode_files(resource, folder, ids):
+    category = resource.Meta.name.lower()
+    encoded = []
+    failed = []
+    for id in ids:
+        try:
+            with open(os.path.join(folder, str(id), 'index.json'),
+                      encoding='utf-8') as file:
+                data = json.load(file)
+            # Built the same way the client builds a response.
+            encoded.append((id, cache.encode([resource(**data)], category)))
+        except Exception:
+            failed.append(id)
+    return encoded, failed
+
+
+# Writes encoded resources to the store in one batch and evicts others if
+# that takes the cache over its maximum size.
+#   resource (class):
+#       the resource class.
+#   encoded (list):
+#       (id, encoded bytes) for each resource.
+#   expiration (int):
+#       the expiration date of every resource, in epoch seconds, or None.
+def store_encoded(resource, encoded, expiration):
+    category = resource.Meta.name.lower()
+    store = cache.get_store()
+    store.write_many((category, id, data, expiration,
+                      cache.resource_path(category, id), None)
+                     for id, data in encoded)
+    # Whatever the memory tier holds has just been replaced.
+    memory = cache.get_memory_tier()
+    if memory is not None:
+        for id, data in encoded:
+            memory.remove(category, id)
+    max_size = cache.get_max_size()
+    if store.get_size() > max_size:
+        store.evict(max_size)
+
+
+# Imports every resource of the chosen types from a dump into the cache.
+# Files are read and encoded by a pool of processes, a chunk at a time, and
+# each chunk is written to the store with one batch of catalog updates.
+#   root (str):
+#       the folder holding api/v2, or api/v2 itself.
+#   resources=None (list):
+#       resource classes, category names or resource class names. If None,
+#       every resource type.
+#   processes=None (int):
+#       how many processes encode resources. If None, one per CPU.
+#   expiration_length=None (datetime.timedelta):
+#       how long the imported resources stay fresh, or cache.never. If None,
+#       the length set for imports (see cache.get_import_expiration_length()).
+#   chunk_size=200 (int):
+#       how many resources each process encodes at a time.
+#   progress=print_progress (function):
+#       called with (category, number done, total) after each chunk. None
+#       for no progress reports.
+# Returns an ImportReport.
+def import_dump(root, resources=None, processes=None, expiration_length=None,
+                chunk_size=200, progress=print_progress):
+    resources = find_resources(
+        [resource if isinstance(resource, str) else resource.__name__
+         for resource in resources] if resources else None)
+    dump_dir = find_dump_dir(root)
+    settings = cache.set_up()
+    start_worker(settings)
+    # Anything waiting to be written would land on top of the import.
+    cache.flush()
+    if expiration_length is None:
+        expiration_length = cache.get_import_expiration_length()
+    processes = processes or os.cpu_count() or 1
+    report = ImportReport()
+    with ProcessPoolExecutor(processes, initializer=start_worker,
+                             initargs=(settings,)) as executor:
+        for resource in resources:
+            category = resource.Meta.name.lower()
+            folder = os.path.join(dump_dir, resource.Meta.resource_name)
+            if not os.path.isdir(folder):
+                report.missing.append(category)
+                continue
+            ids = list_ids(folder)
+            # Every resource in the dump was current at the same time, so
+            # they all expire together.
+            expiration = cache.expiration_date(category, expiration_length)
+            chunks = (ids[start:start + chunk_size]
+                      for start in range(0, len(ids), chunk_size))
+            # Only a few chunks are in flight at once, so a large dump
+            # doesn't have to fit in memory.
+            pending = collections.deque()
+            done = 0
+            for chunk in itertools.chain(chunks, [None] * processes * 2):
+                if chunk is not None:
+                    pending.append(executor.submit(encode_files, resource,
+                                                   folder, chunk))
+                if len(pending) < processes * 2 and chunk is not None:
+                    continue
+                if not pending:
+                    break
+                done += import_chunk(resource, pending.popleft().result(),
+                                     expiration, report)
+                if progress:
+                    progress(category, done, len(ids))
+            if progress and not ids:
+                progress(category, 0, 0)
+    cache.flush()
+    return report
+
+
+# Stores a chunk encoded by encode_files() and records it in the report.
+# Returns how many resources the chunk held.
+def import_chunk(resource, result, expiration, report):
+    category = resource.Meta.name.lower()
+    encoded, failed = result
+    store_encoded(resource, encoded, expiration)
+    report.imported.extend((category, id) for id, data in encoded)
+    report.failed.extend((category, id) for id in failed)
+    return len(encoded) + len(failed)
+
+
+# Returns an expiration length given on the command line, in hours or as
+# 'never'.
+def parse_length(value):
+    if value.lower() == 'never':
+        return cache.never
+    return timedelta(hours=float(value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import an offline Pokeapi JSON dump into the cache.')
+    parser.add_argument('dump', help='the folder holding api/v2')
+    parser.add_argument('resources', nargs='*',
+                        help='category or resource class names; all if none')
+    parser.add_argument('--processes', type=int,
+                        help='processes encoding resources; one per CPU if '
+                             'not given')
+    parser.add_argument('--expiration-length', type=parse_length,
+                        help='hours until imported resources expire, or '
+                             '"never"')
+    args = parser.parse_args(argv)
+    report = import_dump(args.dump, args.resources or None, args.processes,
+                         args.expiration_length)
+    print('{} imported, {} failed, {} missing from the dump'.format(
+        len(report.imported), len(report.failed), len(report.missing)))
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
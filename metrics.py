@@ -0,0 +1,297 @@
+# /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Counters and latency histograms for the client and the cache, labelled by
+# category and outcome. Everything is recorded in registry, which can be
+# read with registry.snapshot() or written out in Prometheus' text format
+# with registry.export().
+
+import math
+import threading
+import universal
+
+# The upper bounds, in seconds, of the buckets latency histograms count in.
+# They run from a memory tier hit to a slow request to Pokeapi.
+default_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    A named series of values, one for each combination of label values.
+
+        Attributes:
+            name (str)
+                The name the metric is exported under.
+            help (str)
+                What the metric measures.
+            label_names (tuple)
+                The names of the labels, in the order their values are
+                given.
+            values (dict)
+                The value of each series, by tuple of label values.
+    """
+
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    # Returns a copy of the values, by tuple of label values.
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    # Returns the lines of the metric in Prometheus' text format.
+    def export(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, like the number of cache hits.
+    """
+
+    type = 'counter'
+
+    # Adds to the count for the given label values.
+    def increment(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def export(self):
+        return [sample(self.name, self.label_names, labels, value)
+                for labels, value in sorted_series(self.snapshot())]
+
+
+class Histogram(Metric):
+    """
+    How many observations, like the seconds a cache read took, fell at or
+    under each of a set of bounds, along with their count and sum.
+
+        Attributes:
+            buckets (tuple)
+                The upper bounds of the buckets, in increasing order.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=default_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    # Records an observation for the given label values.
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = {
+                    'counts': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][position] += 1
+                    break
+            series['count'] += 1
+            series['sum'] += value
+
+    # Returns, for each series, a dictionary with:
+    #   buckets (list): (upper bound, observations at or under it), ending
+    #       with infinity for every observation.
+    #   count (int): the number of observations.
+    #   sum (float): their total.
+    def snapshot(self):
+        with self.lock:
+            values = {labels: (list(series['counts']), series['count'],
+                               series['sum'])
+                      for labels, series in self.values.items()}
+        snapshot = {}
+        for labels, (counts, count, total) in values.items():
+            cumulative = 0
+            buckets = []
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                buckets.append((bound, cumulative))
+            buckets.append((math.inf, count))
+            snapshot[labels] = {'buckets': buckets, 'count': count,
+                                'sum': total}
+        return snapshot
+
+    def export(self):
+        lines = []
+        label_names = self.label_names + ('le',)
+        for labels, series in sorted_series(self.snapshot()):
+            for bound, count in series['buckets']:
+                lines.append(sample(self.name + '_bucket', label_names,
+                                    labels + (format_value(bound),), count))
+            lines.append(sample(self.name + '_sum', self.label_names, labels,
+                                series['sum']))
+            lines.append(sample(self.name + '_count', self.label_names,
+                                labels, series['count']))
+        return lines
+
+
+class Registry:
+    """
+    The metrics that are recorded, and collectors for figures that are kept
+    elsewhere and only read when the metrics are.
+
+        Attributes:
+            metrics (dict)
+                The metrics, by name.
+            collectors (list)
+                Functions that return an iterable of (name, help, labels,
+                value) for gauges, where labels is a dictionary.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    # Returns the metric with a name, making it with kind if there isn't one.
+    def add(self, kind, name, help, label_names=(), **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, help, label_names, **kwargs)
+            return self.metrics[name]
+
+    # Returns the counter with a name, making it if it doesn't exist.
+    #   name (str):
+    #       the name it's exported under, e.g. 'pykachu_requests_total'.
+    #   help (str):
+    #       what it counts.
+    #   label_names=() (tuple):
+    #       the names of its labels, e.g. ('category', 'outcome').
+    def counter(self, name, help, label_names=()):
+        return self.add(Counter, name, help, label_names)
+
+    # Returns the histogram with a name, making it if it doesn't exist. Takes
+    # the same arguments as counter(), and
+    #   buckets=default_buckets (tuple):
+    #       the upper bounds of the buckets.
+    def histogram(self, name, help, label_names=(), buckets=default_buckets):
+        return self.add(Histogram, name, help, label_names, buckets=buckets)
+
+    # Adds a function whose figures are included whenever the metrics are
+    # read (see Registry.collectors).
+    def collector(self, function):
+        self.collectors.append(function)
+        return function
+
+    # Returns the gauges from the collectors, by name and then by tuple of
+    # sorted (label, value) pairs, along with the help for each name.
+    def collect(self):
+        gauges = {}
+        helps = {}
+        for collector in self.collectors:
+            for name, help, labels, value in collector():
+                helps[name] = help
+                gauges.setdefault(name, {})[
+                    tuple(sorted(labels.items()))] = value
+        return gauges, helps
+
+    # Returns every metric's values, by name and then by tuple of label
+    # values. Gauges from collectors are keyed by tuples of (label, value)
+    # pairs instead. Histogram values are described in Histogram.snapshot().
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        snapshot = {metric.name: metric.snapshot() for metric in metrics}
+        snapshot.update(self.collect()[0])
+        return snapshot
+
+    # Clears every metric. Collected figures are left to their owners.
+    def reset(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    # Returns every metric in Prometheus' text format.
+    def to_prometheus(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(),
+                             key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.export())
+        gauges, helps = self.collect()
+        for name in sorted(gauges):
+            lines.append('# HELP {} {}'.format(name, helps[name]))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in sorted_series(gauges[name]):
+                lines.append(sample(name, [label for label, _ in labels],
+                                    [value for _, value in labels], value))
+        return '\n'.join(lines) + '\n'
+
+    # Writes the metrics in Prometheus' text format.
+    #   target (str or function):
+    #       a file, which is replaced in one step so a scraper never reads
+    #       half of it (as node_exporter's textfile collector expects), or a
+    #       function to call with the text.
+    def export(self, target):
+        text = self.to_prometheus()
+        if callable(target):
+            target(text)
+            return
+        universal.write_file(target, text.encode())
+
+    # Exports the metrics every interval seconds on a background thread.
+    # Returns a threading.Event that stops it when set.
+    #   target (str or function):
+    #       as for export().
+    #   interval=15.0 (float):
+    #       the seconds between exports.
+    def export_periodically(self, target, interval=15.0):
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                try:
+                    self.export(target)
+                except Exception:
+                    pass
+
+        threading.Thread(target=run, daemon=True).start()
+        return stopped
+
+
+# Returns the (labels, value) pairs of a metric's values, ordered by label.
+# Label values can be None, so they're compared as strings.
+def sorted_series(values):
+    return sorted(values.items(),
+                  key=lambda item: [str(label) for label in item[0]])
+
+
+# Returns a number as Prometheus writes it.
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value is None:
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Returns one line of Prometheus' text format.
+def sample(name, label_names, labels, value):
+    if not label_names:
+        return '{} {}'.format(name, format_value(value))
+    pairs = ','.join('{}="{}"'.format(
+        label, str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for label, label_value in zip(label_names,
+                                                            labels))
+    return '{}{{{}}} {}'.format(name, pairs, format_value(value))
+
+
+# The registry the client and the cache record to.
+registry = Registry()
@@ -1,6 +1,5 @@
 # /usr/bin/env python
 # -*- coding: utf-8 -*-
-import client
 from universal import lazy_property
 
 
@@ -30,6 +29,8 @@ class APIResource:
     # The API
     @lazy_property
     def resource(self):
+        # Imported here, since client imports resources.
+        import client
         poke_client = client.PokemonClient()
         resource = getattr(poke_client,
                            'get_' + self.resource_type.replace('-', '_'))(uid=self.id)[0]
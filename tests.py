@@ -4,10 +4,25 @@
 import unittest
 import client
 import resources
+import cache
+import warmer
+import importer
+import metrics
+import tempfile
+import configparser
+import sqlite3
+import json
+import pickle
+import lzma
+import http.server
 import os
 import timeit
 from datetime import datetime as dt
+from datetime import timedelta
 import time
+import threading
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
 
 
 class MyTestCase(unittest.TestCase):
@@ -42,5 +57,1150 @@ class MyTestCase(unittest.TestCase):
         #[self.pokemon_client.get_pokemon(uid=x) for x in range(1, 10)]
 
 
+class SQLiteStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = cache.SQLiteStore(
+            os.path.join(self.directory.name, 'cache.sqlite3'),
+            cache.LRUPolicy())
+
+    def tearDown(self):
+        self.store.connection.close()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        expiration = dt(2030, 1, 1, 12, 0, 0)
+        self.store.write('pokemon', 3, b'bulbasaur', expiration)
+        assert self.store.read('pokemon', 3) == b'bulbasaur'
+        assert (self.store.get_expiration('pokemon', 3) ==
+                expiration.timestamp())
+        assert self.store.get_size() == len(b'bulbasaur')
+        self.store.remove('pokemon', 3)
+        assert self.store.read('pokemon', 3) is None
+        assert self.store.get_size() == 0
+
+    def test_size_total(self):
+        self.store.write('pokemon', 1, b'bulbasaur', None)
+        self.store.write('pokemon', 1, b'ivysaur', None)
+        self.store.write_many([('pokemon', 2, b'venusaur', None, None, None),
+                               ('pokemon', 3, b'charmander', 1, None, None)])
+        assert self.store.get_size() == len(b'ivysaur' b'venusaur'
+                                            b'charmander')
+        list(self.store.clean())
+        assert self.store.get_size() == len(b'ivysaur' b'venusaur')
+        # The total is kept in the database, so it's there when reopened.
+        store = cache.SQLiteStore(self.store.path, cache.LRUPolicy())
+        assert store.get_size() == len(b'ivysaur' b'venusaur')
+        store.connection.close()
+
+    def test_migrate_journal(self):
+        # A directory cache whose catalogs are still only in the journal.
+        catalog = cache.Catalog(self.directory.name, 1024 * 1024)
+        for id in range(5):
+            path = os.path.join(self.directory.name, 'pokemon', str(id))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(b'entry')
+            catalog.set_many([('paths', 'pokemon', id, path),
+                              ('expiration', 'pokemon', id, 2000000000),
+                              ('validators', 'pokemon', id,
+                               json.dumps({'etag': str(id)}))])
+        catalog.close()
+        self.store.migrate(self.directory.name)
+        assert self.store.read('pokemon', 4) == b'entry'
+        assert self.store.get_expiration('pokemon', 4) == 2000000000
+        assert self.store.get_validators('pokemon', 4) == {'etag': '4'}
+        assert os.listdir(os.path.join(self.directory.name, 'pokemon')) == []
+        assert not os.path.exists(os.path.join(self.directory.name,
+                                               cache.Catalog.journal_name))
+
+    def test_legacy_expiration(self):
+        path = os.path.join(self.directory.name, 'legacy.sqlite3')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                'CREATE TABLE entries (category TEXT NOT NULL, '
+                'id TEXT NOT NULL, payload BLOB NOT NULL, expiration TEXT, '
+                'size INTEGER NOT NULL, PRIMARY KEY (category, id)) '
+                'WITHOUT ROWID')
+            connection.execute(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                ('pokemon', '3', b'bulbasaur', '2030-01-01:12:00:00.000001',
+                 9))
+        connection.close()
+        store = cache.SQLiteStore(path, cache.LRUPolicy())
+        assert (store.get_expiration('pokemon', 3) ==
+                int(dt(2030, 1, 1, 12, 0, 0).timestamp()))
+        store.connection.close()
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.catalog = cache.Catalog(self.directory.name, 1024)
+
+    def tearDown(self):
+        self.catalog.close()
+        self.directory.cleanup()
+
+    def test_journal_replay(self):
+        self.catalog.set('expiration', 'pokemon', 3, 100)
+        self.catalog.set('expiration', 'pokemon', 4, 200)
+        self.catalog.remove('expiration', 'pokemon', 4)
+        # A crash in the middle of a write leaves a torn record.
+        with open(self.catalog.journal_path(), 'ab') as journal:
+            journal.write(b'["expiration", "pokemon"')
+        replayed = cache.Catalog(self.directory.name, 1024)
+        assert replayed.items('expiration') == [('pokemon', '3', 100)]
+        replayed.set('paths', 'pokemon', 3, 'pokemon/pokemon/3')
+        replayed.close()
+        assert (cache.Catalog(self.directory.name, 1024).get(
+            'paths', 'pokemon', 3) == 'pokemon/pokemon/3')
+
+    def test_compaction(self):
+        for id in range(100):
+            self.catalog.set('expiration', 'pokemon', id, 100)
+        self.catalog.flush()
+        assert os.path.getsize(self.catalog.journal_path()) == 0
+        assert len(cache.Catalog(self.directory.name, 1024).items(
+            'expiration')) == 100
+
+    def test_processes(self):
+        # Workers appending and compacting at once lose nothing.
+        with ProcessPoolExecutor(4) as executor:
+            list(executor.map(append_records, [self.directory.name] * 4,
+                              range(4)))
+        catalog = cache.Catalog(self.directory.name, 1024)
+        assert len(catalog.items('sizes')) == 4 * 50
+        assert catalog.total_size == 4 * sum(range(50))
+        catalog.close()
+
+    def test_legacy_expiration(self):
+        # ISO dates from older caches are read as epoch seconds.
+        with open(self.catalog.file_path('expiration'), 'w') as file:
+            file.write('[pokemon]\n3 = 2030-01-01:12:00:00.000001\n')
+        catalog = cache.Catalog(self.directory.name, 1024)
+        assert (catalog.get('expiration', 'pokemon', 3) ==
+                int(dt(2030, 1, 1, 12, 0, 0).timestamp()))
+        catalog.close()
+
+
+# Evicts everything a policy tracks, returning the keys in the order they
+# went.
+def drain(policy):
+    victims = []
+    for key in policy.victims():
+        victims.append(key)
+        policy.remove(key)
+    return victims
+
+
+class EvictionPolicyTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        policy = cache.LRUPolicy()
+        for key in 'abc':
+            policy.add(key, 10)
+        policy.touch('a')
+        assert drain(policy) == ['b', 'c', 'a']
+
+    def test_lfu(self):
+        policy = cache.LFUPolicy()
+        for key in 'abc':
+            policy.add(key, 10)
+        policy.touch('a')
+        policy.touch('a')
+        policy.touch('b')
+        assert drain(policy) == ['c', 'b', 'a']
+
+    def test_greedy_dual_size(self):
+        policy = cache.GreedyDualSizePolicy()
+        policy.add('big', 1000)
+        policy.add('small', 10)
+        policy.add('gone', 1)
+        policy.remove('gone')
+        assert drain(policy) == ['big', 'small']
+
+    def test_greedy_dual_size_protocol(self):
+        policy = cache.GreedyDualSizePolicy()
+        policy.add('big', 1000)
+        policy.add('small', 10)
+        # Looking at the next victim without removing it changes nothing.
+        assert next(policy.victims()) == 'big'
+        assert next(policy.victims()) == 'big'
+        assert policy.inflation == 0
+        # Removing a resource that wasn't picked doesn't age the rest.
+        policy.remove('small')
+        assert policy.inflation == 0
+        assert drain(policy) == ['big']
+        assert policy.inflation == 1 / 1000
+        # Hits don't grow the heap without bound.
+        policy.add('small', 10)
+        for i in range(100):
+            policy.touch('small')
+        assert len(policy.heap) <= 2
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = cache.SQLiteStore(
+                os.path.join(directory, 'cache.sqlite3'),
+                cache.GreedyDualSizePolicy())
+            for id in range(40):
+                store.write('pokemon', id, b'x' * 10, None)
+                store.evict(100)
+            # Every resource still stored is still ranked.
+            assert store.get_size() == 100
+            assert sorted(drain(store.policy)) == sorted(
+                ('pokemon', str(id)) for id in range(30, 40))
+            store.connection.close()
+
+    def test_policy_lock(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = cache.SQLiteStore(
+                os.path.join(directory, 'cache.sqlite3'), cache.LFUPolicy())
+            store.write('pokemon', 1, b'bulbasaur', None)
+            with store.policy_lock:
+                reader = threading.Thread(target=store.read,
+                                          args=('pokemon', 1))
+                reader.start()
+                # The hit waits for whoever is using the policy.
+                reader.join(0.2)
+                assert reader.is_alive()
+            reader.join()
+            assert store.policy.counts[('pokemon', '1')] == 2
+            store.connection.close()
+
+    def test_tiny_lfu(self):
+        policy = cache.TinyLFUPolicy()
+        policy.add('popular', 10)
+        for i in range(5):
+            policy.touch('popular')
+        policy.add('once', 10)
+        # Pushes 'once' out of the window. It's used less than the oldest in
+        # the main area, so it goes first.
+        policy.add('newest', 10)
+        assert next(policy.victims()) == 'once'
+
+
+class MemoryTierTestCase(unittest.TestCase):
+
+    def test_limits_and_expiry(self):
+        tier = cache.MemoryTier(cache.LRUPolicy(), 2)
+        tier.put('pokemon', 1, 'bulbasaur', None, 10)
+        tier.put('pokemon', 2, 'ivysaur', None, 10)
+        assert tier.get('pokemon', 1) == 'bulbasaur'
+        tier.put('pokemon', 3, 'venusaur', None, 10)
+        assert tier.get('pokemon', 2) is None
+        assert tier.size == 20
+        tier.put('pokemon', 1, 'expired', time.time() - 1, 10)
+        assert tier.get('pokemon', 1) is None
+        assert tier.stats()['entries'] == 1
+
+    def test_stale_entries(self):
+        tier = cache.MemoryTier(cache.LRUPolicy(), 10)
+        expiration = time.time() - 60
+        tier.put('pokemon', 1, 'bulbasaur', expiration, 10)
+        # Still usable if it can be up to two minutes stale.
+        assert tier.get_entry('pokemon', 1, 120) == ('bulbasaur', expiration)
+        assert tier.get_entry('pokemon', 1, 30) is None
+        assert tier.get_entry('pokemon', 1, 120) is None
+
+    def test_greedy_dual_size(self):
+        tier = cache.MemoryTier(cache.GreedyDualSizePolicy(), 2)
+        for id in range(10):
+            tier.put('pokemon', id, 'pokemon', None, 10 + id)
+        assert tier.stats()['entries'] == 2
+
+    def test_store_removal(self):
+        for backend in ('sqlite', 'pack'):
+            with tempfile.TemporaryDirectory() as directory:
+                config = configparser.ConfigParser()
+                config['cache'] = {'path': directory, 'backend': backend}
+                cache.configure(cache.Settings.from_config(config))
+                self.addCleanup(cache.reload)
+                cache.write_cache([resources.PokemonResource(id=1)],
+                                  category='pokemon', id=1)
+                cache.flush()
+                assert cache.read_cache('pokemon', 1)[0].id == 1
+                # Removing it from the store drops the decoded copy too.
+                cache.get_store().remove('pokemon', 1)
+                assert cache.read_cache('pokemon', 1) is None
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        pokemon = [resources.PokemonResource(
+            id=3, name='venusaur',
+            types=[{'slot': 1, 'type': {'name': 'grass',
+                                        'url': 'http://pokeapi.co/api/v2/type/12/'}}])]
+        for serializer in cache.serializers.values():
+            loaded = cache.load(serializer.dump(pokemon))
+            assert isinstance(loaded[0], resources.PokemonResource)
+            assert loaded[0].name == 'venusaur'
+            assert [t.name for t in loaded[0].types] == ['grass']
+
+    def test_untagged_yaml(self):
+        pokemon = [resources.PokemonResource(id=3, name='venusaur')]
+        assert cache.load(cache.serializers['yaml'].dumps(pokemon))[0].id == 3
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    # Sets up a cache in the test's directory with the given [codecs]
+    # section and no memory tier.
+    def set_up(self, codecs):
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name, 'memory_entries': '0',
+                           'serializer': 'json', 'compression': 'true'}
+        config['codecs'] = codecs
+        cache.set_up(cache.Settings.from_config(config))
+
+    # Writes a pokemon through the cache and returns (codec id, payload) of
+    # the entry that was stored.
+    def write(self, id):
+        cache.write_cache([resources.PokemonResource(id=id, name='bulbasaur')],
+                          category='pokemon', id=id)
+        cache.flush()
+        data = bytes(cache.get_store().read('pokemon', id))
+        header = cache.entry_headers[3]
+        return header.unpack_from(data)[3], data[header.size:]
+
+    def test_configured_codec(self):
+        self.set_up({'pokemon': 'lzma:1'})
+        codec_id, payload = self.write(1)
+        assert codec_id == cache.codecs['lzma'].id
+        serialized = cache.serializers['json'].dumps(
+            [resources.PokemonResource(id=1, name='bulbasaur')])
+        assert payload == lzma.compress(serialized, preset=1)
+
+    def test_round_trip(self):
+        for name, codec in cache.codecs.items():
+            self.set_up({'pokemon': name})
+            id = codec.id + 1
+            codec_id, payload = self.write(id)
+            assert codec_id == codec.id
+            assert cache.read_cache('pokemon', id)[0].id == id
+        # A codec that isn't available falls back to the default, gzip.
+        self.set_up({'pokemon': 'zstd:3'})
+        codec_id, payload = self.write(100)
+        assert codec_id == cache.codecs['gzip'].id
+        assert cache.read_cache('pokemon', 100)[0].id == 100
+
+    def test_compression_stats(self):
+        self.set_up({'pokemon': 'none', 'type': 'zlib'})
+        with mock.patch.dict(cache.compression_stats, clear=True):
+            serialized = cache.serializers['json'].dumps(
+                [resources.PokemonResource(id=1)])
+            cache.write_cache([resources.PokemonResource(id=1)],
+                              category='pokemon', id=1)
+            cache.write_cache([resources.TypeResource(id=1)],
+                              category='type', id=1)
+            cache.flush()
+            cache.read_cache('pokemon', 1)
+            stats = cache.get_compression_stats()
+            assert stats['pokemon']['codec'] == 'none'
+            assert stats['pokemon']['ratio'] == len(serialized) / (
+                len(serialized) + cache.entry_headers[3].size)
+            assert stats['pokemon']['decode_time'] > 0
+            assert stats['type']['codec'] == 'zlib'
+            # Written but never read.
+            assert stats['type']['decode_time'] is None
+
+
+class EntryHeaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name, 'memory_entries': '0',
+                           'serializer': 'json'}
+        cache.set_up(cache.Settings.from_config(config))
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    def test_legacy_entries(self):
+        pokemon = [resources.PokemonResource(id=3, name='venusaur')]
+        serialized = cache.serializers['json'].dump(pokemon)
+        for data in (cache.entry_headers[2].pack(cache.entry_magic, 2, 1, 0) +
+                     cache.codecs['zlib'].compress(serialized),
+                     cache.codecs['gzip'].compress(serialized)):
+            assert cache.decode(data)[0].name == 'venusaur'
+
+    def test_corrupt_entry(self):
+        pokemon = [resources.PokemonResource(id=3, name='venusaur')]
+        data = cache.encode(pokemon, 'pokemon')
+        assert data[3] == 3 and cache.decode(data)[0].name == 'venusaur'
+        # Truncated, damaged, and damaged in the header.
+        for bad in (data[:-1], data[:-1] + bytes([data[-1] ^ 1]), data[:8]):
+            assert cache.decode(bad) is None
+        cache.write_cache(pokemon, category='pokemon', id=3)
+        path = cache.get_file_path('pokemon', 3)
+        with open(path, 'r+b') as file:
+            file.seek(len(data) - 2)
+            file.write(b'\xff\xff')
+        assert cache.read_cache('pokemon', 3) is None
+        # It's set aside, so the next read is a plain miss.
+        assert not os.path.exists(path)
+        assert os.path.isfile(os.path.join(self.directory.name, 'quarantine',
+                                           'pokemon', '3'))
+        assert cache.get_file_path('pokemon', 3) is None
+        assert cache.read_cache('pokemon', 3) is None
+
+
+class DictionaryTestCase(unittest.TestCase):
+
+    def test_train(self):
+        documents = [('{"name":"move-%d","url":"http://pokeapi.co/api/v2/'
+                      'move/%d/","version_group":"red-blue"}' % (i, i)).encode()
+                     for i in range(50)]
+        dictionary = cache.Dictionary.train(documents, 1024)
+        assert b'version_group' in dictionary.data
+        for document in documents:
+            compressed = dictionary.compress(document)
+            assert len(compressed) < len(cache.codecs['zlib'].compress(
+                document))
+            assert dictionary.decompress(compressed) == document
+
+
+# Sets catalog entries from another process, compacting along the way.
+def append_records(directory, worker):
+    catalog = cache.Catalog(directory, 512)
+    for id in range(50):
+        catalog.set('sizes', 'worker-{}'.format(worker), id, id)
+    catalog.flush()
+    catalog.close()
+
+
+# Writes entries to a pack store from another process.
+def append_entries(worker):
+    store = cache.get_store()
+    for id in range(200):
+        key = '{}-{}'.format(worker, id)
+        store.write('pokemon', key, key.encode() * 500, None)
+
+
+class CleanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    # Sets up a cache with three expired resources, soonest first, and two
+    # fresh ones.
+    def fill(self, backend):
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': os.path.join(self.directory.name,
+                                                backend),
+                           'backend': backend}
+        cache.configure(cache.Settings.from_config(config))
+        store = cache.get_store()
+        now = int(time.time())
+        for id in range(5):
+            store.write('pokemon', id, b'entry', now + id * 100 - 250)
+        return store
+
+    def test_measure_sizes(self):
+        # A cache from before sizes were catalogued has them filled in with
+        # one journal append.
+        self.fill('directory')
+        catalog = cache.get_catalog()
+        for id in range(5):
+            catalog.remove('sizes', 'pokemon', id)
+        with mock.patch.object(catalog, 'set_many',
+                               wraps=catalog.set_many) as set_many:
+            cache.DirectoryStore()
+        assert set_many.call_count == 1
+        assert catalog.total_size == 5 * len(b'entry')
+
+    def test_dry_run(self):
+        for backend in cache.backends:
+            store = self.fill(backend)
+            report = cache.clean(dry_run=True)
+            assert report.complete
+            assert sorted(report.expired) == [('pokemon', '0'),
+                                              ('pokemon', '1'),
+                                              ('pokemon', '2')]
+            assert report.freed == 3 * len(b'entry')
+            assert all(store.read('pokemon', id) is not None
+                       for id in range(5))
+
+    def test_resume(self):
+        for backend in ('directory', 'pack'):
+            store = self.fill(backend)
+            # Out of time straight away, so it stops partway.
+            report = cache.clean(max_time=0)
+            assert not report.complete
+            # Written again while cleaning is paused, so it's kept.
+            store.write('pokemon', 2, b'entry', int(time.time()) + 100)
+            report = cache.clean()
+            assert report.complete
+            assert store.read('pokemon', 0) is None
+            assert store.read('pokemon', 1) is None
+            assert all(store.read('pokemon', id) is not None
+                       for id in (2, 3, 4))
+            # The next call starts over.
+            assert cache.clean().expired == []
+
+
+class AtomicWriteTestCase(unittest.TestCase):
+
+    def test_no_torn_reads(self):
+        # Readers see the old file or the whole new one, never part of it.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'entry')
+            contents = [bytes([letter]) * (1024 * 1024) for letter in b'ab']
+            cache.write_file(path, contents[0])
+            torn = []
+            stop = threading.Event()
+
+            def read():
+                while not stop.is_set():
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                    if data not in contents:
+                        torn.append(len(data))
+
+            readers = [threading.Thread(target=read) for i in range(2)]
+            for reader in readers:
+                reader.start()
+            for position in range(50):
+                cache.write_file(path, contents[position % 2])
+            stop.set()
+            for reader in readers:
+                reader.join()
+            assert torn == []
+            assert os.listdir(directory) == ['entry']
+
+
+class PackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'pokemon', 'pokemon')
+        self.pack = cache.Pack(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_processes(self):
+        # Workers appending to the same packs at once lose nothing.
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name, 'backend': 'pack'}
+        settings = cache.Settings.from_config(config)
+        with ProcessPoolExecutor(4, initializer=cache.configure,
+                                 initargs=(settings,)) as executor:
+            list(executor.map(append_entries, range(4)))
+        cache.configure(settings)
+        self.addCleanup(cache.reload)
+        store = cache.get_store()
+        for worker in range(4):
+            for id in range(200):
+                key = '{}-{}'.format(worker, id)
+                assert bytes(store.read('pokemon', key)) == \
+                    key.encode() * 500
+
+    def test_append_and_repack(self):
+        self.pack.write(1, b'bulbasaur')
+        self.pack.write(2, b'ivysaur')
+        self.pack.write(1, b'BULBASAUR')
+        self.pack.remove(2)
+        assert bytes(self.pack.read(1)) == b'BULBASAUR'
+        assert self.pack.read(2) is None
+        # Another process sees the same entries.
+        assert bytes(cache.Pack(self.path).read(1)) == b'BULBASAUR'
+        self.pack.repack()
+        assert self.pack.dead == 0
+        assert (os.path.getsize(self.path + '.pack') ==
+                cache.Pack.header_size + len(b'BULBASAUR'))
+        assert bytes(self.pack.read(1)) == b'BULBASAUR'
+
+    def test_mismatched_index(self):
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name, 'backend': 'pack',
+                           'memory_entries': '0'}
+        cache.configure(cache.Settings.from_config(config))
+        self.addCleanup(cache.reload)
+        cache.write_cache([resources.PokemonResource(id=1)],
+                          category='pokemon', id=1)
+        cache.flush()
+        assert cache.is_fresh('pokemon', 1)
+        # An index from some other packfile replaces this one's.
+        path = cache.get_store().pack('pokemon').path
+        with open(path + '.idx', 'rb') as file:
+            header = file.read(cache.Pack.header_size)
+        cache.write_file(path + '.idx',
+                         header[:7] + bytes(cache.Pack.token_size))
+        # Starting the pack again drops what the catalog said it held.
+        assert cache.read_cache('pokemon', 1) is None
+        assert not cache.is_fresh('pokemon', 1)
+        assert cache.get_store().get_size() == 0
+
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    def test_coalesce_and_flush(self):
+        written = []
+        release = threading.Event()
+
+        def store_resource(resource, category, id, file_name=None,
+                           expiration_length=None, validators=None):
+            release.wait()
+            written.append((category, id, resource))
+
+        with mock.patch('cache.store_resource', store_resource):
+            queue = cache.WriteBehind(1, 10)
+            queue.put('first', 'pokemon', 1)
+            queue.put('second', 'pokemon', 2)
+            queue.put('newer second', 'pokemon', 2)
+            assert queue.get('pokemon', 2) == 'newer second'
+            release.set()
+            queue.flush()
+        assert ('pokemon', '2', 'newer second') in written
+        assert ('pokemon', '2', 'second') not in written
+        assert queue.get('pokemon', 2) is None
+        stats = queue.stats()
+        assert stats['coalesced'] == 1
+        assert stats['queue_depth'] == 0
+
+
+class SettingsTestCase(unittest.TestCase):
+
+    def test_from_config(self):
+        config = configparser.ConfigParser()
+        with tempfile.TemporaryDirectory() as directory:
+            config['cache'] = {'path': directory,
+                               'expiration_length': '12',
+                               'max_size': '-5',
+                               'backend': 'floppy',
+                               'compression': 'False'}
+            config['codecs'] = {'pokemon': 'lzma:9', 'moves': 'rot13'}
+            settings = cache.Settings.from_config(config)
+            assert settings.path == directory
+        assert settings.expiration_length == timedelta(hours=12)
+        # Invalid settings get their defaults.
+        assert settings.max_size == float('inf')
+        assert settings.backend == 'directory'
+        assert settings.compression is False
+        assert settings.codecs == {'pokemon': (cache.codecs['lzma'], 9)}
+        with self.assertRaises(AttributeError):
+            settings.max_size = 10
+
+    def test_expiration_lengths(self):
+        config = configparser.ConfigParser()
+        config['expiration'] = {'pokemon/types': 'never',
+                                'statresource': 'immutable',
+                                'pokemon': '24',
+                                'move': 'soon'}
+        settings = cache.Settings.from_config(config)
+        assert settings.expiration_lengths == {
+            'pokemon/types': cache.never,
+            'statresource': cache.never,
+            'pokemon': timedelta(hours=24)}
+        assert settings.immutable == {'statresource'}
+
+    def test_config_key_order(self):
+        # The example in get_expiration_length().
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': tempfile.gettempdir()}
+        config['expiration'] = {'pokemon': '24', 'typeresource': 'never',
+                                'stat': 'immutable'}
+        cache.register_category('type', 'pokemon/types/', 'TypeResource')
+        cache.register_category('stat', 'pokemon/stats/', 'StatResource')
+        cache.register_category('pokemon', 'pokemon/pokemon/',
+                                'PokemonResource')
+        cache.configure(cache.Settings.from_config(config))
+        try:
+            assert cache.config_keys('type') == [
+                'pokemon/types', 'typeresource', 'type', 'pokemon']
+            assert cache.get_expiration_length('pokemon') == \
+                timedelta(hours=24)
+            assert cache.get_expiration_length('type') == cache.never
+            assert cache.is_immutable('stat')
+            assert not cache.is_immutable('type')
+        finally:
+            cache.reload()
+
+    def test_store_follows_path(self):
+        # Pointing the cache somewhere else gives it a store there.
+        with tempfile.TemporaryDirectory() as first, \
+                tempfile.TemporaryDirectory() as second:
+            self.addCleanup(cache.reload)
+            for backend in ('sqlite', 'pack'):
+                config = configparser.ConfigParser()
+                config['cache'] = {'path': first, 'backend': backend}
+                cache.configure(cache.Settings.from_config(config))
+                cache.get_store().write('pokemon', 1, b'first', None)
+                config['cache']['path'] = second
+                cache.configure(cache.Settings.from_config(config))
+                assert cache.get_store().read('pokemon', 1) is None
+                cache.get_store().write('pokemon', 1, b'second', None)
+                assert os.path.exists(os.path.join(
+                    second, 'cache.sqlite3' if backend == 'sqlite'
+                    else os.path.join('pokemon', 'pokemon.pack')))
+
+    def test_client_expiration_lengths(self):
+        pokemon_client = client.PokemonClient(
+            read_cache=False, write_cache=False,
+            expiration_lengths={resources.TypeResource: 'immutable',
+                                'pokemon': 12})
+        assert pokemon_client.expiration_lengths == {
+            'type': cache.never, 'pokemon': timedelta(hours=12)}
+        assert pokemon_client.immutable == {'type'}
+
+
+class ShardedLayoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name}
+        cache.set_up(cache.Settings.from_config(config))
+        cache.register_category('pokemon', 'pokemon/pokemon/')
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    def test_migration(self):
+        for id in (1, 2, 3):
+            cache.write_cache([resources.PokemonResource(id=id)],
+                              category='pokemon', id=id)
+        flat_path = os.path.join(self.directory.name, 'pokemon', 'pokemon',
+                                 '1')
+        assert cache.resource_path('pokemon', 1) == flat_path
+        assert os.path.isfile(flat_path)
+        cache.configure(cache.get_settings()._replace(shard_levels=2))
+        cache.get_memory_tier().clear()
+        path = cache.resource_path('pokemon', 1)
+        assert len(os.path.relpath(path, os.path.dirname(flat_path))
+                   .split(os.sep)) == 3
+        # Reading a resource moves it.
+        resource, expiration = cache.read_entry('pokemon', 1, path)
+        assert resource[0].id == 1
+        assert os.path.isfile(path) and not os.path.exists(flat_path)
+        # The rest are moved together.
+        assert cache.migrate_layout() == 2
+        assert cache.migrate_layout() == 0
+        assert cache.get_file_path('pokemon', 3) == \
+            cache.resource_path('pokemon', 3)
+        assert cache.read_cache('pokemon', 3)[0].id == 3
+
+
+class StubServerTestCase(unittest.TestCase):
+    """
+    Runs the client against a local HTTP server using Handler, with the
+    cache in a temporary directory.
+    """
+
+    Handler = None
+
+    def setUp(self):
+        self.Handler.requests = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name}
+        cache.configure(cache.Settings.from_config(config))
+        base_url = 'http://127.0.0.1:{}/api/v2'.format(
+            self.server.server_address[1])
+        self.base_url = mock.patch.object(client.BeckettClient.Meta,
+                                          'base_url', base_url)
+        self.base_url.start()
+        self.client = client.PokemonClient()
+
+    def tearDown(self):
+        self.base_url.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def send_json(self, data, *headers):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConditionalRequestTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        def do_GET(self):
+            self.requests.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Cache-Control', 'max-age=60')
+                self.end_headers()
+                return
+            self.send_json({'id': 1, 'name': 'normal'}, ('ETag', '"v1"'),
+                           ('Cache-Control', 'public, max-age=60'))
+
+    def test_not_modified(self):
+        assert self.client.get_type(uid=1)[0].name == 'normal'
+        assert cache.get_validators('type', 1) == {'etag': '"v1"',
+                                                   'last_modified': None}
+        # The server's max-age is the expiration length.
+        expiration = cache.get_store().get_expiration('type', 1)
+        assert 0 < expiration - time.time() <= 60
+        cache.extend_expiration('type', 1, timedelta(seconds=-10))
+        assert self.client.get_type(uid=1)[0].name == 'normal'
+        assert self.Handler.requests == [None, '"v1"']
+        assert cache.get_store().get_expiration('type', 1) > time.time()
+
+    def test_configured_length(self):
+        # A length in the config file beats the server's max-age.
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': self.directory.name}
+        config['expiration'] = {'type': 'immutable'}
+        cache.configure(cache.Settings.from_config(config))
+        assert self.client.get_type(uid=1)[0].name == 'normal'
+        assert cache.get_store().get_expiration('type', 1) is None
+        # So does one set on the client, even of 0.
+        self.client.set_expiration_length('type', 0)
+        cache.remove_file('type', 1)
+        self.client.get_type(uid=1)
+        assert cache.get_store().get_expiration('type', 1) <= time.time()
+
+
+class StaleTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        failing = False
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            if self.failing:
+                self.send_response(500)
+                self.end_headers()
+                return
+            self.send_json({'id': 1, 'name': 'normal-{}'.format(
+                len(self.requests))})
+
+    def setUp(self):
+        super().setUp()
+        self.Handler.failing = False
+
+    # Runs the cache with stale data served in the given cases, and caches
+    # a resource that has just expired.
+    def expire(self, **flags):
+        config = configparser.ConfigParser()
+        config['cache'] = dict({'path': self.directory.name}, **flags)
+        cache.configure(cache.Settings.from_config(config))
+        self.client.get_type(uid=1)
+        cache.extend_expiration('type', 1, timedelta(seconds=-10))
+
+    def test_stale_while_revalidate(self):
+        self.expire(stale_while_revalidate='True')
+        # The expired copy comes back straight away...
+        assert self.client.get_type(uid=1)[0].name == 'normal-1'
+        # ...while a fresh one is fetched in the background.
+        deadline = time.monotonic() + 5
+        while not cache.is_fresh('type', 1):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        cache.flush()
+        assert self.client.get_type(uid=1)[0].name == 'normal-2'
+        assert len(self.Handler.requests) == 2
+
+    def test_stale_if_error(self):
+        self.expire(stale_if_error='True')
+        self.Handler.failing = True
+        assert self.client.get_type(uid=1)[0].name == 'normal-1'
+        assert len(self.Handler.requests) == 2
+        # Without it, the error comes through.
+        self.Handler.failing = False
+        self.expire()
+        self.Handler.failing = True
+        with self.assertRaises(client.InvalidStatusCodeError):
+            self.client.get_type(uid=1)
+
+
+class NegativeCacheTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            self.send_response(404)
+            self.end_headers()
+
+    def test_not_found(self):
+        for attempt in range(3):
+            with self.assertRaises(client.NotFoundError) as raised:
+                self.client.get_type(uid='nromal')
+            assert raised.exception.status_code == 404
+        # Only the first attempt reached Pokeapi.
+        assert self.Handler.requests == ['/api/v2/type/nromal/']
+        assert cache.is_missing('type', 'nromal')
+        assert cache.read_cache('type', 'nromal') is None
+        # Once the negative entry expires, Pokeapi is asked again.
+        cache.write_missing('type', 'nromal', timedelta(seconds=-1))
+        assert not cache.is_missing('type', 'nromal')
+        with self.assertRaises(client.NotFoundError):
+            self.client.get_type(uid='nromal')
+        assert len(self.Handler.requests) == 2
+        # A length of zero is used as given, not taken as unset.
+        cache.write_missing('type', 'dragn', timedelta(0))
+        assert cache.get_store().get_expiration('type', 'dragn') <= \
+            time.time() + 1
+
+
+class CoalescingTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            time.sleep(0.3)
+            self.send_json({'id': 1, 'name': 'normal'})
+
+    def test_single_fetch(self):
+        # Clients missing the same resource at once wait for the first
+        # one's fetch instead of making their own.
+        clients = [client.PokemonClient() for i in range(4)]
+        results = [None] * len(clients)
+
+        def get(position):
+            results[position] = clients[position].get_type(uid=1)
+
+        threads = [threading.Thread(target=get, args=(position,))
+                   for position in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.Handler.requests == ['/api/v2/type/1/']
+        assert all(result[0].name == 'normal' for result in results)
+        # A lease that isn't let go in time is given up on.
+        lease = cache.take_lease('type', 2)
+        assert cache.take_lease('type', 2) is None
+        assert not cache.wait_for_lease('type', 2, 0.05)
+        lease.release()
+        assert cache.wait_for_lease('type', 2, 0.05)
+        # Released leases leave no files behind.
+        assert not os.path.exists(cache.lease_path('type', 1))
+        assert not os.path.exists(cache.lease_path('type', 2))
+
+
+class MetricsTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            self.send_json({'id': 1, 'name': 'normal'})
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        reads = registry.counter('reads_total', 'Reads.', ('category',))
+        seconds = registry.histogram('read_seconds', 'Read time.',
+                                     ('category',), buckets=(0.1, 1.0))
+        reads.increment('type')
+        reads.increment('type', amount=2)
+        seconds.observe(0.5, 'type')
+        seconds.observe(2.0, 'type')
+        snapshot = registry.snapshot()
+        assert snapshot['reads_total'] == {('type',): 3}
+        assert snapshot['read_seconds'][('type',)] == {
+            'buckets': [(0.1, 0), (1.0, 1), (float('inf'), 2)],
+            'count': 2, 'sum': 2.5}
+        exported = []
+        registry.export(exported.append)
+        assert 'reads_total{category="type"} 3' in exported[0]
+        assert 'read_seconds_bucket{category="type",le="+Inf"} 2' in \
+            exported[0]
+        path = os.path.join(self.directory.name, 'metrics.prom')
+        registry.export(path)
+        with open(path) as file:
+            assert file.read() == exported[0]
+        registry.reset()
+        assert registry.snapshot() == {'reads_total': {},
+                                       'read_seconds': {}}
+
+    def test_client(self):
+        for attempt in range(2):
+            assert self.client.get_type(uid=1)[0].name == 'normal'
+        snapshot = metrics.registry.snapshot()
+        assert snapshot['pykachu_requests_total'] == {('type', 'miss'): 1,
+                                                      ('type', 'hit'): 1}
+        assert snapshot['pykachu_fetch_seconds'][('type', 'ok')][
+            'count'] == 1
+        assert snapshot['pykachu_cache_writes_total'] == {
+            ('type', 'written'): 1}
+        assert snapshot['pykachu_cache_reads_total'][('type', 'miss')] == 1
+        assert 'pykachu_compressed_stored_bytes{category="type"}' in \
+            metrics.registry.to_prometheus()
+
+
+class WarmerTestCase(StubServerTestCase):
+
+    class Handler(StubHandler):
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            if self.path.startswith('/api/v2/type/?'):
+                self.send_json({'count': 3, 'results': [
+                    {'name': 'type-{}'.format(id),
+                     'url': 'http://127.0.0.1/api/v2/type/{}/'.format(id)}
+                    for id in (1, 2, 3)]})
+            else:
+                id = int(self.path.rstrip('/').rpartition('/')[2])
+                self.send_json({'id': id, 'name': 'type-{}'.format(id)})
+
+    def test_warm(self):
+        checkpoint = os.path.join(self.directory.name, 'checkpoint.json')
+        store = cache.get_store()
+        with mock.patch.object(store, 'write_many',
+                               wraps=store.write_many) as write_many:
+            report = warmer.warm(['TypeResource'], workers=2, batch_size=2,
+                                 checkpoint=checkpoint, progress=None,
+                                 pokemon_client=self.client)
+        assert sorted(report.fetched) == [('type', 1), ('type', 2),
+                                          ('type', 3)]
+        # Each batch is written together.
+        assert write_many.call_count == 2
+        assert self.client.get_type(uid=2)[0].name == 'type-2'
+        assert warmer.load_checkpoint(checkpoint) == {'type': {1, 2, 3}}
+        # Everything is fresh now, so nothing is fetched.
+        report = warmer.warm(['type'], progress=None,
+                             pokemon_client=self.client)
+        assert report.fetched == [] and len(report.skipped) == 3
+
+
+class ImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': os.path.join(self.directory.name, 'cache'),
+                           'import_expiration_length': '48'}
+        config['codecs'] = {'type': 'zlib:9'}
+        cache.configure(cache.Settings.from_config(config))
+        self.dump = os.path.join(self.directory.name, 'dump')
+        for id in (1, 2, 3):
+            folder = os.path.join(self.dump, 'api', 'v2', 'type', str(id))
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'index.json'), 'w') as file:
+                file.write(json.dumps({'id': id, 'name': 'type-{}'.format(id)})
+                           if id < 3 else '{not json')
+        with open(os.path.join(self.dump, 'api', 'v2', 'type',
+                               'index.json'), 'w') as file:
+            json.dump({'count': 3, 'results': []}, file)
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    def test_settings_pickle(self):
+        settings = cache.get_settings()
+        copy = pickle.loads(pickle.dumps(settings))
+        assert copy == settings
+        assert copy.codecs['type'] == (cache.codecs['zlib'], 9)
+
+    def test_import(self):
+        report = importer.import_dump(self.dump, ['type', 'ability'],
+                                      processes=2, chunk_size=1,
+                                      progress=None)
+        assert report.imported == [('type', 1), ('type', 2)]
+        assert report.failed == [('type', 3)]
+        assert report.missing == ['ability']
+        assert cache.read_cache('type', 2)[0].name == 'type-2'
+        expiration = cache.get_store().get_expiration('type', 1)
+        assert abs(expiration - (time.time() + 48 * 3600)) < 60
+        # The whole batch went into the journal.
+        catalog = cache.get_catalog()
+        assert catalog.get('sizes', 'type', 1) > 0
+        assert catalog.get('paths', 'type', 2).endswith(
+            os.path.join('pokemon', 'types', '2'))
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['cache'] = {'path': os.path.join(self.directory.name, 'cache')}
+        cache.set_up(cache.Settings.from_config(config))
+        self.path = os.path.join(self.directory.name, 'cache.bundle')
+
+    def tearDown(self):
+        cache.flush()
+        cache.reload()
+        self.directory.cleanup()
+
+    def test_freeze(self):
+        for id in range(1, 50):
+            cache.write_cache([resources.TypeResource(id=id,
+                                                      name='type-{}'.format(id))],
+                              category='type', id=id)
+        cache.write_cache([resources.TypeResource(id=50, name='old')],
+                          category='type', id=50,
+                          expiration_length=timedelta(seconds=-1))
+        assert cache.freeze(self.path, label='v1') == 49
+        pokemon_client = client.PokemonClient(bundle=self.path)
+        assert pokemon_client.bundle.label == 'v1'
+        assert pokemon_client.get_type(uid=7)[0].name == 'type-7'
+        assert pokemon_client.bundle.read('type', 50) is None
+        # A new bundle is picked up once it replaces the old one.
+        pokemon_client.bundle.check_interval = 0
+        cache.write_cache([resources.TypeResource(id=7, name='new')],
+                          category='type', id=7)
+        cache.freeze(self.path, label='v2')
+        assert pokemon_client.get_type(uid=7)[0].name == 'new'
+        assert pokemon_client.bundle.label == 'v2'
+
+    def test_never_check(self):
+        cache.write_cache([resources.TypeResource(id=7, name='old')],
+                          category='type', id=7)
+        cache.freeze(self.path, label='v1')
+        # With config_check_interval None, the bundle is never re-checked.
+        with mock.patch.object(cache, 'config_check_interval', None):
+            bundle = cache.Bundle(self.path)
+        cache.write_cache([resources.TypeResource(id=7, name='new')],
+                          category='type', id=7)
+        cache.freeze(self.path, label='v2')
+        assert bundle.check_interval is None
+        assert bundle.read('type', 7) is not None
+        assert bundle.label == 'v1'
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -4,6 +4,7 @@
 import configparser
 import os
 import functools
+import threading
 
 config_parser = configparser.ConfigParser()
 if os.name == 'nt':
@@ -16,12 +17,31 @@ default_cache_path = os.path.expanduser(
 default_expiration_length = 7*24 # Seven days
 default_cache_size = float('inf')
 default_cache_compression = True
+default_cache_backend = 'directory'
+default_journal_compact_size = 1024*1024 # One megabyte
+default_eviction_policy = 'lru'
+default_serializer = 'yaml'
+default_write_workers = 2
+default_write_queue_size = 1000
+default_memory_entries = 1000
+default_memory_size = 64*1024*1024 # 64 megabytes
+default_memory_policy = 'lru'
+default_max_stale = 24 # One day
+default_import_expiration_length = 30*24 # Thirty days
+default_missing_expiration_length = 1 # One hour
+default_shard_levels = 0 # One flat folder per category
+default_coalesce_timeout = 10 # Seconds
 
 
-# Returns a ConfigParser with the config file loaded
+# Returns a ConfigParser with the config file loaded. The file is read into a
+# new ConfigParser, since another thread may be reading the old one.
 def get_config():
-    config_parser.read(config_path())
-    return config_parser
+    global config_parser
+    parser = configparser.ConfigParser()
+    parser.read_dict(config_parser)
+    parser.read(config_path())
+    config_parser = parser
+    return parser
 
 
 # Returns the path of the config file.
@@ -37,6 +57,29 @@ def save_config():
         config_parser.write(file)
 
 
+# Returns the name of a temporary file to write before renaming it to path.
+# It's named after the process and thread, so writers never share one.
+def temp_file_name(path):
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+# Writes a file by writing a temporary file next to it and renaming it into
+# place, so a reader in another process sees either the old file or the
+# whole new one, never half of it.
+def write_file(path, data):
+    temp_path = temp_file_name(path)
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
 # A property that caches the result to avoid querying the api more than needed.
 def lazy_property(func):
     return property(functools.lru_cache()(func))
\ No newline at end of file
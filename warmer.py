@@ -0,0 +1,229 @@
+# /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fills the cache ahead of time by fetching every resource of some or all
+# resource types from Pokeapi. Run it with
+#   python warmer.py [--workers N] [--batch-size N] [--checkpoint FILE]
+#                    [--force] [resource ...]
+# where each resource is a category name ('pokemon', 'egg group') or a
+# resource class name ('PokemonResource'). With none, every resource type is
+# warmed.
+
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import client
+import cache
+
+
+class WarmReport:
+    """
+    What warm() did.
+
+        Attributes:
+            fetched (list)
+                (category, id) of the resources fetched and cached.
+            skipped (list)
+                (category, id) of the resources that were already fresh or
+                done before a resumed run.
+            failed (list)
+                (category, id) of the resources that couldn't be fetched.
+                They're left out of the checkpoint, so the next run tries
+                them again.
+    """
+
+    def __init__(self):
+        self.fetched = []
+        self.skipped = []
+        self.failed = []
+
+
+# Returns the resource classes to warm.
+#   names=None (list of str):
+#       category names or resource class names. If None, every resource in
+#       BeckettClient.Meta.resources.
+def find_resources(names=None):
+    resources = client.BeckettClient.Meta.resources
+    if not names:
+        return list(resources)
+    by_name = {}
+    for resource in resources:
+        by_name[resource.Meta.name.lower()] = resource
+        by_name[resource.__name__.lower()] = resource
+    try:
+        return [by_name[name.lower()] for name in names]
+    except KeyError as error:
+        raise ValueError('No resource called {}.'.format(error.args[0]))
+
+
+# Returns the ids of every resource of a type, from Pokeapi's list endpoint.
+#   beckett_client (client.BeckettClient):
+#       the client whose session makes the request.
+#   resource (class):
+#       the resource class.
+def list_ids(beckett_client, resource):
+    url = resource.get_resource_url(resource,
+                                    base_url=beckett_client.Meta.base_url)
+    response = beckett_client.session.get(url.rstrip('/') + '/',
+                                          params={'limit': 100000})
+    response.raise_for_status()
+    return [int(result['url'].rstrip('/').rpartition('/')[2])
+            for result in response.json()['results']]
+
+
+# Returns the checkpoint: the ids already warmed, by category. Returns an
+# empty checkpoint if the file doesn't exist.
+def load_checkpoint(path):
+    try:
+        with open(path) as file:
+            return {category: set(ids)
+                    for category, ids in json.load(file).items()}
+    except FileNotFoundError:
+        return {}
+
+
+# Saves the checkpoint, replacing the old one in one step so a crash never
+# leaves half of it.
+def save_checkpoint(path, done):
+    cache.write_file(path, json.dumps(
+        {category: sorted(ids) for category, ids in done.items()}).encode())
+
+
+# Fetches one resource from Pokeapi. Returns (resource, expiration length,
+# validators) as the client would cache them.
+def fetch(pokemon_client, resource, id):
+    beckett_client = pokemon_client.beckett_client
+    method = getattr(beckett_client,
+                     resource.get_method_name(resource, 'GET'))
+    result = method(uid=id)
+    headers = beckett_client.last_response().headers
+    category = resource.Meta.name.lower()
+    return (result, pokemon_client.expiration_length(category, headers),
+            client.get_validators(headers))
+
+
+# Encodes a batch of fetched resources and writes them to the store in one
+# go, then evicts others if that takes the cache over its maximum size.
+#   category (str):
+#       the category the resources belong to.
+#   fetched (list):
+#       (id, resource, expiration length, validators) for each resource, as
+#       fetch() returns them.
+def store_batch(category, fetched):
+    store = cache.get_store()
+    store.write_many((category, id, cache.encode(result, category),
+                      cache.expiration_date(category, length),
+                      cache.resource_path(category, id), validators)
+                     for id, result, length, validators in fetched)
+    # Whatever the memory tier holds has just been replaced.
+    memory = cache.get_memory_tier()
+    if memory is not None:
+        for id, result, length, validators in fetched:
+            memory.remove(category, id)
+    max_size = cache.get_max_size()
+    if max_size != float('inf') and store.get_size() > max_size:
+        store.evict(max_size)
+
+
+# Prints how far warming a category has got, on one line that's rewritten.
+def print_progress(category, done, total):
+    sys.stderr.write('\r{}: {}/{}'.format(category, done, total))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
+
+# Fetches every resource of the chosen types and writes them to the cache.
+# Requests run on a pool of threads. Each batch of results is written to
+# the cache together, and then the checkpoint is saved.
+#   resources=None (list):
+#       resource classes, category names or resource class names. If None,
+#       every resource type.
+#   workers=8 (int):
+#       the most requests to make at once.
+#   batch_size=100 (int):
+#       how many resources to fetch before writing them and saving the
+#       checkpoint.
+#   checkpoint=None (str):
+#       a file recording which resources have been warmed. A run with the
+#       same file skips them, so an interrupted run can be resumed.
+#   force=False (bool):
+#       if True, resources that are already fresh in the cache are fetched
+#       anyway.
+#   progress=print_progress (function):
+#       called with (category, number done, total) after each batch. None
+#       for no progress reports.
+#   pokemon_client=None (client.PokemonClient):
+#       the client to fetch with. If None, a new one.
+# Returns a WarmReport.
+def warm(resources=None, workers=8, batch_size=100, checkpoint=None,
+         force=False, progress=print_progress, pokemon_client=None):
+    resources = find_resources(
+        [resource if isinstance(resource, str) else resource.__name__
+         for resource in resources] if resources else None)
+    pokemon_client = pokemon_client or client.PokemonClient()
+    beckett_client = pokemon_client.beckett_client
+    done = load_checkpoint(checkpoint) if checkpoint else {}
+    report = WarmReport()
+    with ThreadPoolExecutor(workers) as executor:
+        for resource in resources:
+            category = resource.Meta.name.lower()
+            finished = done.setdefault(category, set())
+            ids = list_ids(beckett_client, resource)
+            wanted = []
+            for id in ids:
+                if id in finished or (not force and
+                                      cache.is_fresh(category, id)):
+                    report.skipped.append((category, id))
+                else:
+                    wanted.append(id)
+            for start in range(0, len(wanted), batch_size):
+                batch = wanted[start:start + batch_size]
+                futures = [executor.submit(fetch, pokemon_client, resource,
+                                           id)
+                           for id in batch]
+                fetched = []
+                for id, future in zip(batch, futures):
+                    try:
+                        fetched.append((id,) + future.result())
+                    except Exception:
+                        report.failed.append((category, id))
+                store_batch(category, fetched)
+                for id, result, length, validators in fetched:
+                    finished.add(id)
+                    report.fetched.append((category, id))
+                if checkpoint:
+                    save_checkpoint(checkpoint, done)
+                if progress:
+                    progress(category, len(ids) - len(wanted) + start +
+                             len(batch), len(ids))
+            if progress and not wanted:
+                progress(category, len(ids), len(ids))
+    cache.flush()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fetch resources from Pokeapi into the cache.')
+    parser.add_argument('resources', nargs='*',
+                        help='category or resource class names; all if none')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='the most requests to make at once')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='resources to fetch between checkpoints')
+    parser.add_argument('--checkpoint',
+                        help='file recording progress, for resuming')
+    parser.add_argument('--force', action='store_true',
+                        help='fetch resources that are already fresh')
+    args = parser.parse_args(argv)
+    report = warm(args.resources or None, args.workers, args.batch_size,
+                  args.checkpoint, args.force)
+    print('{} fetched, {} skipped, {} failed'.format(
+        len(report.fetched), len(report.skipped), len(report.failed)))
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())